@@ -1,15 +1,32 @@
 # coding=utf-8
-from datetime import datetime
+import base64
+import heapq
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
 
+import click
 import pytz
 from dateutil import parser
-from flask import Flask, request
+from flask import Flask, Response, g, request, stream_with_context
 from flask_restful import reqparse, abort, Api, Resource
-from sqlalchemy import create_engine
+from werkzeug.http import quote_etag
+from sqlalchemy import String, event, exists, func, inspect, and_, or_, select, type_coerce, literal_column, table, \
+    column
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from database import Base, populate_db
-from models import User, Message, BEGINNING_OF_TIME, MESSAGE_MAXLEN
+from cache import CachedUser, LRUCache, MemoryRangeCache, SQLiteRangeCache, range_cache_key
+from database import Base, allocate_message_ids, attach_directory, bulk_load, create_db_engine, create_shard_tables, \
+    create_tables, incremental_vacuum, migrate_db, move_mailbox, populate_db, rebuild_search_index, resume_mailbox_moves
+from models import ArchivedMessage, Mailbox, User, Message, BEGINNING_OF_TIME, MESSAGE_MAXLEN
+from group_commit import GroupCommitWriter
+from jobs import PeriodicJob
+from metrics import RequestMetrics
+from notify import NotificationHub, RecentWriters
+from serialize import MessageSerializer
+from timestamps import format_timestamp, parse_iso8601
 from views import views
 
 app = Flask(__name__)
@@ -22,36 +39,176 @@ app.secret_key = "5"  # Guaranteed random by fair dice roll
 app.config["DEBUG"] = False
 
 db_session = None
+read_session = None
+shard_sessions = []
+recent_writers = None
+notification_hub = None
+user_cache = None
+message_serializer = None
+range_cache = None
+request_metrics = None
+group_commit_writers = {}
+search_enabled = False
+archive_job = None
 
+# Lists of values in IN (...) clauses are split in chunks of this size, to stay well below SQLite's limit on bound
+# parameters (999)
+IN_CHUNK_SIZE = 500
 
-def get_user_message_by_id(user, msg_id, fail_silently=False):
+# The maximum number of messages that can be sent in one batch POST request
+MESSAGE_BATCH_MAXLEN = 10000
+
+# The largest page size that MessageList accepts in its "limit" parameter. Larger limits are lowered to this value.
+MESSAGE_LIST_MAX_LIMIT = 1000
+
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Streamed message lists are fetched from the database and written to the client in batches of this many messages
+STREAM_BATCH_SIZE = 500
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# The longest time, in seconds, that a long-polling MessageList request may wait for new messages
+LONG_POLL_MAX_WAIT = 60
+
+# Event streams are closed after this many seconds, after which the client reconnects. While there are no new
+# messages, a keepalive comment is sent every EVENT_STREAM_KEEPALIVE seconds.
+EVENT_STREAM_DURATION = 300
+EVENT_STREAM_KEEPALIVE = 15
+
+# The number of results that MessageSearch returns per page without a "limit" parameter
+SEARCH_DEFAULT_LIMIT = 20
+
+# The full-text index of the messages, created by database.create_search_index
+search_index = table("messages_fts", column("rowid"))
+
+# After flagging users as archived, archive_old_messages waits for the user caches of all worker processes to check
+# for invalidations, and then this many seconds more for the requests that still had the users cached to finish
+ARCHIVE_FLAG_DELAY = 1
+
+# Parsed "start" and "end" parameters, since clients tend to repeat the same boundaries
+datetime_cache = LRUCache(1024)
+
+
+def chunks(values, size=None):
     """
-    Retrieves a specific message. Returns 400 Bad Request or 404 Not Found for invalid requests.
-    :param user: a User object representing the recipient of the requested message
-    :param msg_id: the id of the specific message. The message's recipient has to be the specified user.
-    This variable may be an integer or a string containing an integer.
-    :param fail_silently: do not raise errors if a message could not be retrieved. Returns None instead if an error
-    occurs.
-    :return: The message, if found. If the message could not be found, an error will be raised.
+    Splits a list into chunks, e.g. for use in IN (...) clauses.
+    :param values: the list to be split
+    :param size: the maximum length of each chunk. Defaults to IN_CHUNK_SIZE.
+    :return: a generator of lists
     """
+    size = size or IN_CHUNK_SIZE
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
+
+def read_db():
+    """
+    Returns the session for the read-only queries of the current request. That is the read session, which may be
+    bound to a read replica, unless the request has written to the database or its user has done so recently, see
+    record_write(). Writes always go to db_session, the session of the primary database.
+    :return: a scoped session
+    """
+    if read_session is db_session or g.get("use_primary", False):
+        return db_session
+    return read_session
+
+
+def record_write(user_id):
+    """
+    Sends the remaining reads of the current request to the primary database, and those of the user's requests in
+    the next READ_YOUR_WRITES_SECONDS as well, so that the user sees their own changes even if the read replicas lag
+    behind.
+    :param user_id: the id of the user who changed data
+    """
+    g.use_primary = True
+    if recent_writers is not None:
+        recent_writers.record(user_id)
+
+
+def messages_db(user, write=False):
+    """
+    Returns the session for the messages received by a user. With DATABASE_SHARDS, that is the session of the shard
+    that the user's mailbox is on, except that reads of the mailboxes on the primary database go to read_db().
+    :param user: a CachedUser representing the recipient of the messages
+    :param write: whether the messages are going to be changed
+    :return: a scoped session
+    """
+    if shard_sessions and user.shard != 0:
+        return shard_sessions[user.shard]
+    return db_session if write else read_db()
+
+
+def message_dbs():
+    """:return: the sessions for reading the messages of all shards, or just read_db() if there are no shards"""
+    return [read_db()] + shard_sessions[1:]
+
+
+def release_sessions():
+    """Ends the transactions of the current thread's sessions, e.g. before waiting, returning their connections."""
+    db_session.commit()
+    if read_session is not db_session:
+        read_session.commit()
+    for session in shard_sessions[1:]:
+        session.commit()
+
+
+class ShardMoved(Exception):
+    """
+    Raised when messages were about to be stored or deleted on a shard that their mailbox has been moved away from, by
+    a request that looked up the receiver before the move. The transaction is rolled back, and the request retries
+    with the receiver looked up again, see refresh_user().
+    """
+
+    def __init__(self, shard, receiver_ids):
+        Exception.__init__(self, "Not all mailboxes of users %s are on shard %d" % (sorted(receiver_ids), shard))
+        self.shard = shard
+        self.receiver_ids = receiver_ids
+
+
+def parse_message_id(msg_id):
+    """
+    Validates a message id from a URL or a request body.
+    :param msg_id: the message id, an integer or a string containing an integer
+    :return: the message id as an integer, or None if it is not a valid message id
+    """
     if isinstance(msg_id, basestring):
         if not msg_id.isdigit():
             app.logger.warning(u"Non-digit message id string: %s" % msg_id)
-            if fail_silently:
-                return None
-            else:
-                abort(400)
+            return None
         msg_id = int(msg_id)
 
-    if not isinstance(msg_id, int):
+    if not isinstance(msg_id, (int, long)) or isinstance(msg_id, bool):
         app.logger.warning(u"Non-digit message id: %s" % msg_id)
+        return None
+
+    return msg_id
+
+
+def get_user_message_by_id(user, msg_id, fail_silently=False):
+    """
+    Retrieves a specific message. Returns 400 Bad Request or 404 Not Found for invalid requests.
+    :param user: a CachedUser representing the recipient of the requested message
+    :param msg_id: the id of the specific message. The message's recipient has to be the specified user.
+    This variable may be an integer or a string containing an integer.
+    :param fail_silently: do not raise errors if a message could not be retrieved. Returns None instead if an error
+    occurs.
+    :return: The message as returned by query_messages(), if found. If the message could not be found, an error will
+    be raised.
+    """
+
+    msg_id = parse_message_id(msg_id)
+    if msg_id is None:
         if fail_silently:
             return None
         else:
             abort(400)
 
-    message = Message.query.filter_by(receiver=user, id=msg_id).first()
+    message = query_messages(user).filter(Message.receiver_id == user.id, Message.id == msg_id).first()
+    if message is None and user.archived:
+        message = query_messages(user, ArchivedMessage) \
+            .filter(ArchivedMessage.receiver_id == user.id, ArchivedMessage.id == msg_id).first()
+    count_rows(1 if message else 0)
     if not message:
         app.logger.warning(u"No message id %d found for user %s" % (msg_id, user.username))
         if fail_silently:
@@ -62,45 +219,757 @@ def get_user_message_by_id(user, msg_id, fail_silently=False):
     return message
 
 
+def delete_user_messages(user, ids, report=False):
+    """
+    Deletes messages in bulk, in a single transaction. Each chunk of IN_CHUNK_SIZE ids is deleted with one
+    DELETE ... WHERE receiver_id = ? AND id IN (...) statement. If the user has archived messages, chunks with ids that
+    are not in the messages table are also deleted from the archive.
+    :param user: a CachedUser representing the recipient of the messages. Messages to other users are never deleted.
+    :param ids: the ids of the messages to delete, integers or strings containing integers. Invalid ids are ignored.
+    :param report: also find out which of the ids were deleted, at the cost of a SELECT per chunk
+    :return: if report is True, a tuple of two sorted lists: the ids that were deleted and the ids that were missing
+    or invalid. Otherwise, the number of deleted messages.
+    """
+    valid_ids = set()
+    invalid_ids = []
+    for msg_id in ids:
+        parsed_id = parse_message_id(msg_id)
+        if parsed_id is None:
+            invalid_ids.append(msg_id)
+        else:
+            valid_ids.add(parsed_id)
+
+    valid_ids = sorted(valid_ids)
+    deleted = []
+    deleted_timestamps = []
+    deleted_count = 0
+    session = messages_db(user, write=True)
+    try:
+        for chunk in chunks(valid_ids):
+            discount_unread(session, user, chunk)
+            chunk_count = 0
+            for model in (Message, ArchivedMessage) if user.archived else (Message,):
+                if chunk_count == len(chunk):
+                    break
+                criteria = (model.receiver_id == user.id, model.id.in_(chunk))
+                if report or range_cache is not None:
+                    # The timestamps tell which cached date ranges contained the messages
+                    for row in session.query(model.id, model.timestamp).filter(*criteria):
+                        deleted.append(row.id)
+                        deleted_timestamps.append(row.timestamp)
+                chunk_count += session.query(model).filter(*criteria).delete(synchronize_session=False)
+            deleted_count += chunk_count
+        if shard_sessions:
+            # Nothing is found on a shard that the mailbox has been moved away from, so the version is changed even if
+            # nothing was deleted, to find out whether the mailbox is still there
+            if not bump_mailbox_versions([user.id], session, user.shard, ranges=True):
+                raise ShardMoved(user.shard, [user.id])
+        elif deleted_count:
+            bump_mailbox_versions([user.id], session, ranges=True)
+        session.commit()
+    except ShardMoved:
+        session.rollback()
+        return delete_user_messages(refresh_user(user), ids, report)
+    except Exception:
+        session.rollback()
+        raise
+    if deleted_count:
+        record_write(user.id)
+    if range_cache is not None and deleted_timestamps:
+        range_cache.invalidate(user.id, deleted_timestamps)
+
+    app.logger.debug(u"Deleted %d of %d messages for user %s" % (deleted_count, len(ids), user.username))
+    if deleted_count < len(ids):
+        app.logger.warning(u"Attempted deletion of %d messages failed for user %s" %
+                           (len(ids) - deleted_count, user.username))
+
+    if not report:
+        return deleted_count
+
+    deleted.sort()
+    deleted_set = set(deleted)
+    missing = [msg_id for msg_id in valid_ids if msg_id not in deleted_set] + invalid_ids
+    return deleted, missing
+
+
+def get_users(usernames):
+    """
+    Looks up several users at once. Users that are not in the user cache are looked up in one query.
+    :param usernames: the user names to look up
+    :return: a dict from user name to CachedUser, containing only the users that exist
+    """
+    users = {}
+    uncached = []
+    for username in set(usernames):
+        user = user_cache.get(username)
+        if user is None:
+            uncached.append(username)
+        else:
+            users[username] = user
+
+    for chunk in chunks(uncached):
+        for row in read_db().query(User.id, User.username, User.shard, User.archived) \
+                .filter(User.username.in_(chunk)):
+            users[row.username] = CachedUser(row.id, row.username, row.shard, row.archived)
+            user_cache.put(row.username, users[row.username])
+    return users
+
+
+def mailbox_columns(shard):
+    """
+    The state of a mailbox is kept in the same database as its messages, so that it can be changed in the same
+    transaction: in the users table on the primary database, and in the mailboxes table on the other shards.
+    :param shard: the shard of the mailbox, or None without DATABASE_SHARDS
+    :return: a tuple of the user id, mailbox version, last_read_id and unread_count columns of the mailbox
+    """
+    if shard:
+        return Mailbox.receiver_id, Mailbox.version, Mailbox.last_read_id, Mailbox.unread_count
+    return User.id, User.mailbox_version, User.last_read_id, User.unread_count
+
+
+def range_version_column(shard):
+    """
+    :param shard: the shard of the mailbox, or None without DATABASE_SHARDS
+    :return: the range version column of the mailbox, in the table of mailbox_columns(), see range_etag()
+    """
+    return Mailbox.range_version if shard else User.range_version
+
+
+def get_last_read_id(user):
+    """
+    Reads a user's last_read_id high-water mark, which is never cached since it changes all the time. It is always
+    read from the primary database or the user's shard, so that a lagging read replica can't make messages be
+    delivered twice.
+    :param user: a CachedUser
+    :return: the id of the last message that the user has fetched
+    """
+    user_id, version, last_read_id, unread_count = mailbox_columns(user.shard if shard_sessions else None)
+    return messages_db(user, write=True).query(last_read_id).filter(user_id == user.id).scalar() or 0
+
+
+def get_unread_count(user):
+    """
+    Reads the number of messages that a user has not fetched yet, i.e. those with a higher id than their last_read_id.
+    The count is kept up to date whenever messages are stored, deleted or delivered, so this reads a single row. Like
+    last_read_id, it is read from the primary database or the user's shard.
+    :param user: a CachedUser
+    :return: the number of unread messages
+    """
+    user_id, version, last_read_id, unread_count = mailbox_columns(user.shard if shard_sessions else None)
+    return messages_db(user, write=True).query(unread_count).filter(user_id == user.id).scalar() or 0
+
+
+def get_mailbox_version(user, ranges=False):
+    """
+    Reads the version of a user's mailbox, which changes whenever messages are stored for the user or deleted.
+    :param user: a CachedUser
+    :param ranges: read the range version instead, see range_etag()
+    :return: the version number
+    """
+    if shard_sessions and user.shard != 0:
+        # 0 if the mailbox has been moved away, which a mailbox on the shard never has
+        column = Mailbox.range_version if ranges else Mailbox.version
+        return messages_db(user).query(column).filter(Mailbox.receiver_id == user.id).scalar() or 0
+    return read_db().query(User.range_version if ranges else User.mailbox_version).filter(User.id == user.id).scalar()
+
+
+def mailbox_etag(user, *values):
+    """
+    :param user: a CachedUser
+    :param values: integers that identify the response within the mailbox
+    :return: an unquoted ETag made of the user's mailbox version and the values. With DATABASE_SHARDS, the user's shard
+    comes first, so that a response read from the old shard while the mailbox was being moved doesn't match later.
+    """
+    values = [get_mailbox_version(user)] + list(values)
+    if shard_sessions:
+        values.insert(0, user.shard)
+    return ".".join("%d" % value for value in values)
+
+
+def range_etag(user):
+    """
+    Messages are stored with the current time, so the messages of a date range that has ended only change when messages
+    are deleted or loaded, or their senders renamed. The range version of the mailbox only changes then, and not when
+    messages are stored like the mailbox version.
+    :param user: a CachedUser
+    :return: an unquoted ETag of the user's date ranges that have ended, made of the range version like mailbox_etag()
+    """
+    values = [get_mailbox_version(user, ranges=True)]
+    if shard_sessions:
+        values.insert(0, user.shard)
+    return ".".join("%d" % value for value in values)
+
+
+def bump_mailbox_versions(user_ids, session=None, shard=None, unread=0, ranges=False):
+    """
+    Changes the mailbox versions of users, invalidating the ETags of their messages. Call this in the same transaction
+    that changes the messages.
+    :param user_ids: the ids of the users whose messages are changing
+    :param session: the session of that transaction, db_session by default
+    :param shard: with DATABASE_SHARDS, the shard of the session. Only the mailboxes that are on the shard are changed,
+    see mailbox_columns().
+    :param unread: the number of new messages to add to the unread count of each user
+    :param ranges: whether messages in date ranges that have ended are changing, e.g. deleted, in which case the range
+    versions are changed as well, see range_etag()
+    :return: the number of mailboxes that were changed
+    """
+    session = session or db_session
+    user_id, version, last_read_id, unread_count = mailbox_columns(shard)
+    values = {version: version + 1}
+    if unread:
+        values[unread_count] = unread_count + unread
+    if ranges:
+        range_version = range_version_column(shard)
+        values[range_version] = range_version + 1
+    changed = 0
+    for chunk in chunks(sorted(user_ids)):
+        query = session.query(user_id.class_).filter(user_id.in_(chunk))
+        if shard == 0:
+            query = query.filter(User.shard == 0)
+        changed += query.update(values, synchronize_session=False)
+    return changed
+
+
+def discount_unread(session, user, ids):
+    """
+    Subtracts the unread ones among messages that are about to be deleted from a user's unread count. Call this in the
+    transaction that deletes them, before deleting them.
+    :param session: the session of that transaction
+    :param user: a CachedUser representing the recipient of the messages
+    :param ids: the ids of the messages, at most IN_CHUNK_SIZE of them
+    """
+    user_id, version, last_read_id, unread_count = mailbox_columns(user.shard if shard_sessions else None)
+    unread = select([func.count()]).where(and_(Message.receiver_id == user.id, Message.id.in_(ids),
+                                               Message.id > last_read_id)).as_scalar()
+    session.query(user_id.class_).filter(user_id == user.id) \
+        .update({unread_count: unread_count - unread}, synchronize_session=False)
+
+
+def not_modified(etag):
+    """
+    :param etag: the current ETag of the requested resource, unquoted
+    :return: a 304 Not Modified response if the request's If-None-Match header matches the ETag, otherwise None
+    """
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": quote_etag(etag)})
+    return None
+
+
+def truncate_message(message):
+    """
+    Truncates a message to MESSAGE_MAXLEN characters.
+    :param message: the message contents
+    :return: the message contents, truncated if necessary
+    """
+    if len(message) > MESSAGE_MAXLEN:
+        app.logger.warning("Message length exceeds MESSAGE_MAXLEN (%d), truncating" % MESSAGE_MAXLEN)
+        # Not necessary with SQLite (https://sqlite.org/faq.html#q9) but it seems prudent nonetheless.
+        message = message[:MESSAGE_MAXLEN]
+    return message
+
+
+def store_messages(rows, receivers):
+    """
+    Stores new messages and wakes up the requests waiting for them. If GROUP_COMMIT is enabled, the messages are
+    committed by the group commit writer together with the messages of concurrent requests, otherwise in a
+    transaction of their own. Either way, this returns once the messages have been committed.
+    With DATABASE_SHARDS, the messages are stored on the shards of their receivers, in one transaction per shard. If
+    the directory has moved a receiver's mailbox since the receiver was looked up, the messages of that transaction
+    are stored again with the receivers looked up again.
+    :param rows: a list of dicts with the keys "sender_id", "receiver_id", "message" and "timestamp"
+    :param receivers: a dict from user id to CachedUser, containing the receivers of the messages
+    """
+    pending = rows
+    while pending:
+        by_shard = {}
+        for row in pending:
+            by_shard.setdefault(receivers[row["receiver_id"]].shard if shard_sessions else None, []).append(row)
+        pending = []
+        for shard, shard_rows in sorted(by_shard.items()):
+            try:
+                if group_commit_writers:
+                    # Return the connection to the pool while waiting, which the writer thread might need
+                    release_sessions()
+                    group_commit_writers[shard].submit(shard_rows)
+                else:
+                    insert_messages(shard_rows, shard)
+            except ShardMoved as e:
+                for receiver_id in e.receiver_ids:
+                    receivers[receiver_id] = refresh_user(receivers[receiver_id])
+                pending.extend(shard_rows)
+
+    for sender_id in set(row["sender_id"] for row in rows):
+        record_write(sender_id)
+    notification_hub.notify(set(row["receiver_id"] for row in rows))
+
+
+def insert_messages(rows, shard=None):
+    """
+    Inserts messages with a single multi-row INSERT and commits them in one transaction, together with the new
+    mailbox versions and unread counts of the receivers. Rolls back if anything fails.
+    :param rows: a list of dicts with the keys "sender_id", "receiver_id", "message" and "timestamp"
+    :param shard: with DATABASE_SHARDS, the number of the shard that the mailboxes of all receivers are on. The ids of
+    the messages are taken from the id sequence of the shard. Raises ShardMoved, without inserting anything, if the
+    directory has moved any of the mailboxes to another shard. Without shards, the ids are taken from the id sequence
+    of the primary database, see allocate_message_ids.
+    """
+    session = db_session if shard is None else shard_sessions[shard]
+    try:
+        rows = [dict(row, id=msg_id) for row, msg_id in zip(rows, allocate_message_ids(session, shard, len(rows)))]
+        session.execute(Message.__table__.insert(), rows)
+        counts = Counter(row["receiver_id"] for row in rows)
+        # One UPDATE for all receivers with the same number of new messages, usually just one
+        receivers_by_count = {}
+        for receiver_id, count in counts.items():
+            receivers_by_count.setdefault(count, []).append(receiver_id)
+        changed = sum(bump_mailbox_versions(receiver_ids, session, shard, unread=count)
+                      for count, receiver_ids in receivers_by_count.items())
+        if changed < len(counts) and shard is not None:
+            raise ShardMoved(shard, set(counts))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
 def get_user_or_error(username, error=404):
     """
-    Retrieves a User object based on a user name. Raises an error if the specified user does not exist.
+    Retrieves a user based on a user name. Raises an error if the specified user does not exist.
+    Users are looked up in the user cache first, so most requests don't need to query the users table. If the user has
+    changed data recently, the reads of the request go to the primary database, see record_write().
     :param username: a string containing the user name
     :param error: the error to be thrown if the user does not exist. Default value is 404 (Not Found).
-    :return: a User object
+    :return: a CachedUser with the user's id, user name, shard and archived flag
     """
-    user = User.query.filter_by(username=username).first()
-    if not user:
-        app.logger.warning(u"User '%s' does not exist, returning %s" % (username, error))
-        abort(error)
+    user = user_cache.get(username)
+    if user is None:
+        row = read_db().query(User.id, User.username, User.shard, User.archived).filter_by(username=username).first()
+        if not row:
+            app.logger.warning(u"User '%s' does not exist, returning %s" % (username, error))
+            abort(error)
+        user = CachedUser(row.id, row.username, row.shard, row.archived)
+        user_cache.put(username, user)
 
+    if recent_writers is not None and recent_writers.recent(user.id):
+        g.use_primary = True
     return user
 
 
+def refresh_user(user):
+    """
+    Looks up a user again in the primary database, e.g. after their mailbox has been moved to another shard, and
+    removes the outdated entry from the user caches of all worker processes.
+    :param user: the outdated CachedUser
+    :return: the current CachedUser. Raises 404 Not Found if the user has been deleted.
+    """
+    user_cache.invalidate(user.username)
+    g.use_primary = True
+    return get_user_or_error(user.username)
+
+
+@event.listens_for(User, "after_update")
+def invalidate_renamed_user(mapper, connection, target):
+    """
+    Removes users from the user cache in all worker processes when their user name changes. The messages they sent now
+    show the new name, so the mailbox and range versions of their receivers are changed as well.
+    """
+    history = inspect(target).attrs.username.history
+    if history.has_changes():
+        receivers = select([Message.receiver_id]).where(Message.sender_id == target.id)
+        connection.execute(User.__table__.update().where(User.id.in_(receivers)).values(
+            mailbox_version=User.mailbox_version + 1, range_version=User.range_version + 1))
+        # The mailboxes on the other shards have their versions there
+        for session in shard_sessions[1:]:
+            session.get_bind().execute(Mailbox.__table__.update().where(Mailbox.receiver_id.in_(receivers)).values(
+                version=Mailbox.version + 1, range_version=Mailbox.range_version + 1))
+    if user_cache is not None and history.has_changes():
+        for username in history.deleted:
+            user_cache.invalidate(username)
+        user_cache.invalidate(target.username)
+
+
+@event.listens_for(User, "after_delete")
+def invalidate_deleted_user(mapper, connection, target):
+    """Removes users from the user cache in all worker processes when they are deleted."""
+    if user_cache is not None:
+        user_cache.invalidate(target.username)
+
+
+def query_messages(user, model=Message):
+    """
+    Returns a query for the message columns needed by dictify_message() and the MessageSerializer. The sender's
+    username is joined in, so that serializing a list of messages does not need an extra query per message to load the
+    sender. The timestamp is also selected as the text stored by SQLite, which the serializer uses as is.
+    Filter on the Message columns, since filter_by() would apply to the joined User.
+    :param user: a CachedUser representing the recipient of the messages, whose shard is queried
+    :param model: Message, or ArchivedMessage to query the archived messages
+    :return: a query yielding rows with the attributes "id", "sender", "message", "timestamp" and "stored_timestamp"
+    """
+    return messages_db(user).query(model.id, User.username.label("sender"), model.message, model.timestamp,
+                                   type_coerce(model.timestamp, String).label("stored_timestamp")) \
+        .join(User, model.sender_id == User.id)
+
+
+def with_archive(user, query_for):
+    """
+    Combines a query of the messages with the same query of the archived messages, if the user has any. Building and
+    compiling the UNION takes a few times longer than the query itself, so users without archived messages are spared.
+    :param user: a CachedUser representing the recipient of the messages
+    :param query_for: a function that takes Message or ArchivedMessage and returns a query of that model, based on
+    query_messages()
+    :return: a query of the messages, or of both tables, UNION ALL, which can be ordered on the Message columns
+    """
+    if not user.archived:
+        return query_for(Message)
+    return query_for(Message).union_all(query_for(ArchivedMessage))
+
+
+def query_user_messages(user, start, end, cursor=None):
+    """
+    Returns a query for the messages received by a user within a date range, ordered by timestamp and id, including
+    the archived messages, see with_archive(). SQLite merges the two index ranges, which are already in that order.
+    :param user: a CachedUser representing the recipient of the messages
+    :param start: the earliest timestamp of the messages, inclusive
+    :param end: the latest timestamp of the messages, inclusive
+    :param cursor: optionally, a (timestamp, id) tuple from decode_cursor(). Only messages after it are returned.
+    :return: a query as returned by query_messages()
+    """
+    def query_for(model):
+        query = query_messages(user, model).filter(model.receiver_id == user.id, model.timestamp.between(start, end))
+        return after_cursor(query, cursor, model)
+
+    return with_archive(user, query_for).order_by(Message.timestamp, Message.id)
+
+
+def after_cursor(query, cursor, model=Message):
+    """
+    :param query: a message query
+    :param cursor: a (timestamp, id) tuple from decode_cursor(), or None
+    :param model: the model that the query selects, Message or ArchivedMessage
+    :return: the query, restricted to the messages after the cursor in timestamp and id order
+    """
+    if cursor is None:
+        return query
+    cursor_timestamp, cursor_id = cursor
+    # The redundant lower bound lets SQLite seek to the cursor in a timestamp index instead of scanning up to it
+    return query.filter(model.timestamp >= cursor_timestamp,
+                        or_(model.timestamp > cursor_timestamp,
+                            and_(model.timestamp == cursor_timestamp, model.id > cursor_id)))
+
+
+def query_conversation(sender, receiver, cursor=None):
+    """
+    Returns a query for one direction of a conversation: the messages sent by one user to another, ordered by
+    timestamp and id. It is a single range of the ix_messages_sender_receiver_timestamp index on the receiver's shard,
+    merged with the same range of the archived messages.
+    :param sender: a CachedUser representing the sender of the messages
+    :param receiver: a CachedUser representing the recipient of the messages
+    :param cursor: optionally, a (timestamp, id) tuple from decode_cursor(). Only messages after it are returned.
+    :return: a query as returned by query_messages()
+    """
+    def query_for(model):
+        query = query_messages(receiver, model).filter(model.sender_id == sender.id, model.receiver_id == receiver.id)
+        return after_cursor(query, cursor, model)
+
+    return with_archive(receiver, query_for).order_by(Message.timestamp, Message.id)
+
+
+def query_new_messages(user, after_id):
+    """
+    Returns a query for the messages received by a user after a given message, ordered by id.
+    :param user: a CachedUser representing the recipient of the messages
+    :param after_id: only messages with a higher id than this are returned, usually the user's last_read_id
+    :return: a query as returned by query_messages()
+    """
+    return query_messages(user).filter(Message.receiver_id == user.id, Message.id > after_id).order_by(Message.id)
+
+
+def search_expression(receiver_id, text):
+    """
+    Builds the FTS5 query for a search of a user's messages. Each word of the text is quoted, so that FTS5 operators
+    and column names in it are searched for like any other word, and all words must occur in a message. Words ending
+    with "*" match any word starting with them.
+    :param receiver_id: the id of the user whose messages are searched
+    :param text: the words to search for
+    :return: the query for the MATCH operator, or None if the text has no words
+    """
+    phrases = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            phrases.append(u'"%s"%s' % (word.replace('"', '""'), " *" if prefix else ""))
+    if not phrases:
+        return None
+    return u'receiver_id : "%d" AND message : (%s)' % (receiver_id, " ".join(phrases))
+
+
+def query_search_results(user, text):
+    """
+    Returns a query for the messages received by a user that match a full-text search, the most relevant first, as
+    ranked by FTS5's bm25 function, including the archived messages, see with_archive(). Only the index entries of the
+    user's mailbox are looked at.
+    :param user: a CachedUser representing the recipient of the messages
+    :param text: the words to search for, see search_expression()
+    :return: a query as returned by query_messages(), with an extra "relevance" column, or None if the text has no
+    words
+    """
+    expression = search_expression(user.id, text)
+    if expression is None:
+        return None
+    index = literal_column(search_index.name)
+    # The receiver_id column only restricts the search to the mailbox, and has no weight in the ranking
+    rank = func.bm25(index, literal_column("1.0"), literal_column("0.0"))
+
+    def query_for(model):
+        # The rank is selected, since a UNION can only be ordered by its columns
+        return query_messages(user, model).add_columns(rank.label("relevance")) \
+            .join(search_index, search_index.c.rowid == model.id) \
+            .filter(index.op("MATCH")(expression), model.receiver_id == user.id)
+
+    return with_archive(user, query_for).order_by(literal_column("relevance"), Message.id.desc())
+
+
+def fetch_page(query, limit=None):
+    """
+    Runs a message query, optionally limited to one page of messages.
+    :param query: the query, ordered as by query_user_messages()
+    :param limit: the maximum number of messages to fetch, or None to fetch all of them
+    :return: a tuple of the list of messages and whether there are more messages after them
+    """
+    if limit is None:
+        messages = query.all()
+        count_rows(len(messages))
+        return messages, False
+
+    # Fetch one extra message to find out whether there is another page
+    messages = query.limit(limit + 1).all()
+    count_rows(len(messages))
+    return messages[:limit], len(messages) > limit
+
+
+def query_archivable(user, cutoff):
+    """
+    Returns a query for the ids of the messages of a user that are due to be archived: those from before a cutoff that
+    the user has fetched, so that new messages are always in the messages table.
+    :param user: a CachedUser representing the recipient of the messages
+    :param cutoff: the messages older than this are archived
+    :return: a query of the primary database or the user's shard
+    """
+    session = messages_db(user, write=True)
+    user_id, version, last_read_id, unread_count = mailbox_columns(user.shard if shard_sessions else None)
+    mark = session.query(last_read_id).filter(user_id == user.id).as_scalar()
+    return session.query(Message.id).filter(Message.receiver_id == user.id, Message.timestamp < cutoff,
+                                            Message.id <= mark)
+
+
+def archive_mailbox(user, cutoff, batch_size):
+    """
+    Moves a batch of a user's messages from before a cutoff to the archive, in one transaction, see
+    query_archivable(). The user must already be flagged as archived. The mailbox version is changed, but date ranges
+    return the same messages as before, so the range version and the range cache are left alone.
+    :param user: a CachedUser representing the recipient of the messages
+    :param cutoff: the messages older than this are archived
+    :param batch_size: the maximum number of messages to archive
+    :return: the number of messages archived
+    """
+    shard = user.shard if shard_sessions else None
+    session = messages_db(user, write=True)
+    query = query_archivable(user, cutoff)
+    try:
+        found = query.first() is not None
+        session.rollback()
+        if not found:
+            return 0
+        # Writing first takes the write lock, so the batch can't change before it is moved. Nothing is found on a
+        # shard that the mailbox has been moved away from.
+        if not bump_mailbox_versions([user.id], session, shard):
+            session.rollback()
+            return 0
+        ids = [msg_id for msg_id, in query.limit(batch_size)]
+        columns = [column.name for column in ArchivedMessage.__table__.columns]
+        for chunk in chunks(ids):
+            session.execute(ArchivedMessage.__table__.insert().from_select(
+                columns, select([Message.__table__.c[name] for name in columns]).where(Message.id.in_(chunk))))
+            session.query(Message).filter(Message.id.in_(chunk)).delete(synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return len(ids)
+
+
+def query_due_users(shard, now, default_days):
+    """
+    Finds the users whose mailboxes on a shard have messages that are due to be archived, see query_archivable(), with
+    one query. SQLite computes the cutoff of each user from its retention policy.
+    :param shard: the number of the shard, or None without DATABASE_SHARDS
+    :param now: the current time, used to compute the cutoffs
+    :param default_days: the RETENTION_DAYS setting
+    :return: a list of tuples of a CachedUser and the cutoff of the user
+    """
+    session = shard_sessions[shard] if shard else db_session
+    last_read_id = mailbox_columns(shard)[2]
+    days = User.retention_days if default_days is None else func.coalesce(User.retention_days, default_days)
+    # In the format that SQLAlchemy stores the timestamps in, which compares as text
+    cutoff = func.strftime("%Y-%m-%d %H:%M:%f", now.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S.%f"),
+                           func.printf("-%d days", days))
+    query = session.query(User.id, User.username, User.shard, User.archived, User.retention_days) \
+        .filter(days.isnot(None), exists().where(and_(Message.receiver_id == User.id, Message.timestamp < cutoff,
+                                                      Message.id <= last_read_id)))
+    if shard:
+        query = query.join(Mailbox, Mailbox.receiver_id == User.id)
+    if shard is not None:
+        query = query.filter(User.shard == shard)
+    try:
+        return [(CachedUser(user_id, username, user_shard, user_archived),
+                 now - timedelta(days=user_days if user_days is not None else default_days))
+                for user_id, username, user_shard, user_archived, user_days in query.order_by(User.id)]
+    finally:
+        session.rollback()
+
+
+def archive_old_messages(now=None):
+    """
+    Applies the retention policies: moves the messages that are older than the retention_days of their receiver, or
+    the RETENTION_DAYS setting for users without a policy of their own, to the archive. Each mailbox is archived in
+    batches of ARCHIVE_BATCH_SIZE messages, each in its own short transaction, and afterwards the freed pages of the
+    databases are returned to the file system by an incremental vacuum.
+    Before the first messages of a user are archived, the user is flagged as archived, and the job waits for the user
+    caches of all worker processes to drop the user, so that no request misses the archived messages. The users with
+    messages to archive are found with one query per shard, see query_due_users().
+    :param now: the current time, used to compute the cutoffs
+    :return: the number of messages archived
+    """
+    now = now or datetime.now(pytz.utc)
+    default_days = app.config.get("RETENTION_DAYS")
+    batch_size = app.config.get("ARCHIVE_BATCH_SIZE", 1000)
+    due = []
+    for shard in range(len(shard_sessions)) if shard_sessions else [None]:
+        due.extend(query_due_users(shard, now, default_days))
+
+    flagged = [user for user, cutoff in due if not user.archived]
+    if flagged:
+        for chunk in chunks([user.id for user in flagged]):
+            db_session.query(User).filter(User.id.in_(chunk)).update({User.archived: True}, synchronize_session=False)
+        db_session.commit()
+        for user in flagged:
+            user_cache.invalidate(user.username)
+        time.sleep(user_cache.check_interval + ARCHIVE_FLAG_DELAY)
+    db_session.remove()
+
+    archived = 0
+    for user, cutoff in due:
+        while True:
+            count = archive_mailbox(user, cutoff, batch_size)
+            archived += count
+            if count < batch_size:
+                break
+
+    if archived:
+        for session in shard_sessions or [db_session]:
+            incremental_vacuum(session.get_bind())
+    app.logger.info(u"Archived %d messages" % archived)
+    return archived
+
+
+def run_archive_job():
+    """Runs archive_old_messages() in the background ARCHIVE_INTERVAL_SECONDS job, logging its errors."""
+    try:
+        archive_old_messages()
+    except Exception:
+        app.logger.exception("Archiving messages failed")
+    finally:
+        remove_db_session()
+
+
+def count_rows(count):
+    """Counts rows read from the database towards the metrics of the current request."""
+    if request_metrics is not None:
+        request_metrics.add_rows(count)
+
+
+def mark_delivered(user, last_message):
+    """
+    Marks new messages as seen after they have been delivered, by advancing the user's last_read_id high-water mark to
+    the last delivered message. This is a single conditional UPDATE, so the mark never moves backwards, even if
+    concurrent requests deliver overlapping messages. The messages that the mark passes are subtracted from the unread
+    count, which only counts the index entries between the old and the new mark.
+    :param user: a CachedUser representing the recipient of the messages
+    :param last_message: the last delivered message row
+    """
+    session = messages_db(user, write=True)
+    user_id, version, last_read_id, unread_count = mailbox_columns(user.shard if shard_sessions else None)
+    passed = select([func.count()]).where(and_(Message.receiver_id == user.id, Message.id > last_read_id,
+                                               Message.id <= last_message.id)).as_scalar()
+    session.query(user_id.class_).filter(user_id == user.id, last_read_id < last_message.id) \
+        .update({last_read_id: last_message.id, unread_count: unread_count - passed}, synchronize_session=False)
+    session.commit()
+
+
 def dictify_message(message):
     """
-    Returns a Python dict representation of a Message object from the database.
+    Returns a Python dict representation of a message row from the database.
     Note that the timestamp time zone information is not preserved in this naive implementation.
-    :param message: the Message object to be converted
+    :param message: the row to be converted, as returned by query_messages()
     :return: a dict representing the message, with the keys "id", "sender", "message" and "timestamp"
     """
     return {
         "id": message.id,
-        "sender": message.sender.username,
+        "sender": message.sender,
         "message": message.message,
-        "timestamp": message.timestamp.strftime("%Y-%m-%d %H:%M:%S")}
+        "timestamp": format_timestamp(message.timestamp)}
+
+
+def pretty_json():
+    """
+    :return: whether Flask-RESTful is configured to format JSON for humans, i.e. in debug mode or with RESTFUL_JSON
+    settings, in which case responses can't be built from pre-serialized messages
+    """
+    return app.debug or bool(app.config.get("RESTFUL_JSON"))
+
+
+def message_response(message, headers=None):
+    """
+    :param message: a message row, as returned by query_messages()
+    :param headers: a dict of extra response headers
+    :return: the response for a single message, with the same body as Flask-RESTful would produce for
+    dictify_message(message)
+    """
+    if pretty_json():
+        return dictify_message(message), 200, headers
+    return Response(message_serializer.encode(message) + "\n", mimetype="application/json", headers=headers)
+
+
+def message_list_response(messages, headers=None):
+    """
+    :param messages: a list of message rows, as returned by query_messages()
+    :param headers: a dict of extra response headers
+    :return: the response for a list of messages, with the same body as Flask-RESTful would produce for a list of
+    dictify_message() dicts
+    """
+    if pretty_json():
+        return [dictify_message(message) for message in messages], 200, headers
+    return Response(message_serializer.encode_list(messages), mimetype="application/json", headers=headers)
 
 
 def parse_datetime(arg):
     """
-    Parses a string containing a datetime value and returns a Python datetime object.
+    Parses a string containing a datetime value and returns a Python datetime object. Strings in the documented ISO
+    8601 format take a fast path, anything else is parsed by dateutil. Raises 400 Bad Request if the string can't be
+    parsed.
     :param arg: the string to be parsed
     :return: a datetime object
     """
     if not isinstance(arg, basestring):
         abort(400)
+    value = datetime_cache.get(arg)
+    if value is not None:
+        return value
     try:
-        return parser.parse(arg)
+        value = parse_iso8601(arg) or parser.parse(arg)
+        datetime_cache.put(arg, value)
+        return value
     # Possible exceptions:
     # http://dateutil.readthedocs.io/en/latest/parser.html#dateutil.parser.parse
     except ValueError:
@@ -111,6 +980,66 @@ def parse_datetime(arg):
     abort(400)
 
 
+def compared_timestamp(value):
+    """
+    The time zone of a datetime is dropped when it is bound to a query, so SQLite compares the timestamps of messages,
+    which are stored in UTC, with its wall-clock time.
+    :param value: a datetime from parse_datetime()
+    :return: the aware datetime in UTC that the timestamps of messages are compared with when the value is bound
+    """
+    return value.replace(tzinfo=pytz.utc)
+
+
+def parse_limit(arg):
+    """
+    Parses the "limit" GET parameter used for paging through message lists.
+    :param arg: the string to be parsed
+    :return: the limit as an integer, at most MESSAGE_LIST_MAX_LIMIT. Raises 400 Bad Request for invalid limits.
+    """
+    if not arg.isdigit() or int(arg) < 1:
+        app.logger.error("Invalid limit %r" % arg)
+        abort(400)
+    return min(int(arg), MESSAGE_LIST_MAX_LIMIT)
+
+
+def parse_wait(arg):
+    """
+    Parses the number of seconds that a request may wait for new messages.
+    :param arg: the string to be parsed
+    :return: the number of seconds as an integer, at most LONG_POLL_MAX_WAIT. Raises 400 Bad Request for invalid
+    values.
+    """
+    if not arg.isdigit():
+        app.logger.error("Invalid wait time %r" % arg)
+        abort(400)
+    return min(int(arg), LONG_POLL_MAX_WAIT)
+
+
+def encode_cursor(message):
+    """
+    Creates an opaque cursor pointing just past a message, for paging through lists ordered by timestamp and id.
+    :param message: the last message row of a page
+    :return: a URL safe string
+    """
+    key = "%s|%d" % (message.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), message.id)
+    return base64.urlsafe_b64encode(key).rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor(). Raises 400 Bad Request for invalid cursors.
+    :param cursor: the cursor string
+    :return: a tuple of the timestamp and the id of the message that the cursor points past
+    """
+    try:
+        key = base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4))
+        timestamp, msg_id = key.split("|")
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT).replace(tzinfo=pytz.utc), int(msg_id)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        app.logger.error("Invalid cursor %r" % cursor)
+        abort(400)
+
+
 # Used to validate POST data in MessageResource.post()
 msg_post_parser = reqparse.RequestParser()
 msg_post_parser.add_argument("receiver", type=unicode, required=True)
@@ -125,39 +1054,89 @@ class MessageResource(Resource):
     def get(self, username, msg_id):
         """
         Returns the message identified by msg_id, if the specified user is the message's recipient.
+        The response has an ETag, and if the request's If-None-Match header matches it, 304 Not Modified is returned
+        without looking up the message.
         """
         app.logger.debug(u"GET MessageResource %s" % request.path)
         user = get_user_or_error(username)
 
+        msg_id = parse_message_id(msg_id)
+        if msg_id is None:
+            abort(400)
+        etag = mailbox_etag(user, msg_id)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         message = get_user_message_by_id(user, msg_id)
 
-        return dictify_message(message)
+        return message_response(message, {"ETag": quote_etag(etag)})
 
     def post(self, username):
         """
         Stores a new message from the username specified in the URL to the user specified in the POST data.
         The POST data must contain the "receiver" and "message" fields.
+        If the request body is instead a JSON list of objects with "receiver" and "message" fields, all of the messages
+        are stored in one transaction, see post_batch().
         """
         app.logger.debug(u"POST MessageResource %s\nForm data:\n%s" % (request.path, request.form))
         user = get_user_or_error(username)
 
+        data = request.get_json(silent=True)
+        if isinstance(data, list):
+            return self.post_batch(user, data)
+
         args = msg_post_parser.parse_args()  # Raises 400 Bad Request if the POST data is invalid
 
         receiver_name = args["receiver"]
         receiver = get_user_or_error(receiver_name)
 
-        message = args["message"]
-        if len(message) > MESSAGE_MAXLEN:
-            app.logger.warning("Message length exceeds MESSAGE_MAXLEN (%d), truncating" % MESSAGE_MAXLEN)
-            # Not necessary with SQLite (https://sqlite.org/faq.html#q9) but it seems prudent nonetheless.
-            message = message[:MESSAGE_MAXLEN]
+        message = truncate_message(args["message"])
 
-        new_message = Message(sender=user, receiver=receiver, message=message, timestamp=datetime.now(tz=pytz.utc))
-        db_session.add(new_message)
-        db_session.commit()
+        store_messages([{"sender_id": user.id, "receiver_id": receiver.id, "message": message,
+                         "timestamp": datetime.now(tz=pytz.utc)}], {receiver.id: receiver})
 
         return "", 204  # 204 No Content
 
+    def post_batch(self, user, items):
+        """
+        Stores a batch of messages from the given user. All receivers are looked up in one query and all messages are
+        inserted and committed together.
+        :param user: a CachedUser representing the sender
+        :param items: a list of dicts with the "receiver" and "message" fields
+        :return: a JSON list with one object per item, in the same order, containing the receiver and a status code:
+        204 if the message was stored, 400 if the item was invalid or 404 if the receiver does not exist.
+        Returns 413 Request Entity Too Large if there are more than MESSAGE_BATCH_MAXLEN items.
+        """
+        if len(items) > MESSAGE_BATCH_MAXLEN:
+            app.logger.warning("Batch of %d messages exceeds MESSAGE_BATCH_MAXLEN (%d)" %
+                               (len(items), MESSAGE_BATCH_MAXLEN))
+            abort(413)
+
+        def valid(item):
+            return isinstance(item, dict) and isinstance(item.get("receiver"), basestring) and \
+                isinstance(item.get("message"), basestring)
+
+        receivers = get_users(item["receiver"] for item in items if valid(item))
+
+        now = datetime.now(tz=pytz.utc)
+        rows = []
+        results = []
+        for item in items:
+            if not valid(item):
+                results.append({"receiver": item.get("receiver") if isinstance(item, dict) else None, "status": 400})
+            elif item["receiver"] not in receivers:
+                results.append({"receiver": item["receiver"], "status": 404})
+            else:
+                rows.append({"sender_id": user.id, "receiver_id": receivers[item["receiver"]].id,
+                             "message": truncate_message(item["message"]), "timestamp": now})
+                results.append({"receiver": item["receiver"], "status": 204})
+
+        app.logger.debug(u"Storing %d of %d batched messages from %s" % (len(rows), len(items), user.username))
+        store_messages(rows, dict((receiver.id, receiver) for receiver in receivers.values()))
+
+        return results
+
     def delete(self, username, msg_id=None):
         """
         Deletes a user's message(s), if the messages exist and the user is the recipient of the messages.
@@ -166,6 +1145,10 @@ class MessageResource(Resource):
         To delete multiple messages, include a request body with JSON data, containing a single list called "ids":
         { "ids": [1, 2, 3, 5] }
         Returns 204 if at least one deletion succeeded, otherwise 400 Bad Request.
+        If the "report" GET parameter is present, the response instead has a JSON body listing the ids that were
+        deleted and the ids that were missing, like { "deleted": [1, 2], "missing": [3] }, with status 200 if at least
+        one deletion succeeded, otherwise 400.
+        All deletions happen in a single transaction.
         """
         app.logger.debug(u"DELETE MessageResource %s" % request.path)
 
@@ -179,17 +1162,11 @@ class MessageResource(Resource):
 
         user = get_user_or_error(username)
 
-        deletion_succeeeded = False
-        for msg_id in ids:
-            message = get_user_message_by_id(user, msg_id, fail_silently=True)
-            if message is None:
-                app.logger.warning("Attempted deletion of message %s failed for user %s" % (msg_id, user.username))
-            else:
-                app.logger.debug("Deleting message with id %s" % message.id)
-                db_session.delete(message)
-                db_session.commit()
-                deletion_succeeeded = True
-        if deletion_succeeeded:
+        if "report" in request.args:
+            deleted, missing = delete_user_messages(user, ids, report=True)
+            return {"deleted": deleted, "missing": missing}, 200 if deleted else 400
+
+        if delete_user_messages(user, ids) > 0:
             return "", 204  # 204 No Content
         else:
             return "", 400  # 400 Bad Request
@@ -202,64 +1179,405 @@ class MessageList(Resource):
 
     def get(self, username):
         """
-        If requested without GET parameters, a list of new messages is returned.
+        If requested without GET parameters, a list of new messages is returned, i.e. the messages with a higher id
+        than the user's last_read_id. The returned messages are then marked as seen.
         The requester may optionally use the "start" and "end" GET parameters to specify a date range. Any messages
-        that were received within this date range will then be returned. Dates must be specified in ISO 8601 format
-        (with time zone information) and URL encoded. An example request to retrieve messages for user "a" between the
-        dates 2016-10-08T10:23:29.0+00:00 and 2016-10-08T10:23:50.828699+00:00:
+        that were received within this date range will then be returned, without marking them as seen. Dates must be
+        specified in ISO 8601 format (with time zone information) and URL encoded. An example request to retrieve
+        messages for user "a" between the dates 2016-10-08T10:23:29.0+00:00 and 2016-10-08T10:23:50.828699+00:00:
         /a/messages/?start=2016-10-08T10%3A23%3A29.000000%2B00%3A00&end=2016-10-08T10%3A23%3A50.828699%2B00%3A00
         These date strings are horrible to construct by hand, so at /dates/ there's a handy helper.
+        Messages in a date range are returned in timestamp order, new messages in id order. To page through them, the
+        "limit" GET parameter sets the maximum number of messages to return. If there are more messages, the response
+        has an X-Next-Cursor header, and the next page is requested with the same parameters plus "cursor" set to that
+        value. Each page is a single index range scan, no matter how far into the list it is. Since only the returned
+        new messages are marked as seen, the next page of new messages can also be requested without a cursor.
+        Large lists can be streamed instead of being built in memory, see stream().
+        Responses for date ranges that have already ended have an ETag, and if the request's If-None-Match header
+        matches it, 304 Not Modified is returned without querying the messages. Their responses are also cached in
+        the range cache, from which deleting messages removes the ranges that contained them. Storing messages changes
+        neither, see range_etag().
+        When fetching new messages, the "wait" GET parameter turns the request into a long poll: if there are no new
+        messages, the request waits up to that many seconds for a message to arrive before returning.
         """
         app.logger.debug(u"GET MessageList %s" % request.path)
 
         user = get_user_or_error(username)
 
-        if "start" in request.args:
-            start = parse_datetime(request.args["start"])
-        else:
-            start = user.last_fetch
+        new_only = "start" not in request.args and "end" not in request.args
+        cursor = decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
 
-        if "end" in request.args:
-            end = parse_datetime(request.args["end"])
-            if "start" not in request.args:
-                # If only "end" is specified, get all messages up to that time, not just the new ones
-                start = BEGINNING_OF_TIME
+        if new_only:
+            after_id = get_last_read_id(user)
+            if cursor is not None:
+                after_id = max(after_id, cursor[1])
+            app.logger.debug(u"Retrieving messages after id %d" % after_id)
+            query = query_new_messages(user, after_id)
         else:
-            end = datetime.now(pytz.utc)
+            # If only "end" is specified, get all messages up to that time, not just the new ones
+            start = parse_datetime(request.args["start"]) if "start" in request.args else BEGINNING_OF_TIME
+            end = parse_datetime(request.args["end"]) if "end" in request.args else datetime.now(pytz.utc)
+            app.logger.debug(u"Retrieving messages between %s and %s" % (start, end))
+            app.logger.debug(u"Time span: %s" % (end - start))
+            query = query_user_messages(user, start, end, cursor)
+
+        stream_format = request.args.get("stream")
+        if stream_format is None and request.accept_mimetypes.best == NDJSON_MIMETYPE:
+            stream_format = "ndjson"
+        if stream_format is not None:
+            if stream_format not in ("json", "ndjson") or "limit" in request.args:
+                app.logger.error("Invalid stream format %r, or limit used with stream" % stream_format)
+                abort(400)
+            return self.stream(user, query, new_only, stream_format == "ndjson")
+
+        limit = parse_limit(request.args["limit"]) if "limit" in request.args else None
+
+        wait = None
+        if "wait" in request.args:
+            if not new_only:
+                app.logger.error("Long polling is only supported when fetching new messages")
+                abort(400)
+            wait = parse_wait(request.args["wait"])
+            # Taken before the query, so that a message stored between the query and the wait is not missed
+            token = notification_hub.token(user.id)
+
+        headers = {}
+        cache_key = cache_token = None
+        if not new_only and "end" in request.args and compared_timestamp(end) < datetime.now(pytz.utc):
+            etag = range_etag(user)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            headers["ETag"] = quote_etag(etag)
+
+            if range_cache is not None and not pretty_json():
+                start, end = compared_timestamp(start), compared_timestamp(end)
+                cache_key = range_cache_key(user.id, start, end, etag, limit, request.args.get("cursor"))
+                cached = range_cache.get(cache_key)
+                if cached is not None:
+                    body, next_cursor = cached
+                    if next_cursor is not None:
+                        headers["X-Next-Cursor"] = next_cursor
+                    return Response(body, mimetype="application/json", headers=headers)
+                # Taken before the query, so that messages deleted after the query can't end up in the cache
+                cache_token = range_cache.token(user.id)
 
-        app.logger.debug(u"Retrieving messages between %s and %s" % (start, end))
-        app.logger.debug(u"Time span: %s" % (end - start))
+        messages, has_more = fetch_page(query, limit)
 
-        messages = Message.query.filter_by(receiver=user).filter(Message.timestamp.between(start, end)).all()
+        if not messages and wait:
+            app.logger.debug(u"No new messages, waiting up to %d seconds" % wait)
+            release_sessions()  # Don't hold on to the connections while waiting
+            if notification_hub.wait(user.id, token, wait):
+                messages, has_more = fetch_page(query, limit)
 
         app.logger.debug(u"Query returned %d messages" % len(messages))
 
-        user.last_fetch = datetime.now(pytz.utc)
-        db_session.commit()
+        if new_only and messages:
+            mark_delivered(user, messages[-1])
+
+        if has_more:
+            headers["X-Next-Cursor"] = encode_cursor(messages[-1])
+
+        if cache_key is not None:
+            body = message_serializer.encode_list(messages)
+            range_cache.put(cache_token, cache_key, user.id, start, end, body, headers.get("X-Next-Cursor"))
+            return Response(body, mimetype="application/json", headers=headers)
+
+        return message_list_response(messages, headers)
+
+    def stream(self, user, query, new_only, ndjson):
+        """
+        Streams the messages of a query to the client as they are read from the database, so that memory use does not
+        depend on the number of messages. Requested with the "stream" GET parameter set to "json" for a JSON list, or
+        "ndjson" (or an Accept: application/x-ndjson header) for one JSON object per line. The body of a streamed JSON
+        list is identical to the body of a regular response. Streams cannot be combined with "limit".
+        :param user: a CachedUser representing the recipient of the messages
+        :param query: the message query, as built by get()
+        :param new_only: whether new messages are being fetched, which are marked as seen once they have been sent
+        :param ndjson: stream newline delimited JSON instead of a JSON list
+        :return: a streaming Response
+        """
+        def generate():
+            chunk = [] if ndjson else ["["]
+            last_message = None
+            rows = 0
+            for message in query.yield_per(STREAM_BATCH_SIZE):
+                rows += 1
+                encoded = message_serializer.encode(message)
+                if ndjson:
+                    chunk.append(encoded + "\n")
+                else:
+                    chunk.append(encoded if last_message is None else ", " + encoded)
+                last_message = message
+                if len(chunk) >= STREAM_BATCH_SIZE:
+                    yield "".join(chunk)
+                    chunk = []
+            if not ndjson:
+                chunk.append("]\n")
+            yield "".join(chunk)
+            count_rows(rows)
+
+            if new_only and last_message is not None:
+                mark_delivered(user, last_message)
+
+        mimetype = NDJSON_MIMETYPE if ndjson else "application/json"
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+class MessageEvents(Resource):
+    """
+    Streams new messages to a user as Server-Sent Events, as soon as they are stored.
+    """
+
+    def get(self, username):
+        """
+        Returns a text/event-stream response. Each new message is sent as an event with the message id as the event id
+        and the JSON representation of the message as the data. Delivered messages are marked as seen, just like when
+        fetching new messages from MessageList. The stream is closed after EVENT_STREAM_DURATION seconds, upon which
+        clients such as EventSource reconnect automatically.
+        """
+        app.logger.debug(u"GET MessageEvents %s" % request.path)
+
+        user = get_user_or_error(username)
+
+        def generate():
+            deadline = time.time() + EVENT_STREAM_DURATION
+            after_id = get_last_read_id(user)
+            while True:
+                token = notification_hub.token(user.id)
+                messages, has_more = fetch_page(query_new_messages(user, after_id), STREAM_BATCH_SIZE)
+                if messages:
+                    yield "".join("id: %d\ndata: %s\n\n" % (message.id, message_serializer.encode(message))
+                                  for message in messages)
+                    mark_delivered(user, messages[-1])
+                    after_id = messages[-1].id
+                    continue
+
+                release_sessions()  # Don't hold on to the connections while waiting
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                if not notification_hub.wait(user.id, token, min(remaining, EVENT_STREAM_KEEPALIVE)):
+                    yield ": keepalive\n\n"
+
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
 
-        return [dictify_message(message) for message in messages]
+class Conversation(Resource):
+    """
+    Responds to GET requests with the messages that two users have sent each other.
+    """
+
+    def get(self, username, other):
+        """
+        Returns the messages sent by either user to the other, in timestamp order, without marking them as seen. The
+        "sender" of each message tells its direction. Like MessageList, the conversation can be paged through with the
+        "limit" and "cursor" GET parameters and the X-Next-Cursor header.
+        The two directions are read from separate index ranges, which may be on different shards, and merged. Each
+        page reads at most limit + 1 messages of each direction, however large the mailboxes are.
+        """
+        app.logger.debug(u"GET Conversation %s" % request.path)
+
+        user = get_user_or_error(username)
+        other_user = get_user_or_error(other)
+        cursor = decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+        limit = parse_limit(request.args["limit"]) if "limit" in request.args else None
+
+        queries = [query_conversation(other_user, user, cursor)]
+        if other_user.id != user.id:
+            queries.append(query_conversation(user, other_user, cursor))
+        pages = [fetch_page(query, limit) for query in queries]
+        # heapq.merge has no key function in Python 2, so the messages are merged as (timestamp, id, message) tuples
+        merged = heapq.merge(*[[(message.timestamp, message.id, message) for message in messages]
+                               for messages, has_more in pages])
+        messages = [message for timestamp, msg_id, message in merged]
+        has_more = any(has_more for page, has_more in pages)
+        if limit is not None and len(messages) > limit:
+            messages, has_more = messages[:limit], True
+        app.logger.debug(u"Query returned %d messages" % len(messages))
+
+        headers = {}
+        if has_more:
+            headers["X-Next-Cursor"] = encode_cursor(messages[-1])
+        return message_list_response(messages, headers)
+
+
+class UnreadCount(Resource):
+    """
+    Tells how many new messages a user has, without fetching them or marking them as seen.
+    """
+
+    def get(self, username):
+        """
+        Returns the number of new messages, i.e. the messages that MessageList would return without GET parameters,
+        as { "unread": 3 }, and in the X-Unread-Count header. HEAD requests get just the header.
+        """
+        app.logger.debug(u"GET UnreadCount %s" % request.path)
+        user = get_user_or_error(username)
+        unread = get_unread_count(user)
+        return {"unread": unread}, 200, {"X-Unread-Count": str(unread)}
+
+
+class MessageSearch(Resource):
+    """
+    Full-text search of the messages received by a user.
+    """
+
+    def get(self, username):
+        """
+        Returns the messages received by a user that contain all words of the "q" GET parameter, e.g.
+        /a/search/?q=lunch+tomorrow, the most relevant first. A word ending with "*" matches all words starting with
+        it. Searching doesn't mark messages as seen.
+        At most "limit" messages are returned, SEARCH_DEFAULT_LIMIT by default. If there are more, the response has an
+        X-Next-Cursor header, and the next page is requested with the same parameters plus "cursor" set to that value.
+        Responds with 501 Not Implemented if SQLite lacks the FTS5 extension.
+        """
+        app.logger.debug(u"GET MessageSearch %s" % request.path)
+        if not search_enabled:
+            abort(501)
+
+        user = get_user_or_error(username)
+        query = query_search_results(user, request.args.get("q", u""))
+        if query is None:
+            app.logger.error("Search without words")
+            abort(400)
+
+        limit = parse_limit(request.args["limit"]) if "limit" in request.args else SEARCH_DEFAULT_LIMIT
+        # Relevance depends on all messages, so pages are counted off rather than continuing after a key
+        offset = request.args.get("cursor", "0")
+        if not offset.isdigit():
+            app.logger.error("Invalid cursor %r" % offset)
+            abort(400)
+
+        messages, has_more = fetch_page(query.offset(int(offset)), limit)
+        app.logger.debug(u"Search returned %d messages" % len(messages))
+
+        headers = {}
+        if has_more:
+            headers["X-Next-Cursor"] = str(int(offset) + limit)
+        return message_list_response(messages, headers)
 
 
 api.add_resource(MessageResource, u"/<username>/message/<msg_id>/", u"/<username>/message/")
 api.add_resource(MessageList, u"/<username>/messages/")
+api.add_resource(MessageEvents, u"/<username>/messages/events/")
+api.add_resource(UnreadCount, u"/<username>/unread/")
+api.add_resource(Conversation, u"/<username>/conversation/<other>/")
+api.add_resource(MessageSearch, u"/<username>/search/")
 
 
-def setup_db():
+def setup_db(populate=True, url=None, read_urls=None, shard_urls=None):
     """
     Sets up the database, connections, etc.
+    :param populate: fill an empty database with dummy data, unless testing
+    :param url: the URL of the primary database, which all writes go to. Defaults to the DATABASE setting.
+    :param read_urls: the URLs of databases for read-only queries, such as read replicas of the primary database or
+    read-only connections to it. Each request reads from one of them, chosen at random. Defaults to the
+    DATABASE_READ_URLS setting. Without read URLs, reads also go to the primary database.
+    :param shard_urls: the URLs of additional SQLite databases to store messages in, shards 1, 2 and so on, the primary
+    database being shard 0. Defaults to the DATABASE_SHARDS setting. The users table of the primary database tells
+    which shard each mailbox is on, see the rebalance command.
     :return: a database session object that can be used to access the database
     """
 
-    filename = app.config.get("DATABASE", "sqlite:////tmp/babbel.db")
-    engine = create_engine(filename, convert_unicode=True)
+    url = url or app.config.get("DATABASE", "sqlite:////tmp/babbel.db")
+    if read_urls is None:
+        read_urls = app.config.get("DATABASE_READ_URLS", [])
+    if shard_urls is None:
+        shard_urls = app.config.get("DATABASE_SHARDS", [])
+    engines = [create_db_engine(engine_url, app.config.get("DATABASE_PROFILE", "default"),
+                                pool_size=app.config.get("DATABASE_POOL_SIZE"),
+                                pragmas=app.config.get("DATABASE_PRAGMAS"))
+               for engine_url in [url] + list(read_urls) + list(shard_urls)]
+    engine = engines[0]
     global db_session
     db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
-    Base.metadata.create_all(bind=engine)
+    global read_session, recent_writers
+    if read_urls:
+        read_engines = engines[1:len(read_urls) + 1]
+        read_sessionmaker = sessionmaker(autocommit=False, autoflush=False)
+        read_session = scoped_session(lambda: read_sessionmaker(bind=random.choice(read_engines)))
+        recent_writers = RecentWriters(app.config.get("READ_YOUR_WRITES_DIR", "/tmp/babbel-writers"),
+                                       window=app.config.get("READ_YOUR_WRITES_SECONDS", 5))
+    else:
+        read_session = db_session
+        recent_writers = None
+
+    # Tables that already exist are left alone by create_tables, so older databases are brought up to date by
+    # migrate_db
+    fresh = create_tables(engine)
+    migrate_db(engine, fresh=fresh)
     Base.query = db_session.query_property()
 
+    global search_enabled
+    search_enabled = engine.has_table(search_index.name)
+
+    global shard_sessions
+    if shard_urls:
+        create_shard_tables([url] + list(shard_urls))
+        shard_sessions = [db_session]
+        for shard_engine in engines[len(read_urls) + 1:]:
+            attach_directory(shard_engine, url)
+            shard_sessions.append(scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)))
+    else:
+        shard_sessions = []
+
+    global notification_hub
+    notification_hub = NotificationHub(app.config.get("NOTIFY_DIR", "/tmp/babbel-notify"))
+
+    global user_cache
+    user_cache = LRUCache(app.config.get("USER_CACHE_SIZE", 10000), ttl=app.config.get("USER_CACHE_TTL", 300),
+                          invalidation_file=app.config.get("USER_CACHE_INVALIDATION_FILE", "/tmp/babbel-user-cache"))
+
+    global message_serializer
+    message_serializer = MessageSerializer(app.config.get("JSON_BACKEND", "json"),
+                                           cache_size=app.config.get("MESSAGE_JSON_CACHE_SIZE", 0))
+
+    global range_cache
+    range_cache_backend = app.config.get("RANGE_CACHE", "memory")
+    range_cache_size = app.config.get("RANGE_CACHE_SIZE", 16 * 1024 * 1024)
+    if range_cache_backend == "memory":
+        range_cache = MemoryRangeCache(range_cache_size, invalidation_file=app.config.get(
+            "RANGE_CACHE_INVALIDATION_FILE", "/tmp/babbel-range-cache"))
+    elif range_cache_backend == "sqlite":
+        range_cache = SQLiteRangeCache(app.config.get("RANGE_CACHE_PATH", "/tmp/babbel-range-cache.db"),
+                                       range_cache_size)
+    else:
+        range_cache = None
+
+    global request_metrics
+    if app.config.get("METRICS", True):
+        request_metrics = RequestMetrics(app.config.get("METRICS_DIR", "/tmp/babbel-metrics"),
+                                         slow_request_seconds=app.config.get("SLOW_REQUEST_SECONDS"))
+        for instrumented_engine in engines:
+            request_metrics.instrument(instrumented_engine)
+    else:
+        request_metrics = None
+
+    global group_commit_writers
+    for writer in group_commit_writers.values():
+        writer.close()
+    group_commit_writers = {}
+    if app.config.get("GROUP_COMMIT", False):
+        # Transactions can't span shards, so each shard has a writer of its own
+        for shard in range(len(shard_sessions)) if shard_sessions else [None]:
+            group_commit_writers[shard] = GroupCommitWriter(
+                partial(insert_messages, shard=shard), window=app.config.get("GROUP_COMMIT_WINDOW_MS", 2) / 1000.0,
+                max_batch=app.config.get("GROUP_COMMIT_MAX_BATCH", 1000), metrics=request_metrics)
+
+    global archive_job
+    if archive_job is not None:
+        archive_job.close()
+        archive_job = None
+    if app.config.get("ARCHIVE_INTERVAL_SECONDS"):
+        # Every worker process starts the job, and the one that holds the lock runs it
+        archive_job = PeriodicJob(run_archive_job, app.config["ARCHIVE_INTERVAL_SECONDS"], name="archive-job",
+                                  lock_file=app.config.get("ARCHIVE_LOCK_FILE", "/tmp/babbel-archive.lock"))
+
     testing = app.config.get("TESTING", False)
-    if not testing:
+    if populate and not testing:
         populate_db(db_session)
 
     return db_session
@@ -267,5 +1585,164 @@ def setup_db():
 
 app.before_first_request(setup_db)
 
+
+@app.cli.command("load")
+@click.option("--users", type=click.Path(exists=True, dir_okay=False), help="CSV or NDJSON file of users")
+@click.option("--messages", type=click.Path(exists=True, dir_okay=False), help="CSV or NDJSON file of messages")
+@click.option("--batch-size", default=10000, help="Number of rows to insert per transaction")
+@click.option("--rebuild-indexes", is_flag=True, help="Drop the message indexes during the load and rebuild them after")
+@click.option("--as-read", is_flag=True, help="Load the messages as read, e.g. historical messages")
+def load_command(users, messages, batch_size, rebuild_indexes, as_read):
+    """
+    Bulk loads users and messages into the database, see database.bulk_load. With DATABASE_SHARDS, the messages are
+    loaded into the shards of their receivers' mailboxes.
+    """
+    setup_db(populate=False)
+    counts = bulk_load(db_session.get_bind(), users, messages, batch_size=batch_size, rebuild_indexes=rebuild_indexes,
+                       shards=[session.get_bind() for session in shard_sessions] or None, as_read=as_read)
+    if counts["messages"] and range_cache is not None:
+        # Messages may have been loaded into date ranges that are cached
+        range_cache.clear()
+    click.echo("Loaded %(users)d users (%(skipped_users)d skipped) and %(messages)d messages "
+               "(%(skipped_messages)d skipped)" % counts)
+
+
+@app.cli.command("rebalance")
+@click.option("--user", "usernames", multiple=True, help="Move the mailbox of this user (can be repeated)")
+@click.option("--shard", type=int, help="The shard to move the mailboxes to")
+@click.option("--spread", is_flag=True, help="Move each mailbox to shard (user id modulo the number of shards)")
+def rebalance_command(usernames, shard, spread):
+    """
+    Moves mailboxes between the shards in DATABASE_SHARDS, see database.move_mailbox. Either moves the mailboxes of the
+    given users to --shard, or spreads all mailboxes evenly over the shards with --spread. The app can keep running.
+    Moves that were interrupted, e.g. by a crash, are finished first.
+    """
+    setup_db(populate=False)
+    urls = [db_session.get_bind().url] + [session.get_bind().url for session in shard_sessions[1:]]
+    if spread == (shard is not None) or (spread and usernames) or (shard is not None and not 0 <= shard < len(urls)):
+        raise click.UsageError("Use either --spread, or --shard with a shard number below %d and --user" % len(urls))
+
+    resumed = resume_mailbox_moves(urls)
+    for user_id, target, moved in resumed:
+        click.echo("Finished moving the mailbox of user %d to shard %d (%d messages)" % (user_id, target, moved))
+        user_cache.invalidate(User.query.get(user_id).username)
+
+    query = db_session.query(User.id, User.username, User.shard)
+    if not spread:
+        query = query.filter(User.username.in_(usernames))
+    moves = []
+    for user_id, username, current in query.order_by(User.id):
+        target = user_id % len(urls) if spread else shard
+        if target != current:
+            moves.append((user_id, username, target))
+    db_session.remove()
+
+    for user_id, username, target in moves:
+        moved = move_mailbox(urls, user_id, target)
+        if moved is not None:
+            click.echo("Moved %d messages of %s to shard %d" % (moved, username, target))
+        # Requests look the user up again instead of using the old shard
+        user_cache.invalidate(username)
+    if (moves or resumed) and range_cache is not None:
+        range_cache.clear()
+    click.echo("Moved %d mailboxes" % len(moves))
+
+
+@app.cli.command("reindex")
+def reindex_command():
+    """
+    Rebuilds the full-text index of the messages on every shard, see database.rebuild_search_index. Needed once after
+    upgrading a database that has messages from before the index, which are not found by searches until then.
+    Messages can't be stored while a shard is being reindexed.
+    """
+    setup_db(populate=False)
+    if not search_enabled:
+        raise click.ClickException("SQLite was compiled without FTS5, messages can't be searched")
+    for shard, session in enumerate(shard_sessions or [db_session]):
+        with session.get_bind().begin() as connection:
+            rebuild_search_index(connection)
+        click.echo("Reindexed the messages of shard %d" % shard)
+
+
+@app.cli.command("archive")
+def archive_command():
+    """
+    Moves the messages that are older than the retention policies allow to the archive, see archive_old_messages. Can
+    be run by cron instead of the ARCHIVE_INTERVAL_SECONDS background job. The app can keep running.
+    """
+    setup_db(populate=False)
+    click.echo("Archived %d messages" % archive_old_messages())
+
+
+@app.cli.command("retention")
+@click.argument("username")
+@click.argument("days", type=click.IntRange(min=0), required=False)
+def retention_command(username, days):
+    """
+    Sets the retention policy of a user: the number of days after which the messages they have fetched are archived.
+    Without DAYS, the user gets the RETENTION_DAYS setting again.
+    """
+    setup_db(populate=False)
+    updated = db_session.query(User).filter(User.username == username) \
+        .update({User.retention_days: days}, synchronize_session=False)
+    if not updated:
+        raise click.ClickException("User %s does not exist" % username)
+    db_session.commit()
+    click.echo("Messages of %s are archived after %s" % (username, "%d days" % days if days is not None else
+                                                          "RETENTION_DAYS (%s)" % app.config.get("RETENTION_DAYS")))
+
+
+def endpoint_name():
+    """
+    :return: the name of the endpoint of the current request for metrics, e.g. MessageList.get or views.index
+    """
+    view_class = getattr(app.view_functions.get(request.endpoint), "view_class", None)
+    if view_class is not None:
+        return "%s.%s" % (view_class.__name__, request.method.lower())
+    return request.endpoint or "unmatched"
+
+
+@app.before_request
+def start_request_metrics():
+    if request_metrics is not None:
+        request_metrics.start()
+
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    """
+    Records the metrics of each request. Streamed responses are recorded once the stream has ended. Requests that take
+    longer than SLOW_REQUEST_SECONDS are logged with their SQL statements.
+    """
+    if request_metrics is None:
+        return
+    slow_request = request_metrics.finish(endpoint_name())
+    if slow_request is not None:
+        seconds, statements = slow_request
+        app.logger.warning(u"Slow request %s %s took %.3f s, %d SQL statements:\n%s" % (
+            request.method, request.full_path, seconds, len(statements),
+            "\n".join(u"%.3f s: %s %r" % statement for statement in statements)))
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Serves the request metrics of all worker processes in the Prometheus text format."""
+    if request_metrics is None:
+        abort(404)
+    request_metrics.flush(force=True)
+    return Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    """Closes the sessions of the current thread after each request, returning their connections."""
+    if db_session is not None:
+        db_session.remove()
+    if read_session is not None and read_session is not db_session:
+        read_session.remove()
+    for session in shard_sessions[1:]:
+        session.remove()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,15 +1,36 @@
+import logging
 import os
+import re
+import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+from collections import namedtuple
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta
+from json import dumps
 from urllib import quote_plus
 
 import pytz
+from click.testing import CliRunner
+from dateutil import parser
 from flask import json
+from flask.cli import ScriptInfo
+from sqlalchemy import create_engine, event, inspect
 
 import babbel
 from babbel import setup_db
-from models import User
+from database import SCHEMA_VERSION, SEARCH_INDEX_TRIGGERS, SHARD_ID_STRIDE, bulk_load, create_db_engine, \
+    get_schema_version, move_mailbox, resume_mailbox_moves
+from group_commit import GroupCommitWriter, Submission
+from jobs import PeriodicJob
+from models import MESSAGE_MAXLEN, User, Message
+from cache import RANGE_CACHE_ENTRY_OVERHEAD, LRUCache, MemoryRangeCache
+from notify import WAKEUP_FILE_MAXSIZE, WRITES_LOG_MAXSIZE, NotificationHub, RecentWriters
+from serialize import MessageSerializer
+from timestamps import parse_iso8601
 
 
 class BabbelTestCase(unittest.TestCase):
@@ -17,6 +38,7 @@ class BabbelTestCase(unittest.TestCase):
         self.db_fd, self.filename = tempfile.mkstemp()
         babbel.app.config["TESTING"] = True
         babbel.app.config["DATABASE"] = "sqlite:///%s" % self.filename
+        babbel.app.config["METRICS_DIR"] = None
         # babbel.app.config["DEBUG"] = True
         babbel.app.logger.debug("Setting up temporary DB at %s" % self.filename)
 
@@ -33,6 +55,24 @@ class BabbelTestCase(unittest.TestCase):
             self.db_session.add(u)
             self.db_session.commit()
 
+    @contextmanager
+    def count_queries(self):
+        """
+        Counts the SQL statements executed within the with block. Yields a list that the statements are appended to.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        # The first request of the app runs setup_db() again, so the engine is looked up now, not in setUp()
+        engine = babbel.db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
     def test_empty_db_404_errors(self):
         rv = self.app.get("/name/", follow_redirects=True)
         assert rv.status_code == 404
@@ -57,6 +97,48 @@ class BabbelTestCase(unittest.TestCase):
         rv = self.app.get("/x/", follow_redirects=True)
         assert rv.status_code == 200
 
+    def test_pages_of_user_page_and_db(self):
+        for username in ["x", "y", "z"]:
+            self.create_user(username)
+        for i in range(5):
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test %d!" % i})
+
+        # The user page is streamed a page at a time, with the totals counted
+        rv = self.app.get("/y/?limit=2", follow_redirects=True)
+        assert rv.status_code == 200
+        assert rv.is_streamed
+        assert "(5 messages, 5 unread)" in rv.data
+        assert "Test 0!" in rv.data and "Test 1!" in rv.data and "Test 2!" not in rv.data
+        seen = 2
+        while "More messages" in rv.data:
+            cursor = re.search(r'href="\?cursor=([^&]+)&amp;limit=2"', rv.data).group(1)
+            rv = self.app.get("/y/?limit=2&cursor=%s" % cursor, follow_redirects=True)
+            assert "Test %d!" % seen in rv.data
+            seen += rv.data.count("Message from x")
+        assert seen == 5
+
+        rv = self.app.get("/db/?limit=2", follow_redirects=True)
+        assert rv.status_code == 200
+        assert "Users (3 total)" in rv.data
+        assert "Messages (5 total, 0 archived)" in rv.data
+        assert "Message from x to y: Test 1!" in rv.data and "Test 2!" not in rv.data
+        assert 'href="?users_after=2&amp;messages_after=0&amp;limit=2"' in rv.data
+
+        # Paging through one list keeps the page of the other
+        rv = self.app.get("/db/?limit=2&messages_after=2", follow_redirects=True)
+        assert 'href="?users_after=0&amp;messages_after=4&amp;limit=2"' in rv.data
+        link = re.search(r'href="(\?[^"]+)">More users', rv.data).group(1).replace("&amp;", "&")
+        rv = self.app.get("/db/" + link, follow_redirects=True)
+        assert "User 3: z" in rv.data and "User 1: x" not in rv.data
+        assert "Test 2!" in rv.data and "Test 1!" not in rv.data
+
+        rv = self.app.get("/db/?limit=2&messages_after=4", follow_redirects=True)
+        assert "Test 4!" in rv.data and "Test 3!" not in rv.data
+        assert "More messages" not in rv.data
+
+        rv = self.app.get("/db/?users_after=x", follow_redirects=True)
+        assert rv.status_code == 400
+
     def test_single_user_message_self(self):
         self.create_user("x")
         rv = self.app.post("/x/message/", data={"receiver": "x", "message": "Test!"}, follow_redirects=True)
@@ -404,6 +486,1231 @@ class BabbelTestCase(unittest.TestCase):
         assert rv.status_code == 200
         assert "Test 3!" in rv.data
 
+    def test_migrate_db_adds_message_indexes(self):
+        # Simulate a database created before the indexes existed
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("DROP INDEX ix_messages_receiver_timestamp")
+        engine.execute("DROP INDEX ix_messages_receiver_id")
+        engine.execute("DROP INDEX ix_messages_sender_receiver_timestamp")
+        engine.execute("PRAGMA user_version = 0")
+
+        setup_db()
+
+        indexes = set(index["name"] for index in inspect(engine).get_indexes("messages"))
+        assert "ix_messages_receiver_timestamp" in indexes
+        assert "ix_messages_receiver_id" in indexes
+        assert "ix_messages_sender_receiver_timestamp" in indexes
+        assert get_schema_version(engine) == SCHEMA_VERSION
+
+    def test_message_list_query_count_is_constant(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.create_user("z")
+
+        now = datetime.now(pytz.utc)
+        parameters = "?start=%s&end=%s" % (quote_plus((now + timedelta(minutes=-5)).isoformat()),
+                                           quote_plus((now + timedelta(minutes=5)).isoformat()))
+
+        self.app.post("/x/message/", data={"receiver": "z", "message": "Test 0!"}, follow_redirects=True)
+        with self.count_queries() as statements:
+            rv = self.app.get("/z/messages/%s" % parameters, follow_redirects=True)
+        assert len(json.loads(rv.data)) == 1
+        single_count = len(statements)
+
+        for i in range(1, 10):
+            sender = "x" if i % 2 else "y"
+            self.app.post("/%s/message/" % sender, data={"receiver": "z", "message": "Test %d!" % i},
+                          follow_redirects=True)
+        with self.count_queries() as statements:
+            rv = self.app.get("/z/messages/%s" % parameters, follow_redirects=True)
+        messages = json.loads(rv.data)
+        assert len(messages) == 10
+        assert set(message["sender"] for message in messages) == {"x", "y"}
+        assert len(statements) == single_count
+
+        # z is in the user cache by now, so only a page of messages and the counts are queried. The page is streamed,
+        # so it is read before the block ends.
+        with self.count_queries() as statements:
+            rv = self.app.get("/z/", follow_redirects=True)
+            data = rv.data
+        assert rv.status_code == 200
+        assert "Test 9!" in data
+        assert len([statement for statement in statements if statement.startswith("SELECT")]) == 3
+
+    def test_delete_multiple_messages_report(self):
+        self.create_user("x")
+        self.create_user("y")
+        for i in range(1, 6):
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test %d!" % i}, follow_redirects=True)
+        # Message 6 belongs to x, so y cannot delete it
+        self.app.post("/y/message/", data={"receiver": "x", "message": "Test 6!"}, follow_redirects=True)
+
+        chunk_size = babbel.IN_CHUNK_SIZE
+        babbel.IN_CHUNK_SIZE = 2
+        try:
+            with self.count_queries() as statements:
+                rv = self.app.delete("/y/message/1/?report", data=json.dumps({"ids": [2, 3, 4, 6, 7, "a"]}),
+                                     follow_redirects=True, headers={"Content-Type": "application/json"})
+        finally:
+            babbel.IN_CHUNK_SIZE = chunk_size
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == {"deleted": [1, 2, 3, 4], "missing": [6, 7, "a"]}
+        # 6 valid ids in chunks of 2
+        assert len([statement for statement in statements if statement.startswith("DELETE")]) == 3
+
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        messages = json.loads(rv.data)
+        assert [message["message"] for message in messages] == ["Test 5!"]
+
+        rv = self.app.get("/x/messages/", follow_redirects=True)
+        assert "Test 6!" in rv.data
+
+        rv = self.app.delete("/y/message/1/?report", follow_redirects=True)
+        assert rv.status_code == 400
+        assert json.loads(rv.data) == {"deleted": [], "missing": [1]}
+
+    def test_batch_send(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.create_user("z")
+        items = [{"receiver": "y", "message": "Test 1!"},
+                 {"receiver": "nobody", "message": "Test 2!"},
+                 {"receiver": "z", "message": "Test 3!"},
+                 {"receiver": "y"},
+                 {"receiver": "y", "message": "Test 4!"}]
+
+        with self.count_queries() as statements:
+            rv = self.app.post("/x/message/", data=json.dumps(items), follow_redirects=True,
+                               headers={"Content-Type": "application/json"})
+        assert rv.status_code == 200
+        assert [result["status"] for result in json.loads(rv.data)] == [204, 404, 204, 400, 204]
+        assert len([statement for statement in statements if statement.startswith("INSERT")]) == 1
+
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 1!", "Test 4!"]
+        rv = self.app.get("/z/messages/", follow_redirects=True)
+        assert [message["sender"] for message in json.loads(rv.data)] == ["x"]
+
+        rv = self.app.post("/nobody/message/", data=json.dumps(items), follow_redirects=True,
+                           headers={"Content-Type": "application/json"})
+        assert rv.status_code == 404
+
+    def test_message_list_pagination(self):
+        self.create_user("x")
+        self.create_user("y")
+        items = [{"receiver": "y", "message": "Test %d!" % i} for i in range(7)]
+        # All messages in a batch share the same timestamp, so the pages are ordered by id within it
+        self.app.post("/x/message/", data=json.dumps(items[:4]), headers={"Content-Type": "application/json"})
+        self.app.post("/x/message/", data=json.dumps(items[4:]), headers={"Content-Type": "application/json"})
+
+        # Fetching new messages page by page only marks the delivered messages as seen
+        received = []
+        rv = self.app.get("/y/messages/?limit=3", follow_redirects=True)
+        received.extend(message["message"] for message in json.loads(rv.data))
+        while "X-Next-Cursor" in rv.headers:
+            rv = self.app.get("/y/messages/?limit=3&cursor=%s" % rv.headers["X-Next-Cursor"], follow_redirects=True)
+            received.extend(message["message"] for message in json.loads(rv.data))
+        assert received == [item["message"] for item in items]
+        rv = self.app.get("/y/messages/?limit=3", follow_redirects=True)
+        assert json.loads(rv.data) == []
+
+        # Page through a date range
+        now = datetime.now(pytz.utc)
+        parameters = "?start=%s&end=%s&limit=3" % (quote_plus((now + timedelta(minutes=-5)).isoformat()),
+                                                   quote_plus((now + timedelta(minutes=5)).isoformat()))
+        received = []
+        rv = self.app.get("/y/messages/%s" % parameters, follow_redirects=True)
+        while True:
+            assert rv.status_code == 200
+            page = json.loads(rv.data)
+            assert len(page) <= 3
+            received.extend(message["message"] for message in page)
+            if "X-Next-Cursor" not in rv.headers:
+                break
+            rv = self.app.get("/y/messages/%s&cursor=%s" % (parameters, rv.headers["X-Next-Cursor"]),
+                              follow_redirects=True)
+        assert received == [item["message"] for item in items]
+
+        rv = self.app.get("/y/messages/?limit=0", follow_redirects=True)
+        assert rv.status_code == 400
+        rv = self.app.get("/y/messages/?cursor=bogus", follow_redirects=True)
+        assert rv.status_code == 400
+
+    def test_message_list_streaming(self):
+        self.create_user("x")
+        self.create_user("y")
+        items = [{"receiver": "y", "message": "Test %d!" % i} for i in range(5)]
+        self.app.post("/x/message/", data=json.dumps(items), headers={"Content-Type": "application/json"})
+
+        batch_size = babbel.STREAM_BATCH_SIZE
+        babbel.STREAM_BATCH_SIZE = 2
+        try:
+            # Streaming new messages marks them as seen
+            rv = self.app.get("/y/messages/?stream=ndjson", follow_redirects=True)
+            assert len(rv.data.splitlines()) == 5
+            rv = self.app.get("/y/messages/?stream=json", follow_redirects=True)
+            assert rv.data == "[]\n"
+
+            now = datetime.now(pytz.utc)
+            parameters = "?start=%s&end=%s" % (quote_plus((now + timedelta(minutes=-5)).isoformat()),
+                                               quote_plus((now + timedelta(minutes=5)).isoformat()))
+            expected = self.app.get("/y/messages/%s" % parameters, follow_redirects=True).data
+
+            rv = self.app.get("/y/messages/%s&stream=json" % parameters, follow_redirects=True)
+            assert rv.status_code == 200
+            assert rv.data == expected
+
+            rv = self.app.get("/y/messages/%s" % parameters, follow_redirects=True,
+                              headers={"Accept": "application/x-ndjson"})
+            assert rv.status_code == 200
+            assert rv.mimetype == "application/x-ndjson"
+            assert [json.loads(line) for line in rv.data.splitlines()] == json.loads(expected)
+
+        finally:
+            babbel.STREAM_BATCH_SIZE = batch_size
+
+        rv = self.app.get("/y/messages/?stream=xml", follow_redirects=True)
+        assert rv.status_code == 400
+
+    def test_long_poll_returns_new_message(self):
+        self.create_user("x")
+        self.create_user("y")
+
+        def send():
+            time.sleep(0.2)
+            babbel.app.test_client().post("/x/message/", data={"receiver": "y", "message": "Test!"})
+        sender = threading.Thread(target=send)
+        sender.start()
+        started = time.time()
+        rv = self.app.get("/y/messages/?wait=10", follow_redirects=True)
+        sender.join()
+        assert rv.status_code == 200
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test!"]
+        assert time.time() - started < 5
+
+        # Times out when nothing arrives
+        rv = self.app.get("/y/messages/?wait=1", follow_redirects=True)
+        assert json.loads(rv.data) == []
+
+        rv = self.app.get("/y/messages/?start=2016-10-08T16%3A17%3A25.735955%2B00%3A00&wait=1", follow_redirects=True)
+        assert rv.status_code == 400
+
+    def test_event_stream(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"})
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"})
+
+        duration, keepalive = babbel.EVENT_STREAM_DURATION, babbel.EVENT_STREAM_KEEPALIVE
+        babbel.EVENT_STREAM_DURATION, babbel.EVENT_STREAM_KEEPALIVE = 1, 0.3
+        try:
+            rv = self.app.get("/y/messages/events/", follow_redirects=True)
+            assert rv.status_code == 200
+            assert rv.mimetype == "text/event-stream"
+            events = [event for event in rv.data.split("\n\n") if event.startswith("id:")]
+            assert [json.loads(event.split("data: ")[1])["message"] for event in events] == ["Test 1!", "Test 2!"]
+            assert ": keepalive" in rv.data
+        finally:
+            babbel.EVENT_STREAM_DURATION, babbel.EVENT_STREAM_KEEPALIVE = duration, keepalive
+
+        # The streamed messages have been marked as seen
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert json.loads(rv.data) == []
+
+    def test_notification_hub_across_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Two hubs sharing a directory behave like the hubs of two worker processes
+            waiting, storing = NotificationHub(directory, poll_interval=0.05), NotificationHub(directory)
+            token = waiting.token(1)
+            assert not waiting.wait(1, token, 0.1)
+            storing.notify([2, 3])
+            assert not waiting.wait(1, token, 0.1)
+            storing.notify([2, 1])
+            assert waiting.wait(1, token, 1)
+            # A single wakeup file, however many receivers there are
+            assert os.listdir(directory) == ["wakeup"]
+
+            # The wakeup file is replaced when it gets too large, which wakes up the threads waiting on the old one
+            token = waiting.token(1)
+            with open(os.path.join(directory, "wakeup"), "a") as f:
+                f.write("2\n" * (WAKEUP_FILE_MAXSIZE // 2))
+            assert not waiting.wait(1, token, 0.1)
+            storing.notify([2])
+            assert waiting.wait(1, token, 1)
+            assert os.path.getsize(os.path.join(directory, "wakeup")) == 2
+        finally:
+            shutil.rmtree(directory)
+
+        # Within a process, notifications are remembered in a bounded log
+        hub = NotificationHub(size=2)
+        token = hub.token(1)
+        hub.notify([2, 3])
+        assert not hub.wait(1, token, 0.01)
+        hub.notify([4])
+        assert hub.wait(1, token, 0.01)
+        assert len(hub.recent) == 2
+
+    def test_recent_writers_across_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Two instances sharing a directory behave like those of two worker processes
+            writing, reading = RecentWriters(directory, window=0.2), RecentWriters(directory, window=0.2)
+            writing.record(1)
+            assert reading.recent(1) and not reading.recent(2)
+            assert os.listdir(directory) == ["writes"]
+
+            # The log file is replaced when it gets too large, after the other processes have read it
+            with open(os.path.join(directory, "writes"), "a") as f:
+                f.write("3 0.0\n" * (WRITES_LOG_MAXSIZE // 6))
+            writing.record(2)
+            writing.record(4)
+            assert os.path.getsize(os.path.join(directory, "writes")) < 100
+            assert reading.recent(2) and reading.recent(4) and not reading.recent(3)
+
+            # Writes are forgotten once the window has passed
+            time.sleep(0.25)
+            assert not reading.recent(1)
+            assert not reading.writes and not reading.log
+        finally:
+            shutil.rmtree(directory)
+
+    def test_migrate_db_sets_last_read_id_from_last_fetch(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"})
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"})
+        self.app.post("/y/message/", data={"receiver": "x", "message": "Test 3!"})
+
+        # Simulate a database from before last_read_id, where y has fetched the first message
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("ALTER TABLE users DROP COLUMN last_read_id")
+        engine.execute("UPDATE users SET last_fetch = (SELECT timestamp FROM messages WHERE id = 2) "
+                       "WHERE username = 'y'")
+        engine.execute("PRAGMA user_version = 1")
+
+        self.db_session = setup_db()
+
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 2!"]
+        rv = self.app.get("/x/messages/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 3!"]
+
+    def test_message_ids_are_not_reused(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"})
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 1!"]
+
+        # The newest message is deleted after it was fetched, and the next one still is new
+        assert self.app.delete("/y/message/1/").status_code == 204
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"})
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [(message["id"], message["message"]) for message in json.loads(rv.data)] == [(2, "Test 2!")]
+        assert json.loads(self.app.get("/y/unread/").data) == {"unread": 0}
+
+    def test_migrate_db_stops_reusing_message_ids(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"})
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"})
+        self.app.get("/y/messages/", follow_redirects=True)
+        self.app.delete("/y/message/2/")
+
+        # Simulate a database from before the id sequence, where SQLite would give the next message id 2 again
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("DELETE FROM message_sequence")
+        engine.execute("PRAGMA user_version = 8")
+
+        self.db_session = setup_db()
+
+        # The sequence starts after the last_read_id of y, without copying the messages table
+        assert engine.execute("SELECT id, last_id FROM message_sequence").fetchall() == [(0, 2)]
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 3!"})
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [(message["id"], message["message"]) for message in json.loads(rv.data)] == [(3, "Test 3!")]
+        if babbel.search_enabled:
+            rv = self.app.get("/y/search/?q=test", follow_redirects=True)
+            assert sorted(message["message"] for message in json.loads(rv.data)) == ["Test 1!", "Test 3!"]
+
+    def test_unread_count(self):
+        self.create_user("x")
+        self.create_user("y")
+        for i in range(3):
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test %d!" % i}, follow_redirects=True)
+        self.app.post("/x/message/", data=json.dumps([{"receiver": "y", "message": "Batch"}] * 2),
+                      content_type="application/json", follow_redirects=True)
+
+        with self.count_queries() as statements:
+            rv = self.app.get("/y/unread/", follow_redirects=True)
+        assert json.loads(rv.data) == {"unread": 5}
+        assert rv.headers["X-Unread-Count"] == "5"
+        assert len(statements) == 1
+        rv = self.app.head("/y/unread/", follow_redirects=True)
+        assert rv.headers["X-Unread-Count"] == "5" and rv.data == ""
+        assert self.app.get("/z/unread/", follow_redirects=True).status_code == 404
+
+        self.app.get("/y/messages/?limit=2", follow_redirects=True)
+        assert json.loads(self.app.get("/y/unread/").data) == {"unread": 3}
+        # Deleting a message that has been read doesn't change the count, deleting an unread one does
+        self.app.delete("/y/message/", data=json.dumps({"ids": [1, 3]}), content_type="application/json")
+        assert json.loads(self.app.get("/y/unread/").data) == {"unread": 2}
+        self.app.get("/y/messages/", follow_redirects=True)
+        assert json.loads(self.app.get("/y/unread/").data) == {"unread": 0}
+
+        # Databases from before the counter get it from the messages
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Unread"}, follow_redirects=True)
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("ALTER TABLE users DROP COLUMN unread_count")
+        engine.execute("PRAGMA user_version = 4")
+        self.db_session = setup_db()
+        assert json.loads(self.app.get("/y/unread/").data) == {"unread": 1}
+
+    def test_search(self):
+        self.create_user("x")
+        self.create_user("y")
+        for message in ["lunch tomorrow?", "lunch lunch lunch", "no lunch today", "dinner tomorrow", "launch"]:
+            self.app.post("/x/message/", data={"receiver": "y", "message": message}, follow_redirects=True)
+        self.app.post("/y/message/", data={"receiver": "x", "message": "lunch"}, follow_redirects=True)
+
+        def search(username, query):
+            rv = self.app.get("/%s/search/?%s" % (username, query), follow_redirects=True)
+            return [message["message"] for message in json.loads(rv.data)], rv.headers.get("X-Next-Cursor")
+
+        # The most relevant messages first, only from the user's own mailbox
+        assert search("y", "q=lunch") == (["lunch lunch lunch", "lunch tomorrow?", "no lunch today"], None)
+        assert search("y", "q=Tomorrow+lunch") == (["lunch tomorrow?"], None)
+        assert search("y", "q=la*") == (["launch"], None)
+        assert len(search("y", "q=l*")[0]) == 4
+        assert search("x", "q=lunch") == (["lunch"], None)
+        # Query syntax is searched for as words
+        assert search("y", "q=lunch+OR+dinner") == ([], None)
+        assert search("y", "q=receiver_id") == ([], None)
+
+        messages, cursor = search("y", "q=lunch&limit=2")
+        assert messages == ["lunch lunch lunch", "lunch tomorrow?"]
+        assert search("y", "q=lunch&limit=2&cursor=%s" % cursor) == (["no lunch today"], None)
+        assert self.app.get("/y/search/?q=+", follow_redirects=True).status_code == 400
+        assert self.app.get("/y/search/?q=lunch&cursor=x", follow_redirects=True).status_code == 400
+        assert self.app.get("/y/messages/").data.count("lunch") == 5  # Searching didn't mark them as seen
+
+        self.app.delete("/y/message/2/", follow_redirects=True)
+        assert search("y", "q=lunch")[0] == ["lunch tomorrow?", "no lunch today"]
+
+        # Messages from before the index are found after reindexing
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("DROP TABLE messages_fts")
+        for trigger in SEARCH_INDEX_TRIGGERS:
+            engine.execute("DROP TRIGGER %s" % trigger)
+        engine.execute("PRAGMA user_version = 5")
+        self.db_session = setup_db()
+        assert search("y", "q=lunch")[0] == []
+        rv = CliRunner().invoke(babbel.reindex_command, obj=ScriptInfo(create_app=lambda info: babbel.app))
+        assert rv.exit_code == 0, rv.output
+        assert search("y", "q=lunch")[0] == ["lunch tomorrow?", "no lunch today"]
+
+    def test_conversation(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.create_user("z")
+        for sender, receiver, message in [("x", "y", "Hi y"), ("z", "y", "Hi y, it's z"), ("y", "x", "Hi x"),
+                                           ("x", "z", "Hi z"), ("x", "y", "How are you?"), ("y", "x", "Fine")]:
+            self.app.post("/%s/message/" % sender, data={"receiver": receiver, "message": message})
+
+        def conversation(url):
+            rv = self.app.get(url, follow_redirects=True)
+            return [(message["sender"], message["message"]) for message in json.loads(rv.data)], \
+                rv.headers.get("X-Next-Cursor")
+
+        thread = [("x", "Hi y"), ("y", "Hi x"), ("x", "How are you?"), ("y", "Fine")]
+        assert conversation("/x/conversation/y/") == (thread, None)
+        assert conversation("/y/conversation/x/") == (thread, None)
+        assert conversation("/z/conversation/z/") == ([], None)
+
+        # Each page is one index range per direction
+        with self.count_queries() as statements:
+            messages, cursor = conversation("/y/conversation/x/?limit=3")
+        assert (messages, cursor is not None) == (thread[:3], True)
+        queries = [statement for statement in statements if "FROM messages" in statement]
+        assert len(queries) == 2
+        connection = self.db_session.connection().connection
+        for query in queries:
+            plan = connection.execute("EXPLAIN QUERY PLAN " + query, [1] * query.count("?")).fetchall()
+            assert "ix_messages_sender_receiver_timestamp" in " ".join(row[-1] for row in plan)
+        assert conversation("/y/conversation/x/?limit=3&cursor=%s" % cursor) == (thread[3:], None)
+
+        # Only the receiver's messages are marked as seen by MessageList, not by viewing the conversation
+        assert len(json.loads(self.app.get("/y/messages/").data)) == 3
+        assert self.app.get("/x/conversation/nobody/", follow_redirects=True).status_code == 404
+        assert self.app.get("/x/conversation/y/?cursor=x", follow_redirects=True).status_code == 400
+
+    def test_archive_old_messages(self):
+        self.create_user("x")
+        self.create_user("y")
+        now = datetime.now(pytz.utc)
+        with babbel.app.app_context():
+            self.db_session.execute(Message.__table__.insert(), [
+                {"sender_id": 1, "receiver_id": receiver, "message": "Test %d!" % days,
+                 "timestamp": now - timedelta(days=days)} for receiver, days in [(2, 50), (2, 40), (2, 35), (1, 20)]])
+            self.db_session.commit()
+        self.app.post("/x/message/", data={"receiver": "y", "message": "New"}, follow_redirects=True)
+        # y has read two of the three old messages
+        self.app.get("/y/messages/?limit=2", follow_redirects=True)
+        self.app.get("/x/messages/", follow_redirects=True)
+
+        script_info = ScriptInfo(create_app=lambda info: babbel.app)
+        rv = CliRunner().invoke(babbel.retention_command, ["y", "30"], obj=script_info)
+        assert rv.exit_code == 0, rv.output
+        babbel.app.config["ARCHIVE_BATCH_SIZE"] = 1
+        flag_delay = babbel.ARCHIVE_FLAG_DELAY
+        babbel.ARCHIVE_FLAG_DELAY = 0
+        babbel.user_cache.check_interval = 0
+        try:
+            # x has no policy, and there is no RETENTION_DAYS
+            assert babbel.archive_old_messages() == 2
+            babbel.app.config["RETENTION_DAYS"] = 10
+            rv = CliRunner().invoke(babbel.archive_command, obj=script_info)
+            assert rv.exit_code == 0, rv.output
+            assert "Archived 1 messages" in rv.output
+        finally:
+            babbel.ARCHIVE_FLAG_DELAY = flag_delay
+            babbel.app.config.pop("ARCHIVE_BATCH_SIZE")
+            babbel.app.config.pop("RETENTION_DAYS", None)
+        engine = self.db_session.get_bind()
+        assert engine.execute("SELECT receiver_id, message FROM messages_archive ORDER BY id").fetchall() == \
+            [(2, "Test 50!"), (2, "Test 40!"), (1, "Test 20!")]
+        assert engine.execute("PRAGMA auto_vacuum").scalar() == 2
+        assert engine.execute("PRAGMA freelist_count").scalar() == 0
+        assert [user.archived for user in User.query.order_by(User.id)] == [True, True]
+        self.db_session.remove()
+
+        # Archived messages are still in date ranges, pages, lookups by id and conversations, but never new
+        url = "/y/messages/?start=%s" % quote_plus((now - timedelta(days=60)).isoformat())
+        messages = [message["message"] for message in json.loads(self.app.get(url, follow_redirects=True).data)]
+        assert messages == ["Test 50!", "Test 40!", "Test 35!", "New"]
+        rv = self.app.get(url + "&limit=1", follow_redirects=True)
+        rv = self.app.get(url + "&limit=1&cursor=%s" % rv.headers["X-Next-Cursor"], follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 40!"]
+        assert json.loads(self.app.get("/y/message/1/", follow_redirects=True).data)["message"] == "Test 50!"
+        rv = self.app.get("/y/conversation/x/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == messages
+        rv = self.app.get("/y/messages/", follow_redirects=True)
+        assert [message["message"] for message in json.loads(rv.data)] == ["Test 35!", "New"]
+
+        def search(username, query):
+            rv = self.app.get("/%s/search/?q=%s" % (username, query), follow_redirects=True)
+            return [message["message"] for message in json.loads(rv.data)]
+
+        # Archiving kept the messages in the search index
+        assert search("y", "test") == ["Test 35!", "Test 40!", "Test 50!"]
+        assert search("x", "test") == ["Test 20!"]
+
+        rv = self.app.delete("/y/message/?report", data=json.dumps({"ids": [1, 3]}), content_type="application/json")
+        assert json.loads(rv.data) == {"deleted": [1, 3], "missing": []}
+        assert engine.execute("SELECT COUNT(*) FROM messages_archive").scalar() == 2
+        assert search("y", "test") == ["Test 40!"]
+        assert engine.execute("SELECT COUNT(*) FROM messages_fts_docsize").scalar() == 3
+
+        # Indexes from before archived messages were searchable get them added by the migration
+        for trigger in ["messages_archive_fts_insert", "messages_archive_fts_delete"]:
+            engine.execute("DROP TRIGGER %s" % trigger)
+        engine.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        engine.execute("PRAGMA user_version = 9")
+        assert search("y", "test") == []
+        self.db_session = setup_db()
+        assert search("y", "test") == ["Test 40!"]
+        assert engine.execute("SELECT COUNT(*) FROM messages_fts_docsize").scalar() == 3
+
+        rv = CliRunner().invoke(babbel.retention_command, ["nobody", "30"], obj=script_info)
+        assert rv.exit_code != 0
+
+    def test_periodic_job_runs_in_one_process(self):
+        lock_fd, lock_file = tempfile.mkstemp()
+        try:
+            # Two jobs with the same lock file behave like the jobs of two worker processes
+            calls = []
+            jobs = dict((name, PeriodicJob(lambda name=name: calls.append(name), 0.01, lock_file=lock_file))
+                        for name in "ab")
+            time.sleep(0.2)
+            assert len(set(calls)) == 1
+            # Once the job of the running process ends, the other one takes over
+            runner, = set(calls)
+            other, = set(jobs) - set(runner)
+            jobs[runner].close()
+            del calls[:]
+            time.sleep(0.2)
+            jobs[other].close()
+            assert calls and set(calls) == set(other)
+        finally:
+            os.close(lock_fd)
+            os.unlink(lock_file)
+
+    def test_date_range_does_not_mark_messages_as_seen(self):
+        self.create_user("x")
+        self.app.post("/x/message/", data={"receiver": "x", "message": "Test!"})
+
+        rv = self.app.get("/x/messages/?end=%s" % quote_plus(datetime.now(pytz.utc).isoformat()), follow_redirects=True)
+        assert "Test!" in rv.data
+
+        with self.count_queries() as statements:
+            rv = self.app.get("/x/messages/", follow_redirects=True)
+        assert "Test!" in rv.data
+        assert len([statement for statement in statements if statement.startswith("UPDATE")]) == 1
+
+        with self.count_queries() as statements:
+            rv = self.app.get("/x/messages/", follow_redirects=True)
+        assert "Test!" not in rv.data
+        assert len([statement for statement in statements if statement.startswith("UPDATE")]) == 0
+
+    def test_user_cache(self):
+        self.create_user("x")
+        self.create_user("y")
+        rv = self.app.post("/x/message/", data={"receiver": "y", "message": "Test!"})
+        assert rv.status_code == 204
+
+        # Both users are cached now
+        with self.count_queries() as statements:
+            rv = self.app.post("/x/message/", data={"receiver": "y", "message": "Test!"})
+        assert rv.status_code == 204
+        assert not [statement for statement in statements if "FROM users" in statement]
+        assert babbel.user_cache.stats()["hits"] >= 2
+
+        # Renaming a user removes the old name from the cache
+        with babbel.app.app_context():
+            user = User.query.filter_by(username="y").first()
+            user.username = "w"
+            self.db_session.commit()
+        rv = self.app.post("/x/message/", data={"receiver": "y", "message": "Test!"})
+        assert rv.status_code == 404
+        rv = self.app.post("/x/message/", data={"receiver": "w", "message": "Test!"})
+        assert rv.status_code == 204
+
+        rv = self.app.get("/db/")
+        assert rv.status_code == 200
+        assert "User cache" in rv.data
+
+    def test_lru_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "invalidation")
+            # Two caches sharing an invalidation file behave like the caches of two worker processes
+            cache = LRUCache(2, invalidation_file=filename, check_interval=0)
+            other = LRUCache(2, invalidation_file=filename)
+            cache.put("a", 1)
+            cache.put("b", 2)
+            assert cache.get("a") == 1
+            cache.put("c", 3)  # Evicts b, the least recently used entry
+            assert cache.get("b") is None
+            assert cache.get("c") == 3
+            assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "size": 2, "maxsize": 2}
+
+            other.invalidate("a")
+            assert cache.get("a") is None
+            assert cache.get("c") is None
+
+            expiring = LRUCache(2, ttl=0)
+            expiring.put("a", 1)
+            time.sleep(0.01)
+            assert expiring.get("a") is None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_production_database_profile(self):
+        engine = create_db_engine(babbel.app.config["DATABASE"], "production", pool_size=2)
+        try:
+            connection = engine.connect()
+            assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.execute("PRAGMA synchronous").scalar() == 1  # NORMAL
+            assert connection.execute("PRAGMA busy_timeout").scalar() == 5000
+            connection.close()
+            assert engine.pool.size() == 2
+        finally:
+            engine.dispose()
+
+    def test_bulk_load(self):
+        self.create_user("x")
+        directory = tempfile.mkdtemp()
+        try:
+            users_file = os.path.join(directory, "users.csv")
+            with open(users_file, "w") as f:
+                f.write("username\nx\ny\nz\n")
+            messages_file = os.path.join(directory, "messages.ndjson")
+            with open(messages_file, "w") as f:
+                for sender, receiver, message, timestamp in [("x", "y", "Test 1!", "2016-10-08T16:17:25+00:00"),
+                                                             ("y", "z", "Test 2!", "2016-10-08T18:17:25+02:00"),
+                                                             ("w", "z", "Test 3!", "2016-10-08T16:17:25"),
+                                                             ("z", "y", "Test 4!", "2016-10-09T16:17:25")]:
+                    f.write(json.dumps({"sender": sender, "receiver": receiver, "message": message,
+                                        "timestamp": timestamp}) + "\n")
+
+            engine = self.db_session.get_bind()
+            counts = bulk_load(engine, users_file, messages_file, batch_size=2, rebuild_indexes=True)
+            assert counts == {"users": 2, "skipped_users": 1, "messages": 3, "skipped_messages": 1}
+
+            indexes = set(index["name"] for index in inspect(engine).get_indexes("messages"))
+            assert "ix_messages_receiver_timestamp" in indexes
+
+            rv = self.app.get("/y/messages/", follow_redirects=True)
+            messages = json.loads(rv.data)
+            assert [(message["sender"], message["message"]) for message in messages] == [("x", "Test 1!"),
+                                                                                       ("z", "Test 4!")]
+            rv = self.app.get("/z/messages/", follow_redirects=True)
+            assert [message["timestamp"] for message in json.loads(rv.data)] == ["2016-10-08 16:17:25"]
+
+            # A load that fails halfway still leaves the messages table with its indexes
+            with open(messages_file, "a") as f:
+                f.write(json.dumps({"sender": "x", "receiver": "y", "message": "Test 5!", "timestamp": "x"}) + "\n")
+            self.assertRaises(ValueError, bulk_load, engine, messages_file=messages_file, batch_size=2,
+                              rebuild_indexes=True)
+            indexes = set(index["name"] for index in inspect(engine).get_indexes("messages"))
+            assert indexes == set(index.name for index in Message.__table__.indexes)
+
+            # Loading the users again through the CLI command skips all of them
+            result = CliRunner().invoke(babbel.load_command, ["--users", users_file],
+                                        obj=ScriptInfo(create_app=lambda info: babbel.app))
+            assert result.exit_code == 0
+            assert "Loaded 0 users (3 skipped)" in result.output
+
+            # Historical messages are loaded as read, except for receivers with messages they haven't fetched yet
+            self.app.get("/y/messages/", follow_redirects=True)
+            self.app.get("/z/messages/", follow_redirects=True)
+            self.app.post("/x/message/", data={"receiver": "z", "message": "New"}, follow_redirects=True)
+            with open(messages_file, "w") as f:
+                for receiver, message in [("y", "Old " * 30), ("z", "Old")]:
+                    f.write(json.dumps({"sender": "x", "receiver": receiver, "message": message,
+                                        "timestamp": "2015-01-01T00:00:00"}) + "\n")
+            result = CliRunner().invoke(babbel.load_command, ["--messages", messages_file, "--as-read"],
+                                        obj=ScriptInfo(create_app=lambda info: babbel.app))
+            assert result.exit_code == 0, result.output
+            assert json.loads(self.app.get("/y/unread/").data) == {"unread": 0}
+            assert json.loads(self.app.get("/y/messages/", follow_redirects=True).data) == []
+            rv = self.app.get("/y/messages/?start=2000-01-01T00%3A00%3A00%2B00%3A00", follow_redirects=True)
+            assert json.loads(rv.data)[0]["message"] == ("Old " * 30)[:MESSAGE_MAXLEN]
+            assert json.loads(self.app.get("/z/unread/").data) == {"unread": 2}
+            rv = self.app.get("/z/messages/", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["New", "Old"]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parse_iso8601(self):
+        for value in ["2016-10-08T16:17:25.735955+00:00", "2016-10-08T16:17:25Z", "2016-10-08T16:17:25.7-05:30",
+                      "2016-10-08 16:17:25", "2016-10-08T16:17:25+0200"]:
+            parsed = parse_iso8601(value)
+            assert parsed == parser.parse(value)
+            assert parsed.utcoffset() == parser.parse(value).utcoffset()
+        # Left to dateutil
+        assert parse_iso8601("Oct 8 2016") is None
+        assert parse_iso8601("2016-13-08T16:17:25") is None
+
+        self.create_user("x")
+        for value in ["2016-13-08T16:17:25+00:00", "not a date"]:
+            rv = self.app.get("/x/messages/?start=%s" % quote_plus(value), follow_redirects=True)
+            assert rv.status_code == 400
+        rv = self.app.get("/x/messages/?start=Oct+8+2016+16%3A17+UTC", follow_redirects=True)
+        assert rv.status_code == 200
+
+    def test_message_serializer(self):
+        self.create_user("x")
+        self.create_user("y")
+        for message in [u"Plain", u"Quotes \" and \\ backslashes", u"Line\nbreak\t\u00e5\u00e4\u00f6 \u2603 </script>"]:
+            self.app.post("/x/message/", data={"receiver": "y", "message": message}, follow_redirects=True)
+
+        with babbel.app.app_context():
+            rows = babbel.query_messages(babbel.get_user_or_error("y")).order_by(babbel.Message.id).all()
+            expected = dumps([babbel.dictify_message(row) for row in rows]) + "\n"
+            assert babbel.dictify_message(rows[0])["timestamp"] == rows[0].timestamp.strftime("%Y-%m-%d %H:%M:%S")
+            for serializer in [MessageSerializer(), MessageSerializer(cache_size=2)]:
+                assert serializer.encode_list(rows) == expected
+                assert serializer.encode_list(rows) == expected  # Partly from the cache
+            assert babbel.message_serializer.encode(rows[2]) + "\n" == dumps(babbel.dictify_message(rows[2])) + "\n"
+
+        rv = self.app.get("/y/messages/?start=2000-01-01T00%3A00%3A00%2B00%3A00", follow_redirects=True)
+        assert rv.data == expected
+        assert rv.mimetype == "application/json"
+        rv = self.app.get("/y/message/%d/" % rows[2].id, follow_redirects=True)
+        assert rv.data == dumps(babbel.dictify_message(rows[2])) + "\n"
+        rv = self.app.get("/y/messages/?stream=json", follow_redirects=True)
+        assert rv.data == expected
+
+        # Renamed senders don't get the cached JSON with their old name
+        serializer = MessageSerializer(cache_size=10)
+        serializer.encode(rows[2])
+        Row = namedtuple("Row", ["id", "sender", "message", "timestamp", "stored_timestamp"])
+        renamed = Row(rows[2].id, u"alice", rows[2].message, rows[2].timestamp, rows[2].stored_timestamp)
+        assert '"sender": "alice"' in serializer.encode(renamed)
+        babbel.app.config["MESSAGE_JSON_CACHE_SIZE"] = 10
+        try:
+            self.db_session = setup_db()
+            etag = self.app.get("/y/message/1/", follow_redirects=True).headers["ETag"]
+            user = User.query.get(1)
+            user.username = u"alice"
+            self.db_session.commit()
+            rv = self.app.get("/y/message/1/", follow_redirects=True)
+            assert rv.headers["ETag"] != etag
+            assert json.loads(rv.data)["sender"] == "alice"
+        finally:
+            babbel.app.config.pop("MESSAGE_JSON_CACHE_SIZE")
+
+    def test_conditional_get(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"}, follow_redirects=True)
+
+        rv = self.app.get("/y/message/1/", follow_redirects=True)
+        etag = rv.headers["ETag"]
+        with self.count_queries() as statements:
+            rv = self.app.get("/y/message/1/", headers={"If-None-Match": etag}, follow_redirects=True)
+        assert rv.status_code == 304
+        assert not any("FROM messages" in statement for statement in statements)
+
+        end = quote_plus((datetime.now(pytz.utc) + timedelta(seconds=1)).isoformat())
+        time.sleep(1.1)
+        url = "/y/messages/?start=2000-01-01T00%%3A00%%3A00%%2B00%%3A00&end=%s" % end
+        rv = self.app.get(url, follow_redirects=True)
+        range_etag = rv.headers["ETag"]
+        rv = self.app.get(url, headers={"If-None-Match": range_etag}, follow_redirects=True)
+        assert rv.status_code == 304
+        assert rv.headers["ETag"] == range_etag
+        # Ranges that have not ended yet can still get new messages
+        assert "ETag" not in self.app.get("/y/messages/?start=2000-01-01T00%3A00%3A00%2B00%3A00").headers
+
+        # Storing a message changes the ETags of the receiver's messages, but not those of ranges that have ended
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"}, follow_redirects=True)
+        rv = self.app.get("/y/message/1/", headers={"If-None-Match": etag}, follow_redirects=True)
+        assert rv.status_code == 200
+        assert rv.headers["ETag"] != etag
+        rv = self.app.get(url, headers={"If-None-Match": range_etag}, follow_redirects=True)
+        assert rv.status_code == 304
+
+        # Deleting one changes both
+        self.app.delete("/y/message/1/", follow_redirects=True)
+        rv = self.app.get(url, headers={"If-None-Match": range_etag}, follow_redirects=True)
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == []
+
+        # Databases from before mailbox versions get the column
+        engine = create_engine(babbel.app.config["DATABASE"])
+        engine.execute("ALTER TABLE users DROP COLUMN mailbox_version")
+        engine.execute("ALTER TABLE users DROP COLUMN range_version")
+        engine.execute("PRAGMA user_version = 2")
+        self.db_session = setup_db()
+        rv = self.app.get("/y/message/2/", follow_redirects=True)
+        assert rv.status_code == 200
+        assert rv.headers["ETag"] == '"0.2"'
+
+    def test_range_cache(self):
+        self.create_user("x")
+        self.create_user("y")
+        with babbel.app.app_context():
+            self.db_session.execute(Message.__table__.insert(), [
+                {"sender_id": 1, "receiver_id": 2, "message": "Test %d!" % hour,
+                 "timestamp": datetime(2016, 10, 8, hour, tzinfo=pytz.utc)} for hour in (10, 11, 12)])
+            self.db_session.commit()
+        first = "/y/messages/?start=2016-10-08T09%3A00%3A00%2B00%3A00&end=2016-10-08T10%3A30%3A00%2B00%3A00"
+        last = "/y/messages/?start=2016-10-08T11%3A30%3A00%2B00%3A00&end=2016-10-08T12%3A30%3A00%2B00%3A00&limit=5"
+
+        directory = tempfile.mkdtemp()
+        try:
+            for backend in ["memory", "sqlite"]:
+                babbel.app.config["RANGE_CACHE"] = backend
+                babbel.app.config["RANGE_CACHE_PATH"] = os.path.join(directory, "range-cache.db")
+                babbel.app.config["RANGE_CACHE_INVALIDATION_FILE"] = os.path.join(directory, "range-cache")
+                self.db_session = setup_db()
+
+                expected = {}
+                for url in [first, last]:
+                    expected[url] = self.app.get(url, follow_redirects=True).data
+                    with self.count_queries() as statements:
+                        rv = self.app.get(url, follow_redirects=True)
+                    assert rv.data == expected[url]
+                    assert not any("FROM messages" in statement for statement in statements)
+                assert babbel.range_cache.stats()["hits"] == 2
+
+                # Storing messages doesn't change past ranges, so they stay cached
+                self.app.post("/x/message/", data={"receiver": "y", "message": "Test 13!"}, follow_redirects=True)
+                assert self.app.get(first, follow_redirects=True).data == expected[first]
+                assert babbel.range_cache.stats()["hits"] == 3
+
+                # The times of a range are compared without their time zone, and the cache does the same. In UTC, this
+                # is the first range.
+                shifted = "/y/messages/?start=2016-10-08T11%3A00%3A00%2B02%3A00&end=2016-10-08T12%3A30%3A00%2B02%3A00"
+                babbel.app.config["RANGE_CACHE"] = None
+                self.db_session = setup_db()
+                uncached = self.app.get(shifted, follow_redirects=True).data
+                babbel.app.config["RANGE_CACHE"] = backend
+                self.db_session = setup_db()
+                assert self.app.get(first, follow_redirects=True).data == expected[first]
+                assert self.app.get(shifted, follow_redirects=True).data == uncached
+                assert self.app.get(shifted, follow_redirects=True).data == uncached
+                assert len(json.loads(uncached)) == 2
+
+                # Another worker deletes a message, without telling this one. The range ETag changes, so the ranges
+                # cached before are not used anymore, and the new ETag is never sent with the old body.
+                with babbel.app.app_context():
+                    self.db_session.execute("DELETE FROM messages WHERE id = 1")
+                    self.db_session.execute("UPDATE users SET range_version = range_version + 1 WHERE id = 2")
+                    self.db_session.commit()
+                rv = self.app.get(first, follow_redirects=True)
+                assert json.loads(rv.data) == []
+                rv = self.app.get(first, headers={"If-None-Match": rv.headers["ETag"]}, follow_redirects=True)
+                assert rv.status_code == 304
+                with self.count_queries() as statements:
+                    rv = self.app.get(last, follow_redirects=True)
+                assert rv.data == expected[last]
+                assert any("FROM messages" in statement for statement in statements)
+
+                # Renaming a sender changes the ETags of the mailboxes they sent messages to as well
+                with babbel.app.app_context():
+                    for old, new in [("x", "w"), ("w", "x")]:
+                        User.query.filter_by(username=old).one().username = new
+                        self.db_session.commit()
+                        assert json.loads(self.app.get(last, follow_redirects=True).data)[0]["sender"] == new
+
+                # A list queried before a deletion is not cached after it
+                token = babbel.range_cache.token(2)
+                babbel.range_cache.invalidate(2, [datetime(2016, 10, 8, 12, tzinfo=pytz.utc)])
+                start, end = datetime(2016, 10, 8, tzinfo=pytz.utc), datetime(2016, 10, 9, tzinfo=pytz.utc)
+                babbel.range_cache.put(token, "key", 2, start, end, "[]\n", None)
+                assert babbel.range_cache.get("key") is None
+
+                babbel.range_cache.clear()
+                assert babbel.range_cache.stats()["size"] == 0
+                with babbel.app.app_context():  # Restore the message for the next backend
+                    self.db_session.execute(Message.__table__.insert(), [
+                        {"id": 1, "sender_id": 1, "receiver_id": 2, "message": "Test 10!",
+                         "timestamp": datetime(2016, 10, 8, 10, tzinfo=pytz.utc)}])
+                    self.db_session.commit()
+        finally:
+            for key in ["RANGE_CACHE", "RANGE_CACHE_PATH", "RANGE_CACHE_INVALIDATION_FILE"]:
+                babbel.app.config.pop(key)
+            shutil.rmtree(directory)
+
+        # Sized by bytes, evicting the least recently used ranges
+        cache = MemoryRangeCache(3 * (RANGE_CACHE_ENTRY_OVERHEAD + 10))
+        for key in "abcd":
+            cache.put(cache.token(1), key, 1, start, end, "x" * 10, None)
+            cache.get("a")
+        assert cache.get("a") == ("x" * 10, None)
+        assert cache.get("b") is None
+        assert cache.stats()["evictions"] == 1
+
+    def test_request_metrics(self):
+        directory = tempfile.mkdtemp()
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        babbel.app.logger.addHandler(handler)
+        try:
+            babbel.app.config["METRICS_DIR"] = directory
+            babbel.app.config["SLOW_REQUEST_SECONDS"] = 0
+            self.db_session = setup_db()
+            self.create_user("x")
+            self.create_user("y")
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"}, follow_redirects=True)
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"}, follow_redirects=True)
+            self.app.get("/y/messages/", follow_redirects=True)
+            self.app.get("/y/", follow_redirects=True)
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test 3!"}, follow_redirects=True)
+            duration, babbel.EVENT_STREAM_DURATION = babbel.EVENT_STREAM_DURATION, 0
+            try:
+                assert "Test 3!" in self.app.get("/y/messages/events/", follow_redirects=True).data
+            finally:
+                babbel.EVENT_STREAM_DURATION = duration
+
+            # Another worker process
+            with open(os.path.join(directory, "1-1.json"), "w") as f:
+                json.dump({"endpoints": {"MessageList.get": {"buckets": [1] + [0] * 11, "count": 1, "seconds": 0.001,
+                                                             "sql_statements": 3, "db_seconds": 0.0005, "rows": 10,
+                                                             "commits": 1}},
+                           "batches": {"buckets": [0] * 11, "count": 0, "rows": 0}}, f)
+
+            rv = self.app.get("/metrics")
+            lines = set(rv.data.splitlines())
+            assert 'babbel_request_duration_seconds_count{endpoint="MessageResource.post"} 3' in lines
+            assert 'babbel_request_duration_seconds_bucket{endpoint="MessageList.get",le="+Inf"} 2' in lines
+            assert 'babbel_rows_total{endpoint="MessageList.get"} 12' in lines
+            assert 'babbel_rows_total{endpoint="views.index"} 2' in lines
+            assert 'babbel_rows_total{endpoint="MessageEvents.get"} 1' in lines
+            assert 'babbel_commits_total{endpoint="MessageResource.post"} 3' in lines
+            statements = [line for line in lines
+                          if line.startswith('babbel_sql_statements_total{endpoint="MessageList')]
+            assert int(statements[0].split()[1]) > 3
+
+            slow = [record.getMessage() for record in records if record.getMessage().startswith("Slow request")]
+            assert any("GET /y/messages/" in message and "FROM messages" in message for message in slow)
+        finally:
+            babbel.app.logger.removeHandler(handler)
+            babbel.app.config.pop("SLOW_REQUEST_SECONDS")
+            shutil.rmtree(directory)
+
+    def test_group_commit(self):
+        babbel.app.config["GROUP_COMMIT"] = True
+        babbel.app.config["GROUP_COMMIT_WINDOW_MS"] = 100
+        try:
+            self.db_session = setup_db()
+            self.create_user("x")
+            self.create_user("y")
+            self.app.get("/y/messages/", follow_redirects=True)
+
+            def post(i):
+                rv = babbel.app.test_client().post("/x/message/", data={"receiver": "y", "message": "Test %d!" % i},
+                                                   follow_redirects=True)
+                assert rv.status_code == 204
+
+            threads = [threading.Thread(target=post, args=(i,)) for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            rv = self.app.get("/y/messages/", follow_redirects=True)
+            assert sorted(message["message"] for message in json.loads(rv.data)) == \
+                sorted("Test %d!" % i for i in range(10))
+            totals, batches = babbel.request_metrics.snapshot()
+            assert batches["rows"] == 10
+            assert batches["count"] < 10
+        finally:
+            babbel.app.config.pop("GROUP_COMMIT")
+            babbel.app.config.pop("GROUP_COMMIT_WINDOW_MS")
+
+        # A failing submission is retried on its own, without failing the rest of its batch
+        inserted = []
+
+        def insert(rows):
+            if "bad" in rows:
+                raise ValueError("bad row")
+            inserted.extend(rows)
+
+        writer = GroupCommitWriter(insert)
+        batch = [Submission(["good"]), Submission(["bad"]), Submission(["better"])]
+        writer.commit(batch)
+        writer.close()
+        assert inserted == ["good", "better"]
+        assert [isinstance(submission.error, ValueError) for submission in batch] == [False, True, False]
+        assert all(submission.done.is_set() for submission in batch)
+
+    def test_read_replicas(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 1!"}, follow_redirects=True)
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Test 2!"}, follow_redirects=True)
+
+        # A replica that lags behind: a copy of the database that doesn't get any later changes
+        replica_fd, replica = tempfile.mkstemp()
+        directory = tempfile.mkdtemp()
+        try:
+            shutil.copyfile(self.filename, replica)
+            babbel.app.config["READ_YOUR_WRITES_DIR"] = directory
+            self.db_session = setup_db(read_urls=["sqlite:///%s" % replica])
+            url = "/%s/messages/?start=2000-01-01T00%%3A00%%3A00%%2B00%%3A00"
+
+            self.app.post("/y/message/", data={"receiver": "x", "message": "Test 3!"}, follow_redirects=True)
+            # x hasn't written anything, so x reads from the replica
+            assert json.loads(self.app.get(url % "x", follow_redirects=True).data) == []
+            assert os.listdir(directory) == ["writes"]
+            # The last_read_id is always read from the primary, so new messages can't be delivered twice
+            rv = self.app.get("/y/messages/", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Test 1!", "Test 2!"]
+            assert json.loads(self.app.get("/y/messages/", follow_redirects=True).data) == []
+
+            # Having changed data, y reads its own writes from the primary
+            self.app.delete("/y/message/1/", follow_redirects=True)
+            rv = self.app.get(url % "y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Test 2!"]
+            rv = babbel.app.test_client().get(url % "y", follow_redirects=True)  # As another worker would
+            assert [message["message"] for message in json.loads(rv.data)] == ["Test 2!"]
+
+            # Until the window has passed
+            babbel.recent_writers.window = 0
+            rv = self.app.get(url % "y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Test 1!", "Test 2!"]
+        finally:
+            babbel.app.config.pop("READ_YOUR_WRITES_DIR")
+            os.close(replica_fd)
+            os.unlink(replica)
+            shutil.rmtree(directory)
+
+    def test_sharding(self):
+        self.create_user("x")
+        self.create_user("y")
+        self.create_user("z")
+        self.app.post("/x/message/", data={"receiver": "y", "message": "Before sharding"}, follow_redirects=True)
+
+        shard_fds, shards = zip(*[tempfile.mkstemp() for _ in range(2)])
+        try:
+            babbel.app.config["DATABASE_SHARDS"] = ["sqlite:///%s" % shard for shard in shards]
+            self.db_session = setup_db()
+            # The primary database's sequence of plain ids gave way to the sequence of shard 0
+            assert self.db_session.get_bind().execute("SELECT id FROM message_sequence").fetchall() == [(1,)]
+            url = "/%s/messages/?start=2000-01-01T00%%3A00%%3A00%%2B00%%3A00"
+            script_info = ScriptInfo(create_app=lambda info: babbel.app)
+
+            # Mailboxes stay on the primary database until they are moved
+            rv = CliRunner().invoke(babbel.rebalance_command, ["--user", "y", "--shard", "2"], obj=script_info)
+            assert rv.exit_code == 0, rv.output
+            assert "Moved 1 messages of y to shard 2" in rv.output
+            rv = CliRunner().invoke(babbel.rebalance_command, ["--spread"], obj=script_info)
+            assert rv.exit_code == 0, rv.output
+            assert [(user.username, user.shard) for user in User.query.order_by(User.id)] == \
+                [("x", 1), ("y", 2), ("z", 0)]
+            babbel.db_session.remove()
+
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Sharded"}, follow_redirects=True)
+            rv = self.app.post("/x/message/", data=json.dumps([{"receiver": "y", "message": "To y"},
+                                                              {"receiver": "z", "message": "To z"}]),
+                               content_type="application/json", follow_redirects=True)
+            assert [result["status"] for result in json.loads(rv.data)] == [204, 204]
+            with closing(sqlite3.connect(shards[1])) as connection:
+                ids = [msg_id for msg_id, in connection.execute("SELECT id FROM messages ORDER BY id")]
+            assert len(ids) == 3 and all(msg_id % SHARD_ID_STRIDE == 2 for msg_id in ids[1:])
+
+            rv = self.app.get(url % "y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Before sharding", "Sharded", "To y"]
+            assert json.loads(self.app.get("/y/message/%d/" % ids[1], follow_redirects=True).data)["message"] == \
+                "Sharded"
+            assert [message["message"] for message in json.loads(self.app.get("/z/messages/").data)] == ["To z"]
+
+            assert json.loads(self.app.get("/y/unread/").data) == {"unread": 3}
+            assert json.loads(self.app.get("/z/unread/").data) == {"unread": 0}
+
+            # A worker that has y's old shard cached notices the move when storing or deleting, and retries
+            self.app.get("/y/", follow_redirects=True)
+            assert babbel.user_cache.get("y").shard == 2
+            assert move_mailbox([babbel.db_session.get_bind().url] + list(babbel.app.config["DATABASE_SHARDS"]),
+                                2, 1) == 3
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Moved"}, follow_redirects=True)
+            assert babbel.user_cache.get("y").shard == 1
+            rv = self.app.get(url % "y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == \
+                ["Before sharding", "Sharded", "To y", "Moved"]
+            # New messages still get higher ids than the moved ones
+            moved_id = json.loads(rv.data)[3]["id"]
+            assert moved_id > ids[2] and moved_id % SHARD_ID_STRIDE == 1
+            babbel.user_cache.put("y", babbel.user_cache.get("y")._replace(shard=0))
+            assert self.app.delete("/y/message/%d/" % ids[1], follow_redirects=True).status_code == 204
+            rv = self.app.get(url % "y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Before sharding", "To y", "Moved"]
+            assert [message["message"] for message in json.loads(self.app.get("/y/messages/").data)] == \
+                ["Before sharding", "To y", "Moved"]
+            assert json.loads(self.app.get("/y/unread/").data) == {"unread": 0}
+            # The full-text index moves along with the messages
+            rv = self.app.get("/y/search/?q=to+y", follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["To y"]
+
+            rv = self.app.get("/db/", follow_redirects=True)
+            assert "Shard 1: 2 mailboxes, 3 messages" in rv.data
+            assert "Shard 2: 0 mailboxes, 0 messages" in rv.data
+            assert "Message from x to z: To z" in rv.data
+
+            # Loaded messages are stored on the shards of their receivers, with ids from the shards' sequences
+            directory = tempfile.mkdtemp()
+            try:
+                messages_file = os.path.join(directory, "messages.csv")
+                with open(messages_file, "w") as f:
+                    f.write("sender,receiver,message,timestamp\n"
+                            "x,y,Loaded,2016-10-08T16:17:25\nx,z,Loaded,2016-10-08T16:17:25\n")
+                rv = CliRunner().invoke(babbel.load_command, ["--messages", messages_file, "--rebuild-indexes"],
+                                        obj=script_info)
+                assert rv.exit_code == 0, rv.output
+            finally:
+                shutil.rmtree(directory)
+            for username, shard in [("y", 1), ("z", 0)]:
+                rv = self.app.get(url % username, follow_redirects=True)
+                loaded = json.loads(rv.data)[0]
+                assert loaded["message"] == "Loaded" and loaded["id"] % SHARD_ID_STRIDE == shard
+            assert json.loads(self.app.get("/y/unread/").data) == {"unread": 1}
+
+            # The old messages of the mailboxes on every shard are archived, once they have been fetched
+            self.app.get("/y/messages/", follow_redirects=True)
+            self.app.get("/z/messages/", follow_redirects=True)
+            babbel.app.config["RETENTION_DAYS"] = 365
+            flag_delay, babbel.ARCHIVE_FLAG_DELAY = babbel.ARCHIVE_FLAG_DELAY, 0
+            babbel.user_cache.check_interval = 0
+            try:
+                assert babbel.archive_old_messages() == 2
+            finally:
+                babbel.ARCHIVE_FLAG_DELAY = flag_delay
+                babbel.app.config.pop("RETENTION_DAYS")
+            for username, shard in [("y", 1), ("z", 0)]:
+                with closing(sqlite3.connect(shards[shard - 1] if shard else self.filename)) as connection:
+                    assert connection.execute("SELECT message FROM messages_archive").fetchall() == [(u"Loaded",)]
+        finally:
+            babbel.app.config.pop("DATABASE_SHARDS")
+            self.db_session = setup_db()
+            for shard_fd, shard in zip(shard_fds, shards):
+                os.close(shard_fd)
+                os.unlink(shard)
+
+    def test_interrupted_mailbox_move(self):
+        self.create_user("x")
+        self.create_user("y")
+        for i in range(3):
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Test %d!" % i}, follow_redirects=True)
+
+        shard_fds, shards = zip(*[tempfile.mkstemp() for _ in range(2)])
+        try:
+            babbel.app.config["DATABASE_SHARDS"] = ["sqlite:///%s" % shard for shard in shards]
+            self.db_session = setup_db()
+            urls = [babbel.db_session.get_bind().url] + list(babbel.app.config["DATABASE_SHARDS"])
+            url = "/y/messages/?start=2000-01-01T00%3A00%3A00%2B00%3A00"
+            script_info = ScriptInfo(create_app=lambda info: babbel.app)
+            assert move_mailbox(urls, 2, 1) == 3
+
+            def fail_on(path, statement):
+                with closing(sqlite3.connect(path)) as connection:
+                    connection.execute("CREATE TRIGGER crash BEFORE %s BEGIN SELECT RAISE(ABORT, 'crash'); END"
+                                       % statement)
+                    connection.commit()
+
+            def recover(path):
+                with closing(sqlite3.connect(path)) as connection:
+                    connection.execute("DROP TRIGGER crash")
+                    connection.commit()
+
+            # Interrupted before the target shard took over the mailbox, which is still on the source shard
+            fail_on(shards[1], "INSERT ON mailboxes")
+            self.assertRaises(sqlite3.IntegrityError, move_mailbox, urls, 2, 2)
+            assert User.query.get(2).shard == 1
+            babbel.db_session.remove()
+            rv = self.app.get(url, follow_redirects=True)
+            self.app.delete("/y/message/%d/" % json.loads(rv.data)[0]["id"], follow_redirects=True)
+            recover(shards[1])
+            self.assertRaises(RuntimeError, move_mailbox, urls, 2, 2)
+            rv = CliRunner().invoke(babbel.rebalance_command, ["--user", "y", "--shard", "2"], obj=script_info)
+            assert rv.exit_code == 0, rv.output
+            assert "Finished moving the mailbox of user 2 to shard 2 (2 messages)" in rv.output
+            assert "Moved 0 mailboxes" in rv.output
+
+            # Interrupted after the directory was changed, while a worker that has the source shard cached stores a
+            # message there
+            fail_on(shards[1], "DELETE ON mailboxes")
+            self.assertRaises(sqlite3.IntegrityError, move_mailbox, urls, 2, 1)
+            assert User.query.get(2).shard == 1
+            babbel.db_session.remove()
+            self.app.get("/y/unread/", follow_redirects=True)
+            babbel.user_cache.put("y", babbel.user_cache.get("y")._replace(shard=2))
+            self.app.post("/x/message/", data={"receiver": "y", "message": "Late"}, follow_redirects=True)
+            recover(shards[1])
+            assert [move[:2] for move in resume_mailbox_moves(urls)] == [(2, 1)]
+            babbel.user_cache.invalidate("y")
+
+            rv = self.app.get(url, follow_redirects=True)
+            assert [message["message"] for message in json.loads(rv.data)] == ["Test 1!", "Test 2!", "Late"]
+            assert json.loads(self.app.get("/y/unread/").data) == {"unread": 3}
+            for shard in shards:
+                with closing(sqlite3.connect(shard)) as connection:
+                    counts = [connection.execute("SELECT COUNT(*) FROM %s WHERE receiver_id = 2" % table).fetchone()[0]
+                              for table in ("messages", "mailboxes")]
+                assert counts == ([3, 1] if shard == shards[0] else [0, 0])
+            assert self.db_session.execute("SELECT COUNT(*) FROM mailbox_moves").scalar() == 0
+        finally:
+            babbel.app.config.pop("DATABASE_SHARDS")
+            self.db_session = setup_db()
+            for shard_fd, shard in zip(shard_fds, shards):
+                os.close(shard_fd)
+                os.unlink(shard)
+
 
 if __name__ == "__main__":
     unittest.main()
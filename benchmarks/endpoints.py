@@ -0,0 +1,277 @@
+# coding=utf-8
+"""
+Load test of the API endpoints and views. Seeds a database with users and messages, where a few users receive most of
+the messages, and then drives a mix of requests from several threads against the WSGI app in-process. Reports the
+throughput, the p50/p95/p99 latency and the number of SQL statements per request for each endpoint.
+Run from the repository root:
+python -m benchmarks.endpoints --users 1000 --messages 100000 --threads 8 --seconds 30 --output results.json
+Results written with --output can be compared with the results of another commit using --compare.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib import quote_plus
+
+import pytz
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import babbel
+from database import count_unread_messages
+from models import User, Message
+
+# Relative weights of the endpoints in the request mix
+ENDPOINTS = [
+    ("MessageResource.get", 20),
+    ("MessageResource.post", 20),
+    ("MessageResource.delete", 5),
+    ("MessageList.get new", 25),
+    ("MessageList.get range", 20),
+    ("views.index", 8),
+    ("views.db", 2),
+]
+
+# The SQL statements executed by each thread are attributed to the endpoint it is currently requesting
+current = threading.local()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if getattr(current, "statements", None) is not None:
+        current.statements += 1
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Dataset(object):
+    """
+    The seeded users and messages. Mailbox sizes follow a Zipf-like distribution: the receiver of each message is
+    drawn with a weight of 1 / rank ** skew.
+    """
+
+    def __init__(self, users, messages, skew, days):
+        self.usernames = ["user%d" % i for i in range(users)]
+        weights = [1.0 / (rank + 1) ** skew for rank in range(users)]
+        total = sum(weights)
+        self.cumulative = []
+        running = 0
+        for weight in weights:
+            running += weight / total
+            self.cumulative.append(running)
+        self.messages = messages
+        self.end = datetime.now(pytz.utc)
+        self.start = self.end - timedelta(days=days)
+        self.mailboxes = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def receiver(self):
+        """Draws a user index, favoring the users with large mailboxes."""
+        r = random.random()
+        low, high = 0, len(self.cumulative) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative[middle] < r:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def seed(self, db_session, batch_size=10000):
+        db_session.execute(User.__table__.insert(), [
+            {"username": username, "last_fetch": self.start, "last_read_id": 0} for username in self.usernames])
+        span = (self.end - self.start).total_seconds()
+        for offset in range(0, self.messages, batch_size):
+            rows = []
+            for i in range(offset, min(offset + batch_size, self.messages)):
+                receiver = self.receiver()
+                rows.append({"sender_id": random.randint(1, len(self.usernames)), "receiver_id": receiver + 1,
+                             "message": "Message %d" % i,
+                             "timestamp": self.start + timedelta(seconds=span * i / self.messages)})
+                self.mailboxes[receiver].append(i + 1)
+            db_session.execute(Message.__table__.insert(), rows)
+        count_unread_messages(db_session.connection())
+        db_session.commit()
+
+    def message_id(self, receiver, remove=False):
+        with self.lock:
+            mailbox = self.mailboxes[receiver]
+            if not mailbox:
+                return None
+            index = random.randrange(len(mailbox))
+            if remove:
+                mailbox[index] = mailbox[-1]
+                return mailbox.pop()
+            return mailbox[index]
+
+
+def request(client, endpoint, dataset):
+    """Sends one request to an endpoint and returns the response."""
+    receiver = dataset.receiver()
+    username = dataset.usernames[receiver]
+
+    if endpoint == "MessageResource.get":
+        msg_id = dataset.message_id(receiver) or 0
+        return client.get("/%s/message/%d/" % (username, msg_id))
+    if endpoint == "MessageResource.post":
+        sender = random.choice(dataset.usernames)
+        return client.post("/%s/message/" % sender, data={"receiver": username, "message": "Benchmark"})
+    if endpoint == "MessageResource.delete":
+        ids = [msg_id for msg_id in (dataset.message_id(receiver, remove=True) for _ in range(5)) if msg_id]
+        return client.delete("/%s/message/" % username, data=json.dumps({"ids": ids}),
+                             headers={"Content-Type": "application/json"})
+    if endpoint == "MessageList.get new":
+        return client.get("/%s/messages/" % username)
+    if endpoint == "MessageList.get range":
+        span = (dataset.end - dataset.start).total_seconds()
+        start = dataset.start + timedelta(seconds=random.uniform(0, span))
+        end = start + timedelta(seconds=span / 30)
+        return client.get("/%s/messages/?start=%s&end=%s" % (username, quote_plus(start.isoformat()),
+                                                              quote_plus(end.isoformat())))
+    if endpoint == "views.index":
+        return client.get("/%s/" % username)
+    if endpoint == "views.db":
+        return client.get("/db/")
+    raise ValueError(endpoint)
+
+
+def run(dataset, endpoints, threads, seconds):
+    """
+    Sends requests from several threads until the time is up.
+    :return: a dict from endpoint to a list of (latency in seconds, SQL statements, status code) tuples
+    """
+    names = [name for name, weight in endpoints]
+    cumulative = []
+    running = 0
+    for name, weight in endpoints:
+        running += weight
+        cumulative.append(running)
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def work():
+        client = babbel.app.test_client()
+        own = defaultdict(list)
+        while time.time() < deadline:
+            r = random.uniform(0, running)
+            endpoint = names[next(i for i, value in enumerate(cumulative) if r <= value)]
+            current.statements = 0
+            started = time.time()
+            response = request(client, endpoint, dataset)
+            response.get_data()  # Streamed responses are only generated when read
+            own[endpoint].append((time.time() - started, current.statements, response.status_code))
+            current.statements = None
+        with lock:
+            for endpoint, values in own.items():
+                samples[endpoint].extend(values)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples
+
+
+def summarize(samples, seconds):
+    results = {}
+    for endpoint, values in samples.items():
+        latencies = sorted(latency for latency, statements, status in values)
+        statuses = defaultdict(int)
+        for latency, statements, status in values:
+            statuses[str(status)] += 1
+        results[endpoint] = {
+            "requests": len(values),
+            "throughput": len(values) / float(seconds),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "queries_per_request": sum(statements for latency, statements, status in values) / float(len(values)),
+            "statuses": dict(statuses),
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--users", type=int, default=200)
+    argparser.add_argument("--messages", type=int, default=20000)
+    argparser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the mailbox sizes")
+    argparser.add_argument("--days", type=int, default=30, help="the seeded messages are spread over this many days")
+    argparser.add_argument("--threads", type=int, default=8)
+    argparser.add_argument("--seconds", type=float, default=10)
+    argparser.add_argument("--profile", default="default", help="the DATABASE_PROFILE to use")
+    argparser.add_argument("--group-commit", type=float, metavar="WINDOW_MS",
+                           help="enable GROUP_COMMIT with this batch window in milliseconds")
+    argparser.add_argument("--endpoints", nargs="+", choices=[name for name, weight in ENDPOINTS],
+                           help="only request these endpoints")
+    argparser.add_argument("--output", help="write the results to this file as JSON")
+    argparser.add_argument("--compare", help="compare with the results in this file, written by --output")
+    args = argparser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    babbel.app.config["TESTING"] = True
+    babbel.app.config["DATABASE"] = "sqlite:///%s" % filename
+    babbel.app.config["DATABASE_PROFILE"] = args.profile
+    babbel.app.config["METRICS_DIR"] = None
+    if args.group_commit is not None:
+        babbel.app.config["GROUP_COMMIT"] = True
+        babbel.app.config["GROUP_COMMIT_WINDOW_MS"] = args.group_commit
+    babbel.app.logger.disabled = True
+    try:
+        # The first request runs setup_db through before_first_request, creating the tables
+        babbel.app.test_client().get("/dates/")
+        dataset = Dataset(args.users, args.messages, args.skew, args.days)
+        dataset.seed(babbel.db_session)
+        babbel.db_session.remove()
+
+        endpoints = [(name, weight) for name, weight in ENDPOINTS if not args.endpoints or name in args.endpoints]
+        results = summarize(run(dataset, endpoints, args.threads, args.seconds), args.seconds)
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(filename + suffix):
+                os.unlink(filename + suffix)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["endpoints"]
+
+    print "%-24s %8s %9s %9s %9s %9s %8s" % ("endpoint", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries", "vs p95")
+    for endpoint, weight in ENDPOINTS:
+        if endpoint not in results:
+            continue
+        result = results[endpoint]
+        change = ""
+        if endpoint in previous:
+            change = "%+.0f%%" % ((result["p95_ms"] / previous[endpoint]["p95_ms"] - 1) * 100)
+        print "%-24s %8.1f %9.2f %9.2f %9.2f %9.1f %8s" % (endpoint, result["throughput"], result["p50_ms"],
+                                                           result["p95_ms"], result["p99_ms"],
+                                                           result["queries_per_request"], change)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "args": vars(args), "endpoints": results}, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# coding=utf-8
+"""
+Measures the concurrent read/write throughput of the database engine profiles in database.DATABASE_PROFILES.
+Reader threads fetch messages like MessageList does and writer threads store one message per transaction like
+MessageResource.post does, all against the same database file.
+Run from the repository root:
+python -m benchmarks.engine_profiles --threads 8 --writers 2 --seconds 10
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import pytz
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, DATABASE_PROFILES, create_db_engine
+from models import User, Message
+
+
+def seed(engine, users, messages):
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"username": "user%d" % i, "last_fetch": datetime.now(pytz.utc), "last_read_id": 0} for i in range(users)])
+        connection.execute(Message.__table__.insert(), [
+            {"sender_id": random.randint(1, users), "receiver_id": random.randint(1, users),
+             "message": "Message %d" % i, "timestamp": datetime.now(pytz.utc)} for i in range(messages)])
+
+
+def run_profile(profile, threads, writers, seconds, users, messages):
+    """
+    Runs the benchmark against a new database file.
+    :return: a dict with the number of reads, writes and errors per second
+    """
+    fd, filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = create_db_engine("sqlite:///%s" % filename, profile, pool_size=threads)
+    Base.metadata.create_all(bind=engine)
+    seed(engine, users, messages)
+    Session = sessionmaker(bind=engine)
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def work(writer):
+        session = Session()
+        done = {"reads": 0, "writes": 0, "errors": 0}
+        while time.time() < deadline:
+            receiver_id = random.randint(1, users)
+            try:
+                if writer:
+                    session.execute(Message.__table__.insert(), {
+                        "sender_id": random.randint(1, users), "receiver_id": receiver_id, "message": "Benchmark",
+                        "timestamp": datetime.now(pytz.utc)})
+                    session.commit()
+                    done["writes"] += 1
+                else:
+                    session.query(Message.id, User.username, Message.message, Message.timestamp) \
+                        .join(User, Message.sender_id == User.id) \
+                        .filter(Message.receiver_id == receiver_id).order_by(Message.id).all()
+                    session.commit()
+                    done["reads"] += 1
+            except OperationalError:  # "database is locked"
+                session.rollback()
+                done["errors"] += 1
+        session.close()
+        with lock:
+            for key in counts:
+                counts[key] += done[key]
+
+    workers = [threading.Thread(target=work, args=(i < writers,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(filename + suffix):
+            os.unlink(filename + suffix)
+
+    return dict((key, value / float(seconds)) for key, value in counts.items())
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--profiles", nargs="+", default=sorted(DATABASE_PROFILES),
+                           choices=sorted(DATABASE_PROFILES))
+    argparser.add_argument("--threads", type=int, default=8, help="number of threads, readers and writers")
+    argparser.add_argument("--writers", type=int, default=2, help="how many of the threads write")
+    argparser.add_argument("--seconds", type=float, default=10, help="duration of each run")
+    argparser.add_argument("--users", type=int, default=100)
+    argparser.add_argument("--messages", type=int, default=20000)
+    argparser.add_argument("--output", help="write the results to this file as JSON")
+    args = argparser.parse_args()
+
+    results = {}
+    print "%-12s %12s %12s %12s" % ("profile", "reads/s", "writes/s", "errors/s")
+    for profile in args.profiles:
+        results[profile] = run_profile(profile, args.threads, args.writers, args.seconds, args.users, args.messages)
+        print "%-12s %12.1f %12.1f %12.1f" % (profile, results[profile]["reads"], results[profile]["writes"],
+                                              results[profile]["errors"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
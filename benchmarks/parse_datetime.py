@@ -0,0 +1,38 @@
+# coding=utf-8
+"""
+Compares the time it takes to parse the "start" and "end" parameters of MessageList with dateutil, with the ISO 8601
+fast path and with the memo cache of babbel.parse_datetime.
+Run from the repository root:
+python -m benchmarks.parse_datetime
+"""
+import argparse
+import timeit
+
+from dateutil import parser
+
+import babbel
+from timestamps import parse_iso8601
+
+VALUE = "2016-10-08T16:17:25.735955+00:00"
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--number", type=int, default=100000, help="number of parses per measurement")
+    args = argparser.parse_args()
+
+    candidates = [
+        ("dateutil", lambda: parser.parse(VALUE)),
+        ("fast path", lambda: parse_iso8601(VALUE)),
+        ("memo cache", lambda: babbel.parse_datetime(VALUE)),
+    ]
+    baseline = None
+    print "%-12s %12s %9s" % ("parser", "us/parse", "speedup")
+    for name, function in candidates:
+        seconds = min(timeit.repeat(function, number=args.number, repeat=3))
+        baseline = baseline or seconds
+        print "%-12s %12.2f %8.1fx" % (name, seconds / args.number * 1e6, baseline / seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+# coding=utf-8
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import pytz
+
+# Invalidation files are truncated when they grow larger than this, see LRUCache.invalidate()
+INVALIDATION_FILE_MAXSIZE = 4096
+
+# The approximate memory used by a cached message list besides its body, in bytes
+RANGE_CACHE_ENTRY_OVERHEAD = 500
+
+RANGE_CACHE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# The user data that is cached. Users are looked up on every request, but their ids and names never change in practice,
+# their shards only change when the rebalance command moves their mailboxes, and archived only changes when their
+# messages are first archived, both of which invalidate them.
+CachedUser = namedtuple("CachedUser", ["id", "username", "shard", "archived"])
+
+
+class LRUCache(object):
+    """
+    A thread safe, bounded cache that evicts the least recently used entries, and optionally expires entries after a
+    time to live. Counts hits, misses and evictions so that the cache can be sized. By default the size of the cache is
+    the number of entries, but it can also be measured with a sizeof function, e.g. in bytes.
+    Each worker process has its own cache. To invalidate entries in all worker processes, the caches can share an
+    invalidation file: invalidate() appends a byte to it, and a cache that sees the file change clears itself, checking
+    at most every check_interval seconds.
+    """
+
+    def __init__(self, maxsize, ttl=None, invalidation_file=None, check_interval=1.0, sizeof=None):
+        """
+        :param maxsize: the maximum number of entries, or the maximum total size if sizeof is given
+        :param ttl: the number of seconds after which an entry expires, or None if entries never expire
+        :param invalidation_file: the path of the invalidation file shared with other processes, or None
+        :param check_interval: how often, in seconds, the invalidation file is checked
+        :param sizeof: a function returning the size of a value. Values larger than maxsize are not cached.
+        """
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.size = 0
+        self.ttl = ttl
+        self.invalidation_file = invalidation_file
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.next_check = 0
+        self.file_state = self.get_file_state()
+
+    def get_file_state(self):
+        if self.invalidation_file is None:
+            return None
+        try:
+            stat = os.stat(self.invalidation_file)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def check_invalidation_file(self):
+        """Clears the cache if another process has invalidated entries. Must be called with the lock held."""
+        if self.invalidation_file is None or time.time() < self.next_check:
+            return
+        self.next_check = time.time() + self.check_interval
+        file_state = self.get_file_state()
+        if file_state != self.file_state:
+            self.file_state = file_state
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key, default=None):
+        """
+        :param key: the key to look up
+        :param default: the value to return if the key is not cached
+        :return: the cached value, or default
+        """
+        with self.lock:
+            self.check_invalidation_file()
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return default
+            # Reinserting moves the entry to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches a value, evicting the least recently used entry if the cache is full.
+        """
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.sizeof is not None else 1
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+            if size > self.maxsize:
+                return
+            self.entries[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.maxsize:
+                self.size -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes an entry from the cache in this process, and clears the caches sharing the invalidation file in all
+        other processes.
+        :param key: the key to remove, or None to clear the whole cache
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[2]
+        self.touch_invalidation_file()
+
+    def invalidate_matching(self, predicate, shared=True):
+        """
+        Removes the entries whose values match a predicate from the cache in this process, and clears the caches
+        sharing the invalidation file in all other processes. Takes time proportional to the number of entries.
+        :param predicate: a function that is called with each cached value
+        :param shared: whether to clear the caches of other processes. If the removed entries can't be looked up
+        anymore anyway, they only take up space there until they are evicted.
+        """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if predicate(entry[0]):
+                    del self.entries[key]
+                    self.size -= entry[2]
+        if shared:
+            self.touch_invalidation_file()
+
+    def touch_invalidation_file(self):
+        """
+        Appends to the invalidation file, so that the caches of other processes clear themselves. If no other process
+        has touched the file since this cache last checked it, this cache does not clear itself.
+        """
+        if self.invalidation_file is None:
+            return
+        with self.lock:
+            fd = os.open(self.invalidation_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                stat = os.fstat(fd)
+                unchanged = (stat.st_mtime, stat.st_size) == self.file_state
+                size = stat.st_size
+                if size >= INVALIDATION_FILE_MAXSIZE:
+                    os.ftruncate(fd, 0)
+                    size = 0
+                os.write(fd, "\n")
+                stat = os.fstat(fd)
+                if unchanged and stat.st_size == size + 1:
+                    self.file_state = stat.st_mtime, stat.st_size
+            finally:
+                os.close(fd)
+
+    def stats(self):
+        """
+        :return: a dict with the number of hits, misses and evictions, the current size and the maximum size
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": self.size, "maxsize": self.maxsize}
+
+
+def range_cache_key(receiver_id, start, end, etag, *extra):
+    """
+    :param receiver_id: the id of the receiving user
+    :param start: the start of the range, as the query compares it, see babbel.compared_timestamp()
+    :param end: the end of the range, as the query compares it
+    :param etag: the ETag of the receiver's date ranges, see babbel.range_etag(). It changes whenever messages of the
+    receiver are deleted or the names of their senders change, so that entries from before are not found anymore, in
+    any process, but not when messages are stored.
+    :param extra: other values that the cached response depends on, such as the page size
+    :return: a string key for a range cache
+    """
+    return "|".join(["%d" % receiver_id, format_range_timestamp(start), format_range_timestamp(end), etag] +
+                    [u"%s" % value for value in extra])
+
+
+def format_range_timestamp(value):
+    """Formats an aware datetime in UTC, so that the strings sort like the datetimes."""
+    return value.astimezone(pytz.utc).strftime(RANGE_CACHE_TIMESTAMP_FORMAT)
+
+
+class MemoryRangeCache(object):
+    """
+    Caches the responses of message lists for date ranges that have ended, in the memory of each worker process.
+    The keys include the range ETag, so the ranges cached before messages were deleted are not used by any process
+    afterwards. Deleting messages removes them from this process right away, and from the others as they are evicted.
+    Clearing the cache clears the range caches of all other processes sharing the invalidation file.
+    Usage: on a miss, take a token() before querying the messages and pass it to put(). If messages of the receiver are
+    deleted in the meantime, put() does nothing, so that a list that includes them is not cached.
+    """
+
+    def __init__(self, maxsize, invalidation_file=None, check_interval=1.0):
+        """
+        :param maxsize: the maximum total size of the cached responses, in bytes
+        :param invalidation_file: the path of the invalidation file shared with other processes, or None
+        :param check_interval: how often, in seconds, the invalidation file is checked
+        """
+        self.cache = LRUCache(maxsize, invalidation_file=invalidation_file, check_interval=check_interval,
+                              sizeof=lambda value: len(value[3]) + RANGE_CACHE_ENTRY_OVERHEAD)
+        self.lock = threading.Lock()
+        self.generations = {}
+
+    def get(self, key):
+        """
+        :param key: a key from range_cache_key()
+        :return: a tuple of the cached response body and next cursor, or None
+        """
+        value = self.cache.get(key)
+        return value[3:] if value is not None else None
+
+    def token(self, receiver_id):
+        """
+        :param receiver_id: the id of the receiving user
+        :return: an opaque token to be passed to put()
+        """
+        with self.lock:
+            return self.generations.get(receiver_id, 0), self.cache.get_file_state()
+
+    def put(self, token, key, receiver_id, start, end, body, next_cursor):
+        """
+        Caches the response for a range, unless messages of the receiver have been deleted since the token was taken.
+        :param token: a token from token(), taken before the messages were queried
+        :param key: a key from range_cache_key()
+        :param receiver_id: the id of the receiving user
+        :param start: the aware start datetime of the range
+        :param end: the aware end datetime of the range
+        :param body: the response body
+        :param next_cursor: the X-Next-Cursor header of the response, or None
+        """
+        with self.lock:
+            if token == (self.generations.get(receiver_id, 0), self.cache.get_file_state()):
+                self.cache.put(key, (receiver_id, start, end, body, next_cursor))
+
+    def invalidate(self, receiver_id, timestamps):
+        """
+        Removes the cached ranges of a receiver that contain any of the given timestamps from this process. Call this
+        after the messages with those timestamps have been deleted.
+        :param receiver_id: the id of the receiving user
+        :param timestamps: the aware timestamps of the deleted messages
+        """
+        def matches(value):
+            return value[0] == receiver_id and any(value[1] <= timestamp <= value[2] for timestamp in timestamps)
+
+        with self.lock:
+            self.generations[receiver_id] = self.generations.get(receiver_id, 0) + 1
+            self.cache.invalidate_matching(matches, shared=False)
+
+    def clear(self):
+        """Clears the range caches of all processes, e.g. after messages have been loaded into past date ranges."""
+        with self.lock:
+            self.cache.invalidate()
+
+    def stats(self):
+        """
+        :return: a dict with the number of hits, misses and evictions, the current size and the maximum size in bytes
+        """
+        return self.cache.stats()
+
+
+class SQLiteRangeCache(object):
+    """
+    Caches the responses of message lists for date ranges that have ended in an SQLite database file, which all worker
+    processes on the machine share. Entries are evicted in least recently used order when the total size of the cached
+    responses exceeds the maximum size. Deleting messages removes the cached ranges that contain them, in all
+    processes at once.
+    The usage is the same as for MemoryRangeCache.
+    """
+
+    def __init__(self, path, maxsize):
+        """
+        :param path: the path of the database file
+        :param maxsize: the maximum total size of the cached responses, in bytes
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        connection = self.connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, receiver_id INTEGER NOT NULL, "
+                           "start TEXT NOT NULL, end TEXT NOT NULL, body BLOB NOT NULL, next_cursor TEXT, "
+                           "size INTEGER NOT NULL, used REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_entries_receiver_start ON entries (receiver_id, start)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)")
+        connection.execute("CREATE TABLE IF NOT EXISTS generations (receiver_id INTEGER PRIMARY KEY, "
+                           "generation INTEGER NOT NULL)")
+
+    def connection(self):
+        """
+        :return: the connection of the current thread, in autocommit mode
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.text_factory = str
+            # A cache does not need to survive a crash of the machine
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Runs the with block in a write transaction of the current thread's connection, which it yields."""
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def get(self, key):
+        connection = self.connection()
+        row = connection.execute("SELECT body, next_cursor, used FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        now = time.time()
+        # Recording every use would make each hit a write
+        if row[2] < now - 1:
+            connection.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        return str(row[0]), row[1]
+
+    def token(self, receiver_id):
+        # The generation of receiver 0 changes when the whole cache is cleared
+        return self.connection().execute("SELECT COALESCE(SUM(generation), 0) FROM generations "
+                                         "WHERE receiver_id IN (?, 0)", (receiver_id,)).fetchone()[0]
+
+    def put(self, token, key, receiver_id, start, end, body, next_cursor):
+        size = len(body) + RANGE_CACHE_ENTRY_OVERHEAD
+        if size > self.maxsize:
+            return
+        with self.transaction() as connection:
+            if self.token(receiver_id) != token:
+                return
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, receiver_id, format_range_timestamp(start), format_range_timestamp(end),
+                                sqlite3.Binary(body), next_cursor, size, time.time()))
+            excess = connection.execute("SELECT SUM(size) FROM entries").fetchone()[0] - self.maxsize
+            if excess > 0:
+                evicted = []
+                for evicted_key, evicted_size in connection.execute("SELECT key, size FROM entries ORDER BY used"):
+                    evicted.append((evicted_key,))
+                    excess -= evicted_size
+                    if excess <= 0:
+                        break
+                connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+                self.evictions += len(evicted)
+
+    def invalidate(self, receiver_id, timestamps):
+        with self.transaction() as connection:
+            connection.executemany("DELETE FROM entries WHERE receiver_id = ? AND start <= ? AND end >= ?",
+                                   [(receiver_id, timestamp, timestamp)
+                                    for timestamp in set(format_range_timestamp(t) for t in timestamps)])
+            connection.execute("INSERT OR REPLACE INTO generations VALUES "
+                               "(?, COALESCE((SELECT generation FROM generations WHERE receiver_id = ?), 0) + 1)",
+                               (receiver_id, receiver_id))
+
+    def clear(self):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("INSERT OR REPLACE INTO generations VALUES "
+                               "(0, COALESCE((SELECT generation FROM generations WHERE receiver_id = 0), 0) + 1)")
+
+    def stats(self):
+        size = self.connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": size,
+                "maxsize": self.maxsize}
@@ -1,11 +1,671 @@
 # coding=utf-8
+import csv
+import json
+from contextlib import contextmanager
 from datetime import datetime
 
 import pytz
+from dateutil import parser
+import sqlite3
+from sqlalchemy import bindparam, case, create_engine, event, func, inspect, select
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+from timestamps import parse_iso8601
 
 Base = declarative_base()
 
+# Engine settings, selected by name with the DATABASE_PROFILE config value.
+# "default" leaves SQLite and SQLAlchemy at their defaults: a rollback journal and a new connection for every session.
+# "production" is meant for several worker processes and threads sharing one database file. The write-ahead log lets
+# readers and a writer work concurrently, synchronous=NORMAL only syncs the log at checkpoints (committed
+# transactions survive a crash of the application, but not necessarily a power loss), writers wait for the lock for
+# busy_timeout milliseconds instead of failing with "database is locked", and pooled connections keep their page
+# cache and memory map between requests.
+DATABASE_PROFILES = {
+    "default": {
+        "pragmas": [],
+    },
+    "production": {
+        "pragmas": [
+            ("journal_mode", "WAL"),
+            ("synchronous", "NORMAL"),
+            ("busy_timeout", 5000),
+            ("mmap_size", 256 * 1024 * 1024),
+            ("cache_size", -64 * 1024),  # Negative values are in KiB
+        ],
+        "poolclass": QueuePool,
+        "pool_size": 4,
+        "max_overflow": 4,
+    },
+}
+
+
+def create_db_engine(url, profile="default", pool_size=None, pragmas=None):
+    """
+    Creates the database engine, with the settings of a profile from DATABASE_PROFILES.
+    :param url: the database URL
+    :param profile: the name of the profile
+    :param pool_size: overrides the number of pooled connections of the profile, if it uses a pool
+    :param pragmas: a list of (name, value) tuples of additional pragmas to set on every connection
+    :return: the engine
+    """
+    settings = DATABASE_PROFILES[profile]
+    kwargs = {"convert_unicode": True}
+    if "poolclass" in settings:
+        kwargs["poolclass"] = settings["poolclass"]
+        kwargs["pool_size"] = pool_size or settings["pool_size"]
+        kwargs["max_overflow"] = settings["max_overflow"]
+        # Pooled connections are handed to whichever thread needs one
+        kwargs["connect_args"] = {"check_same_thread": False}
+    engine = create_engine(url, **kwargs)
+
+    all_pragmas = settings["pragmas"] + list(pragmas or [])
+    if all_pragmas:
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in all_pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+            cursor.close()
+
+    return engine
+
+
+def create_indexes(connection, table_name, *index_names):
+    """
+    Creates the named indexes of a table, as they are declared on the models, unless they already exist.
+    :param connection: the connection to issue the CREATE INDEX statements on
+    :param table_name: the name of the table that the indexes belong to
+    :param index_names: the names of the indexes to create
+    """
+    existing = set(index["name"] for index in inspect(connection).get_indexes(table_name))
+    for index in Base.metadata.tables[table_name].indexes:
+        if index.name in index_names and index.name not in existing:
+            print "Creating index %s on %s" % (index.name, table_name)
+            index.create(connection)
+
+
+def migration_1(connection):
+    """Adds the receiver indexes used by MessageList and by lookups of single messages."""
+    create_indexes(connection, "messages", "ix_messages_receiver_timestamp", "ix_messages_receiver_id")
+
+
+def migration_2(connection):
+    """
+    Adds the last_read_id high-water mark to users. It is set to the newest message each user received before their
+    last_fetch timestamp, which it replaces.
+    """
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "last_read_id" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN last_read_id INTEGER DEFAULT '0' NOT NULL")
+    connection.execute("UPDATE users SET last_read_id = COALESCE("
+                       "(SELECT MAX(messages.id) FROM messages "
+                       "WHERE messages.receiver_id = users.id AND messages.timestamp < users.last_fetch), 0)")
+
+
+def migration_3(connection):
+    """Adds the mailbox_version counter to users, from which the ETags of message responses are derived."""
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "mailbox_version" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN mailbox_version INTEGER DEFAULT '0' NOT NULL")
+
+
+def migration_4(connection):
+    """Adds the shard directory to users: the shard that each user's mailbox is on, initially the primary database."""
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "shard" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN shard INTEGER DEFAULT '0' NOT NULL")
+
+
+def count_unread_messages(connection, table="users", id_column="id"):
+    """
+    Sets the unread counts of all mailboxes in a table from the messages, e.g. after messages have been added without
+    updating them.
+    :param connection: the connection to the database of the messages
+    :param table: the table with the mailboxes, users or mailboxes
+    :param id_column: the column of the table with the ids of the receivers
+    """
+    connection.execute("UPDATE %(table)s SET unread_count = (SELECT COUNT(*) FROM messages "
+                       "WHERE messages.receiver_id = %(table)s.%(id)s AND messages.id > %(table)s.last_read_id)"
+                       % {"table": table, "id": id_column})
+
+
+def migration_5(connection):
+    """Adds the unread_count counter to users, counting the messages after their last_read_id."""
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "unread_count" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN unread_count INTEGER DEFAULT '0' NOT NULL")
+    count_unread_messages(connection)
+
+
+# The full-text index of the messages, see create_search_index. It is an external content table: it only holds the
+# index, and reads the text from the messages table. The receiver_id column is indexed as a token too, so that searches
+# can be restricted to one mailbox within the index, instead of filtering all matches of all mailboxes afterwards.
+# Archived messages stay in the index, with the same rowid: a message that is being archived is briefly in both tables,
+# and the triggers leave its index entry alone while the other table still has it.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "message, receiver_id, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, message, receiver_id) VALUES (new.id, new.message, new.receiver_id); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE id = old.id) BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, message, receiver_id) "
+    "VALUES ('delete', old.id, old.message, old.receiver_id); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, receiver_id ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, message, receiver_id) "
+    "VALUES ('delete', old.id, old.message, old.receiver_id); "
+    "INSERT INTO messages_fts (rowid, message, receiver_id) VALUES (new.id, new.message, new.receiver_id); END",
+]
+
+ARCHIVE_SEARCH_INDEX_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS messages_archive_fts_insert AFTER INSERT ON messages_archive "
+    "WHEN NOT EXISTS (SELECT 1 FROM messages WHERE id = new.id) BEGIN "
+    "INSERT INTO messages_fts (rowid, message, receiver_id) VALUES (new.id, new.message, new.receiver_id); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_archive_fts_delete AFTER DELETE ON messages_archive "
+    "WHEN NOT EXISTS (SELECT 1 FROM messages WHERE id = old.id) BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, message, receiver_id) "
+    "VALUES ('delete', old.id, old.message, old.receiver_id); END",
+]
+
+SEARCH_INDEX_TRIGGERS = ("messages_fts_insert", "messages_fts_delete", "messages_fts_update",
+                         "messages_archive_fts_insert", "messages_archive_fts_delete")
+
+
+def fts5_available(connection):
+    """:return: whether the SQLite library was compiled with the FTS5 full-text search extension"""
+    return any(option == "ENABLE_FTS5" for option, in connection.execute("PRAGMA compile_options"))
+
+
+def create_search_index(connection):
+    """
+    Creates the messages_fts full-text index of the messages and archived messages and the triggers that keep it up to
+    date, unless they already exist. Every message that is inserted, deleted, changed or archived afterwards, by the
+    app, the bulk loader or a mailbox move, is indexed in the same transaction. Messages that existed before are
+    indexed by rebuild_search_index, except for archived ones, which are indexed along with the triggers of the
+    messages_archive table, e.g. those of indexes from before archived messages were searchable.
+    Does nothing if SQLite lacks FTS5, in which case searching is disabled.
+    :param connection: the connection to the database of the messages
+    :return: whether the index exists
+    """
+    if not fts5_available(connection):
+        print "SQLite was compiled without FTS5, messages can't be searched"
+        return False
+    names = set(name for name, in connection.execute("SELECT name FROM sqlite_master"))
+    if "messages" not in names:
+        # The index is created along with the messages table, which is created after the archive
+        return False
+    index_archive = "messages_archive" in names and "messages_archive_fts_insert" not in names
+    if index_archive:
+        # The delete trigger of older indexes drops the entries of the messages that are archived
+        connection.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(statement)
+    if index_archive:
+        for statement in ARCHIVE_SEARCH_INDEX_DDL:
+            connection.execute(statement)
+        index_archived_messages(connection)
+    return True
+
+
+def index_archived_messages(connection):
+    """
+    Adds the archived messages that are missing from the full-text index to it. The 'rebuild' command of FTS5 only
+    reads the messages table.
+    :param connection: the connection to the database of the messages
+    """
+    connection.execute("INSERT INTO messages_fts (rowid, message, receiver_id) "
+                       "SELECT id, message, receiver_id FROM messages_archive "
+                       "WHERE id NOT IN (SELECT id FROM messages_fts_docsize)")
+
+
+def rebuild_search_index(connection):
+    """
+    Rebuilds the full-text index from all messages in the database, archived ones included, e.g. to index the messages
+    that existed before it was created. This takes the write lock of the database until it is done.
+    :param connection: the connection to the database of the messages
+    """
+    connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    index_archived_messages(connection)
+
+
+def migration_6(connection):
+    """
+    Adds the full-text index of the messages. It starts out empty, so that the migration doesn't hold up the app on a
+    large database: new messages are indexed right away, and the existing ones by the reindex command.
+    """
+    if create_search_index(connection) and connection.execute("SELECT 1 FROM messages LIMIT 1").scalar():
+        print "Run 'flask reindex' to make the existing messages searchable"
+
+
+def migration_7(connection):
+    """Adds the index of the messages between two users used by Conversation."""
+    create_indexes(connection, "messages", "ix_messages_sender_receiver_timestamp")
+
+
+def migration_8(connection):
+    """
+    Adds the retention_days policy and the archived flag to users. The messages_archive table is created like any new
+    table, and is empty until messages are archived.
+    """
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "retention_days" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN retention_days INTEGER")
+    if "archived" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN archived BOOLEAN DEFAULT '0' NOT NULL")
+
+
+def start_message_sequence(connection):
+    """
+    Starts the id sequence of the primary database after the ids that new messages have to stay above, unless it or the
+    sequence of a sharded database exists already, see allocate_message_ids.
+    :param connection: the connection to the primary database
+    """
+    if connection.execute("SELECT 1 FROM message_sequence").scalar() is None:
+        connection.execute("INSERT INTO message_sequence (id, last_id) VALUES (0, ?)", last_message_id(connection))
+
+
+def migration_9(connection):
+    """
+    Starts the id sequence of the primary database, which messages take their ids from instead of SQLite, so that the
+    id of the newest message is not handed out again after it has been deleted or archived.
+    """
+    start_message_sequence(connection)
+
+
+def migration_10(connection):
+    """Adds the archived messages to the full-text index, see create_search_index."""
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").scalar():
+        create_search_index(connection)
+
+
+def migration_11(connection):
+    """Adds the range_version counter to users, from which the ETags of date ranges that have ended are derived."""
+    columns = set(column["name"] for column in inspect(connection).get_columns("users"))
+    if "range_version" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN range_version INTEGER DEFAULT '0' NOT NULL")
+
+
+# Migrations are applied in order to bring an existing database up to date with the models. The index of a migration
+# in this list + 1 is the schema version it results in. New migrations must only ever be appended.
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+    migration_7,
+    migration_8,
+    migration_9,
+    migration_10,
+    migration_11,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").scalar()
+
+
+def set_schema_version(connection, version):
+    connection.execute("PRAGMA user_version = %d" % version)
+
+
+def migrate_db(engine, fresh=False):
+    """
+    Brings the schema of an existing database up to date by applying the migrations that have not been applied yet.
+    The schema version is kept in SQLite's user_version pragma.
+    :param engine: the engine of the database to be migrated
+    :param fresh: True if the tables were just created from the models, in which case the database is already up to
+    date and is only stamped with the current schema version
+    """
+    with engine.begin() as connection:
+        if fresh:
+            set_schema_version(connection, SCHEMA_VERSION)
+            start_message_sequence(connection)
+            return
+
+        version = get_schema_version(connection)
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            print "Migrating database to schema version %d" % number
+            migration(connection)
+            set_schema_version(connection, number)
+
+
+# Message ids are unique across all shards, since shard n only assigns ids that leave a remainder of n when divided by
+# this number. It is therefore also the maximum number of shards.
+SHARD_ID_STRIDE = 1024
+
+
+def create_tables(engine, tables=None):
+    """
+    Creates the tables of the models that don't exist yet. A database file without tables is set up for incremental
+    vacuuming first, which can only be done before the first table is created, so that archive_old_messages can hand
+    the pages freed by archiving back to the file system.
+    :param engine: the engine of the database
+    :param tables: the tables to create, all of them by default
+    :return: whether the database had no tables before
+    """
+    with engine.begin() as connection:
+        fresh = not inspect(connection).get_table_names()
+        if fresh:
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        Base.metadata.create_all(bind=connection, tables=tables)
+    return fresh
+
+
+def incremental_vacuum(engine, step=1000):
+    """
+    Returns the free pages of a database to the file system, e.g. after messages have been archived, step pages per
+    transaction so that writers don't have to wait long. Does nothing unless the database was created for incremental
+    vacuuming, see create_tables. Older databases can be converted once, while the app is stopped, with
+    "PRAGMA auto_vacuum = INCREMENTAL; VACUUM;".
+    :param engine: the engine of the database
+    :param step: the number of pages to free per transaction
+    :return: the number of pages freed
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        freed = 0
+        while True:
+            free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return freed
+            # Every step of the statement frees one page, so it has to be read to the end
+            cursor.execute("PRAGMA incremental_vacuum(%d)" % step).fetchall()
+            connection.commit()
+            freed += min(free, step)
+    finally:
+        connection.close()
+
+
+def attach_directory(engine, directory_url):
+    """
+    Attaches the primary database to every connection of a shard's engine, under the name "directory". SQLite looks up
+    tables that a shard doesn't have, i.e. users, in attached databases, so queries joining messages with their senders
+    work on a shard as they do on the primary database.
+    :param engine: the engine of the shard
+    :param directory_url: the URL of the primary database, which must be an SQLite file
+    """
+    path = make_url(directory_url).database
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS directory", (path,))
+
+
+def create_shard_tables(urls):
+    """
+    Creates the messages, messages_archive, mailboxes and message_sequence tables, indexes and full-text indexes of the
+    shards that don't have them yet, and advances the id sequence of each shard past the ids of all existing messages,
+    e.g. those of a database that was not sharded before. Uses connections of its own, since the primary database's
+    tables would be found through the "directory" database attached to the connections of the app.
+    :param urls: the URLs of all shards, starting with the primary database
+    """
+    from models import ArchivedMessage, Mailbox, Message, MessageSequence, User
+
+    engines = [create_engine(url) for url in urls]
+    try:
+        for shard, engine in enumerate(engines):
+            create_tables(engine, [Message.__table__, ArchivedMessage.__table__, Mailbox.__table__,
+                                   MessageSequence.__table__])
+            with engine.begin() as connection:
+                create_indexes(connection, Message.__tablename__, *[index.name for index in Message.__table__.indexes])
+                create_search_index(connection)
+                columns = set(column["name"] for column in inspect(connection).get_columns(Mailbox.__tablename__))
+                if shard != 0 and "unread_count" not in columns:
+                    # Shards from before the last_read_id and unread count of their mailboxes moved to them
+                    print "Moving last_read_id to the mailboxes of shard %d" % shard
+                    connection.execute("ALTER TABLE mailboxes ADD COLUMN last_read_id INTEGER DEFAULT '0' NOT NULL")
+                    connection.execute("ALTER TABLE mailboxes ADD COLUMN unread_count INTEGER DEFAULT '0' NOT NULL")
+                    marks = engines[0].execute(select([User.id, User.last_read_id]).where(User.shard == shard))
+                    for chunk in batches(marks, 500):
+                        connection.execute(Mailbox.__table__.update().where(
+                            Mailbox.receiver_id == bindparam("user_id")).values(last_read_id=bindparam("mark")),
+                            [{"user_id": user_id, "mark": mark} for user_id, mark in chunk])
+                    count_unread_messages(connection, "mailboxes", "receiver_id")
+                if shard != 0 and "range_version" not in columns:
+                    connection.execute("ALTER TABLE mailboxes ADD COLUMN range_version INTEGER DEFAULT '0' NOT NULL")
+
+        sequence = MessageSequence.__table__
+        max_id = max(engine.execute(select([func.max(model.id)])).scalar() or 0
+                     for engine in engines for model in (Message, ArchivedMessage))
+        # The ids that the primary database handed out before it was sharded, see allocate_message_ids
+        max_id = max(max_id, engines[0].execute(select([sequence.c.last_id]).where(sequence.c.id == 0)).scalar() or 0)
+        for engine in engines:
+            with engine.begin() as connection:
+                connection.execute(sequence.delete().where(sequence.c.id == 0))
+                if connection.execute(select([sequence.c.last_id])).scalar() is None:
+                    connection.execute(sequence.insert(), {"id": 1, "last_id": max_id // SHARD_ID_STRIDE})
+                else:
+                    connection.execute(sequence.update().where(sequence.c.last_id < max_id // SHARD_ID_STRIDE)
+                                       .values(last_id=max_id // SHARD_ID_STRIDE))
+    finally:
+        for engine in engines:
+            engine.dispose()
+
+
+def last_message_id(connection):
+    """
+    :param connection: a connection to the primary database
+    :return: the highest id of the messages, the archived messages and the last_read_ids, which may belong to messages
+    that are gone already. New messages must get higher ids, or they would never be delivered as new.
+    """
+    return connection.execute("SELECT MAX((SELECT COALESCE(MAX(id), 0) FROM messages), "
+                              "(SELECT COALESCE(MAX(id), 0) FROM messages_archive), "
+                              "(SELECT COALESCE(MAX(last_read_id), 0) FROM users))").scalar()
+
+
+def allocate_message_ids(session, shard, count):
+    """
+    Takes message ids from the id sequence of a shard, or of the primary database if the messages are not sharded.
+    SQLite would hand out the id of the newest message again once it is deleted or archived. Other transactions have to
+    wait for this one to end before they can take ids, and if it is rolled back, the same ids are handed out again.
+    :param session: the session of the shard, in the transaction that inserts the messages
+    :param shard: the number of the shard, or None if the messages are not sharded
+    :param count: the number of ids to take
+    :return: a list of increasing ids
+    """
+    from models import Message, MessageSequence
+
+    sequence = MessageSequence.__table__
+    if shard is None:
+        # The primary database counts plain ids in row 0 until it is sharded, see create_shard_tables. The sequence
+        # skips the messages stored without it, e.g. by populate_db, at the cost of looking up the last rowid.
+        highest = select([func.coalesce(func.max(Message.id), 0)]).as_scalar()
+        session.execute(sequence.update().where(sequence.c.id == 0).values(
+            last_id=func.max(sequence.c.last_id, highest) + count))
+        last = session.execute(select([sequence.c.last_id]).where(sequence.c.id == 0)).scalar()
+        return range(last - count + 1, last + 1)
+
+    session.execute(sequence.update().values(last_id=sequence.c.last_id + count))
+    last = session.execute(select([sequence.c.last_id])).scalar()
+    return [sequence_number * SHARD_ID_STRIDE + shard for sequence_number in range(last - count + 1, last + 1)]
+
+
+@contextmanager
+def transaction(connection, immediate=True):
+    """
+    Runs the with block in a transaction of an sqlite3 connection without an isolation level.
+    :param connection: the connection
+    :param immediate: whether to take the write locks of the main and all attached databases right away. Otherwise
+    they are taken by the first statement that writes to each of them.
+    """
+    connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def connect_shards(urls):
+    """
+    :param urls: the URLs of all shards, starting with the primary database
+    :return: a tuple of the paths of the shards' files and an sqlite3 connection to each of them. Without an isolation
+    level, sqlite3 leaves transactions to the statements run on them.
+    """
+    paths = [make_url(url).database for url in urls]
+    return paths, [sqlite3.connect(path, timeout=30, isolation_level=None) for path in paths]
+
+
+def move_mailbox(urls, receiver_id, target):
+    """
+    Moves the messages of a user to another shard, keeping their ids, and updates the user's shard in the directory.
+    The move is made of several transactions that each write to a single database, since SQLite doesn't commit a
+    transaction across databases atomically in WAL mode. It is recorded in the mailbox_moves table of the primary
+    database first, and if it is interrupted, resume_mailbox_moves() finishes it. See transfer_mailbox for the steps.
+    :param urls: the URLs of all shards, starting with the primary database
+    :param receiver_id: the id of the user
+    :param target: the number of the shard to move the messages to
+    :return: the number of messages moved, or None if the mailbox already is on the target shard
+    """
+    paths, connections = connect_shards(urls)
+    try:
+        directory = connections[0]
+        source = directory.execute("SELECT shard FROM users WHERE id = ?", (receiver_id,)).fetchone()[0]
+        if source == target:
+            return None
+        with transaction(directory):
+            if directory.execute("SELECT 1 FROM mailbox_moves WHERE receiver_id = ?", (receiver_id,)).fetchone():
+                raise RuntimeError("The mailbox of user %d is being moved already, or its move was interrupted and "
+                                   "has to be resumed" % receiver_id)
+            directory.execute("INSERT INTO mailbox_moves (receiver_id, source, target) VALUES (?, ?, ?)",
+                              (receiver_id, source, target))
+        return transfer_mailbox(paths, connections, receiver_id, source, target)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def resume_mailbox_moves(urls):
+    """
+    Finishes the moves of mailboxes that were interrupted, e.g. by a crash.
+    :param urls: the URLs of all shards, starting with the primary database
+    :return: a list of (user id, target shard, number of messages moved) tuples
+    """
+    paths, connections = connect_shards(urls)
+    try:
+        moves = connections[0].execute("SELECT receiver_id, source, target FROM mailbox_moves").fetchall()
+        return [(receiver_id, target, transfer_mailbox(paths, connections, receiver_id, source, target))
+                for receiver_id, source, target in moves]
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def transfer_mailbox(paths, connections, receiver_id, source, target):
+    """
+    Moves a mailbox as recorded in mailbox_moves, in steps that each commit to one database:
+    1. The messages are copied to the target shard, while they can still change on the source shard.
+    2. The source shard is locked, so that no messages can be stored or deleted there until the move is done.
+    3. The copy is brought up to date, and the target shard takes over the mailbox: its versions are changed, its
+       last_read_id and unread count are moved along, and the id sequence of the target shard is advanced past the
+       moved ids, so that new messages to the user still get higher ids than the ones they have read.
+    4. The directory is changed to the target shard.
+    5. The messages and the mailbox are deleted from the source shard, which unlocks it. Requests that have the old
+       shard cached can't store or delete messages there afterwards, since the mailbox's version is gone from it, and
+       retry on the new shard.
+    6. The move is removed from mailbox_moves.
+    If the move was interrupted before the directory was changed, it starts over, otherwise it continues with step 5,
+    copying any messages that were stored on the source shard in the meantime by requests that had it cached.
+    :param paths: the paths of the files of all shards, from connect_shards()
+    :param connections: the connections to all shards, from connect_shards()
+    :param receiver_id: the id of the user
+    :param source: the number of the shard that the mailbox is moved from
+    :param target: the number of the shard that the mailbox is moved to
+    :return: the number of messages moved from the source shard
+    """
+    directory, source_db, target_db = connections[0], connections[source], connections[target]
+    tables = ("messages", "messages_archive")
+    columns = "id, sender_id, receiver_id, message, timestamp"
+
+    def copy():
+        for table in tables:
+            target_db.execute("INSERT OR IGNORE INTO main.%s (%s) SELECT %s FROM source.%s WHERE receiver_id = ?"
+                              % (table, columns, columns, table), (receiver_id,))
+
+    target_db.execute("ATTACH DATABASE ? AS source", (paths[source],))
+    try:
+        # The transactions of the target shard only lock it once they write to it, since an immediate transaction
+        # would lock the attached source shard as well
+        with transaction(target_db, immediate=False):
+            copy()
+
+        with transaction(source_db):
+            shard = directory.execute("SELECT shard FROM users WHERE id = ?", (receiver_id,)).fetchone()[0]
+            if shard == source:
+                if source == 0:
+                    mailbox = source_db.execute("SELECT mailbox_version, last_read_id, unread_count, range_version "
+                                                "FROM users WHERE id = ?", (receiver_id,)).fetchone()
+                else:
+                    mailbox = source_db.execute("SELECT version, last_read_id, unread_count, range_version "
+                                                "FROM mailboxes WHERE receiver_id = ?", (receiver_id,)).fetchone()
+                if mailbox is None:
+                    raise RuntimeError("The mailbox of user %d is missing from shard %d" % (receiver_id, source))
+                version, last_read_id, unread_count, range_version = mailbox
+
+                with transaction(target_db, immediate=False):
+                    copy()
+                    # Messages that were deleted or archived on the source shard since they were copied
+                    for table in tables:
+                        target_db.execute("DELETE FROM main.%s WHERE receiver_id = ? AND id NOT IN "
+                                          "(SELECT id FROM source.%s WHERE receiver_id = ?)" % (table, table),
+                                          (receiver_id, receiver_id))
+                    if target == 0:
+                        target_db.execute("UPDATE users SET shard = 0, mailbox_version = ?, last_read_id = ?, "
+                                          "unread_count = ?, range_version = ? WHERE id = ?",
+                                          (version + 1, last_read_id, unread_count, range_version + 1, receiver_id))
+                    else:
+                        target_db.execute("INSERT OR REPLACE INTO mailboxes (receiver_id, version, last_read_id, "
+                                          "unread_count, range_version) VALUES (?, ?, ?, ?, ?)",
+                                          (receiver_id, version + 1, last_read_id, unread_count, range_version + 1))
+                    target_db.execute("UPDATE message_sequence SET last_id = MAX(last_id, "
+                                      "(SELECT COALESCE(MAX(id), 0) FROM main.messages) / ?, "
+                                      "(SELECT COALESCE(MAX(id), 0) FROM main.messages_archive) / ?)",
+                                      (SHARD_ID_STRIDE, SHARD_ID_STRIDE))
+
+                # With source 0, the directory is changed along with the source shard in step 5
+                if source != 0 and target != 0:
+                    with transaction(directory):
+                        directory.execute("UPDATE users SET shard = ? WHERE id = ?", (target, receiver_id))
+            elif shard == target:
+                with transaction(target_db, immediate=False):
+                    copy()
+                    if target == 0:
+                        mailbox = "users SET mailbox_version = mailbox_version + 1, " \
+                                  "range_version = range_version + 1, unread_count = (%s) WHERE id = ?"
+                    else:
+                        mailbox = "mailboxes SET version = version + 1, range_version = range_version + 1, " \
+                                  "unread_count = (%s) WHERE receiver_id = ?"
+                    target_db.execute("UPDATE " + mailbox % "SELECT COUNT(*) FROM main.messages WHERE receiver_id = ? "
+                                      "AND id > last_read_id", (receiver_id, receiver_id))
+            else:
+                raise RuntimeError("The mailbox of user %d was moved by someone else" % receiver_id)
+
+            moved = sum(source_db.execute("DELETE FROM main.%s WHERE receiver_id = ?" % table,
+                                          (receiver_id,)).rowcount for table in tables)
+            if source == 0:
+                source_db.execute("UPDATE users SET shard = ? WHERE id = ?", (target, receiver_id))
+                source_db.execute("DELETE FROM mailbox_moves WHERE receiver_id = ?", (receiver_id,))
+            else:
+                source_db.execute("DELETE FROM mailboxes WHERE receiver_id = ?", (receiver_id,))
+
+        if source != 0:
+            with transaction(directory):
+                directory.execute("DELETE FROM mailbox_moves WHERE receiver_id = ?", (receiver_id,))
+        return moved
+    finally:
+        target_db.execute("DETACH DATABASE source")
+
 
 def populate_db(db_session):
     from models import User, Message
@@ -38,4 +698,165 @@ def populate_db(db_session):
     db_session.add(m)
     db_session.commit()
 
+    count_unread_messages(db_session.connection())
+    db_session.commit()
+
     print "Database has been populated"
+
+
+def batches(iterable, size):
+    """
+    Groups the items of an iterable into lists.
+    :param iterable: the items, which are only read as the lists are needed
+    :param size: the number of items in each list, except the last one
+    :return: a generator of lists
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_records(filename, fields):
+    """
+    Reads records from a CSV file with a header row, or from an NDJSON file with one JSON object per line. The format
+    is chosen by the file extension: .csv for CSV, anything else for NDJSON.
+    :param filename: the file to read
+    :param fields: the names of the fields to read from each record
+    :return: a generator of tuples with the values of the fields, in the same order
+    """
+    with open(filename, "rb") as f:
+        if filename.lower().endswith(".csv"):
+            for record in csv.DictReader(f):
+                yield tuple(record[field].decode("utf-8") for field in fields)
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield tuple(record[field] for field in fields)
+
+
+def bulk_load(engine, users_file=None, messages_file=None, batch_size=10000, rebuild_indexes=False, shards=None,
+              as_read=False):
+    """
+    Loads users and messages from CSV or NDJSON files (see read_records), much faster than creating them one by one.
+    The files are streamed, and rows are inserted batch_size at a time with executemany INSERTs, each batch in its own
+    transaction (per shard). Users need the field "username", and users that already exist are skipped. Messages need
+    the fields "sender", "receiver" (user names), "message" and "timestamp" (ISO 8601, UTC if there is no time zone).
+    Messages to or from unknown users are skipped, and longer messages are truncated to MESSAGE_MAXLEN characters, like
+    the API does.
+    The loaded messages get higher ids than the existing ones, so they are new to their receivers unless as_read is
+    set.
+    :param engine: the engine of the database to load into
+    :param users_file: the file to read users from, or None
+    :param messages_file: the file to read messages from, or None
+    :param batch_size: the number of rows to insert per transaction
+    :param rebuild_indexes: drop the indexes of the messages table before loading messages, and create them again
+    afterwards, even if the load fails. This is faster when loading many messages into a large table.
+    :param shards: with DATABASE_SHARDS, the engines of all shards, starting with engine. Each message is stored on
+    the shard of its receiver's mailbox, with an id from the shard's id sequence. Mailboxes must not be moved during
+    the load.
+    :param as_read: load the messages as read, e.g. when importing historical messages, by advancing the last_read_id
+    of their receivers past them. Receivers who have not fetched all of their messages yet get the loaded ones as new
+    messages anyway, since the last_read_id can't pass the loaded messages without passing theirs.
+    :return: a dict with the number of users and messages that were loaded and skipped
+    """
+    from models import User, Mailbox, Message, BEGINNING_OF_TIME, MESSAGE_MAXLEN
+
+    counts = {"users": 0, "messages": 0, "skipped_users": 0, "skipped_messages": 0}
+
+    if users_file is not None:
+        insert = User.__table__.insert().prefix_with("OR IGNORE")
+        for batch in batches(read_records(users_file, ["username"]), batch_size):
+            with engine.begin() as connection:
+                inserted = connection.execute(insert, [{"username": username, "last_fetch": BEGINNING_OF_TIME,
+                                                        "last_read_id": 0} for username, in batch]).rowcount
+            counts["users"] += inserted
+            counts["skipped_users"] += len(batch) - inserted
+            print "Loaded %d users" % counts["users"]
+
+    if messages_file is not None:
+        engines = shards or [engine]
+        indexes = list(Message.__table__.indexes)
+        if rebuild_indexes:
+            for shard_engine in engines:
+                with shard_engine.begin() as connection:
+                    for index in indexes:
+                        index.drop(connection)
+
+        try:
+            users = {}
+            for batch in batches(read_records(messages_file, ["sender", "receiver", "message", "timestamp"]),
+                                 batch_size):
+                # Resolve the user names that have not been seen yet, staying below SQLite's limit on bound parameters
+                usernames = list(set(name for record in batch for name in record[:2] if name not in users))
+                for i in range(0, len(usernames), 500):
+                    users.update((username, (user_id, shard)) for username, user_id, shard in engine.execute(
+                        select([User.username, User.id, User.shard]).where(User.username.in_(usernames[i:i + 500]))))
+
+                rows_by_shard = {}
+                for sender, receiver, message, timestamp in batch:
+                    if sender not in users or receiver not in users:
+                        counts["skipped_messages"] += 1
+                        continue
+                    timestamp = parse_iso8601(timestamp) or parser.parse(timestamp)
+                    if timestamp.tzinfo is None:
+                        timestamp = timestamp.replace(tzinfo=pytz.utc)
+                    receiver_id, shard = users[receiver]
+                    rows_by_shard.setdefault(shard if shards else 0, []).append({
+                        "sender_id": users[sender][0], "receiver_id": receiver_id, "message": message[:MESSAGE_MAXLEN],
+                        "timestamp": timestamp.astimezone(pytz.utc)})
+
+                for shard, rows in sorted(rows_by_shard.items()):
+                    with engines[shard].begin() as connection:
+                        message_ids = allocate_message_ids(connection, shard if shards else None, len(rows))
+                        for row, message_id in zip(rows, message_ids):
+                            row["id"] = message_id
+                        connection.execute(Message.__table__.insert(), rows)
+                        # Messages may be loaded into past date ranges, so the ETags of the receivers must change,
+                        # those of the ranges as well.
+                        # The loaded messages have higher ids than the existing ones, so they are unread unless the
+                        # last_read_ids are advanced past them.
+                        received = {}
+                        for row in rows:
+                            count, last_id = received.get(row["receiver_id"], (0, 0))
+                            received[row["receiver_id"]] = (count + 1, row["id"])
+                        if shard == 0:
+                            table, mailbox, version = User.__table__, User.id, User.mailbox_version
+                            last_read_id, unread_count, range_version = User.last_read_id, User.unread_count, \
+                                User.range_version
+                        else:
+                            table, mailbox, version = Mailbox.__table__, Mailbox.receiver_id, Mailbox.version
+                            last_read_id, unread_count, range_version = Mailbox.last_read_id, Mailbox.unread_count, \
+                                Mailbox.range_version
+                        values = {version: version + 1, range_version: range_version + 1,
+                                  unread_count: unread_count + bindparam("count")}
+                        if as_read:
+                            # Both CASEs compare the unread count from before the UPDATE
+                            nothing_unread = unread_count == 0
+                            values[last_read_id] = case([(nothing_unread, func.max(last_read_id,
+                                                                                   bindparam("last_id")))],
+                                                        else_=last_read_id)
+                            values[unread_count] = case([(nothing_unread, 0)], else_=values[unread_count])
+                        mailboxes = table.update().where(mailbox == bindparam("mailbox")).values(values)
+                        if shard == 0 and shards:
+                            mailboxes = mailboxes.where(User.shard == 0)
+                        changed = connection.execute(mailboxes, [
+                            {"mailbox": receiver_id, "count": count, "last_id": last_id}
+                            for receiver_id, (count, last_id) in received.items()]).rowcount
+                        if changed != len(received):
+                            raise RuntimeError("Mailboxes were moved to other shards during the load")
+                    counts["messages"] += len(rows)
+                print "Loaded %d messages" % counts["messages"]
+        finally:
+            if rebuild_indexes:
+                for shard_engine in engines:
+                    with shard_engine.begin() as connection:
+                        create_indexes(connection, Message.__tablename__, *[index.name for index in indexes])
+
+    return counts
+
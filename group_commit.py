@@ -0,0 +1,99 @@
+# coding=utf-8
+import Queue
+import threading
+import time
+
+
+class Submission(object):
+    """Rows submitted to a GroupCommitWriter by one request, and the outcome of committing them."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter(object):
+    """
+    Coalesces the writes of concurrent requests within a worker process into shared transactions, so that the database
+    syncs to disk once per batch instead of once per request.
+    A writer thread takes the first waiting submission, keeps collecting submissions for up to window seconds or until
+    the batch has max_batch rows, and then inserts all of them in one transaction. submit() returns once the batch
+    containing its rows has been committed. If committing a batch fails, its submissions are retried one by one, so
+    that a bad submission only fails its own request.
+    """
+
+    def __init__(self, insert, window=0.002, max_batch=1000, metrics=None):
+        """
+        :param insert: a function that inserts and commits a list of rows in one transaction, rolling back if it fails
+        :param window: the longest time, in seconds, to wait for more submissions before committing a batch. With 0,
+        batches are formed only by the submissions that arrive while the previous batch is being committed.
+        :param max_batch: the number of rows after which a batch is committed without waiting any longer
+        :param metrics: a RequestMetrics to record the batch sizes in, or None
+        """
+        self.insert = insert
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="group-commit-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, rows):
+        """
+        Queues rows to be inserted, and blocks until they have been committed.
+        :param rows: a list of rows for the insert function
+        """
+        submission = Submission(rows)
+        self.queue.put(submission)
+        # Without a timeout, the wait doesn't poll, so the request continues as soon as the commit is done
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+
+    def close(self):
+        """Commits the submissions that are already queued and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            submission = self.queue.get()
+            if submission is None:
+                return
+            batch = [submission]
+            rows = len(submission.rows)
+            deadline = time.time() + self.window
+            while rows < self.max_batch:
+                try:
+                    remaining = deadline - time.time()
+                    submission = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if submission is None:
+                    stopping = True
+                    break
+                batch.append(submission)
+                rows += len(submission.rows)
+            self.commit(batch)
+
+    def commit(self, batch):
+        """Inserts the rows of a batch of submissions in one transaction and wakes up the submitting requests."""
+        try:
+            self.insert([row for submission in batch for row in submission.rows])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                for submission in batch:
+                    try:
+                        self.insert(submission.rows)
+                    except Exception as e:
+                        submission.error = e
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_batch(sum(len(submission.rows) for submission in batch))
+            for submission in batch:
+                submission.done.set()
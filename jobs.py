@@ -0,0 +1,62 @@
+# coding=utf-8
+import errno
+import fcntl
+import os
+import threading
+
+
+class PeriodicJob(object):
+    """
+    Calls a function in a background thread every interval seconds, until the job is closed. The function has to
+    handle its own errors, since an exception ends the thread.
+    Jobs that every worker process starts, but that should only run in one of them at a time, are given a lock file:
+    the first process to take an exclusive lock on it runs the job, and keeps the lock until the job is closed or the
+    process ends, upon which another process takes over.
+    """
+
+    def __init__(self, function, interval, name="periodic-job", lock_file=None):
+        """
+        :param function: the function to call, without arguments
+        :param interval: the number of seconds between the end of one call and the start of the next
+        :param name: the name of the thread
+        :param lock_file: the path of the lock file shared by the processes that start the job, or None to run it in
+        every process
+        """
+        self.function = function
+        self.interval = interval
+        self.lock_file = lock_file
+        self.lock_fd = None
+        self.elected = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stops the thread, waiting for a call that is in progress to finish, and gives up the lock."""
+        self.stopping.set()
+        self.thread.join()
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+            self.elected = False
+
+    def elect(self):
+        """:return: whether this process runs the job, taking the lock if no other process holds it"""
+        if self.lock_file is None or self.elected:
+            return True
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        self.elected = True
+        return True
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            if self.elect():
+                self.function()
@@ -0,0 +1,253 @@
+# coding=utf-8
+import errno
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+# The upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The upper bounds of the group commit batch size histogram buckets, in messages
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# The counters recorded for each endpoint: the key in the snapshots, the Prometheus metric name and its help text
+COUNTERS = [
+    ("sql_statements", "babbel_sql_statements_total", "SQL statements executed."),
+    ("db_seconds", "babbel_db_seconds_total", "Time spent executing SQL statements, in seconds."),
+    ("rows", "babbel_rows_total", "Rows of messages and users read from the database for the responses."),
+    ("commits", "babbel_commits_total", "Database transactions committed."),
+]
+
+
+def format_value(value):
+    """Formats a sample value for Prometheus: integers as such, floats without loss of precision."""
+    if isinstance(value, float):
+        return repr(value)
+    return "%d" % value
+
+
+def endpoint_label(endpoint):
+    return 'endpoint="%s"' % endpoint.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def bucket_index(bounds, value):
+    """:return: the index of the histogram bucket for a value, len(bounds) for the +Inf bucket"""
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def histogram_lines(name, labels, bounds, buckets, total, count):
+    """:return: the Prometheus sample lines of a histogram with non-cumulative bucket counts"""
+    prefix = labels + "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, bucket in zip(bounds + ("+Inf",), buckets):
+        cumulative += bucket
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, cumulative))
+    labels = "{%s}" % labels if labels else ""
+    lines.append("%s_sum%s %s" % (name, labels, format_value(total)))
+    lines.append("%s_count%s %d" % (name, labels, count))
+    return lines
+
+
+def new_batch_metrics():
+    return {"buckets": [0] * (len(BATCH_SIZE_BUCKETS) + 1), "count": 0, "rows": 0}
+
+
+def new_endpoint_metrics():
+    metrics = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0, "seconds": 0.0}
+    for key, name, help_text in COUNTERS:
+        metrics[key] = 0
+    return metrics
+
+
+class RequestMetrics(object):
+    """
+    Records the latency, the number of SQL statements, the time spent in the database, the rows read and the commits
+    of requests, per endpoint, and the sizes of the batches of the group commit writer.
+    Each worker process aggregates its own requests, and periodically writes them to a file of its own in a directory
+    shared by all worker processes (e.g. uWSGI processes). snapshot() adds up the files of all processes, including
+    processes that have exited, so that the counters never decrease. The directory should be emptied when the app is
+    deployed.
+    Usage: call start() when a request starts and finish() when it ends, and instrument() each engine.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0, slow_request_seconds=None):
+        """
+        :param directory: the directory for the metrics files of all worker processes. If it is None, only the
+        requests of this process are counted.
+        :param flush_interval: how often, in seconds, the metrics of this process are written to its file
+        :param slow_request_seconds: the latency above which the SQL statements of a request are returned by
+        finish(), or None to not record SQL statements
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.slow_request_seconds = slow_request_seconds
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.batches = new_batch_metrics()
+        self.current = threading.local()
+        self.next_flush = 0
+
+        self.filename = None
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # The start time keeps a process from overwriting the file of an earlier process with the same pid
+            self.filename = os.path.join(directory, "%d-%d.json" % (os.getpid(), time.time() * 1000))
+
+    def instrument(self, engine):
+        """Counts the SQL statements and commits of an engine towards the current request of each thread."""
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        event.listen(engine, "commit", self.commit)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        request = getattr(self.current, "request", None)
+        if request is not None:
+            request["statement_started"] = time.time()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        request = getattr(self.current, "request", None)
+        if request is not None and "statement_started" in request:
+            seconds = time.time() - request.pop("statement_started")
+            request["sql_statements"] += 1
+            request["db_seconds"] += seconds
+            if request["statements"] is not None:
+                request["statements"].append((seconds, statement, parameters))
+
+    def commit(self, conn):
+        request = getattr(self.current, "request", None)
+        if request is not None:
+            request["commits"] += 1
+
+    def add_rows(self, count):
+        """Counts rows read from the database towards the current request."""
+        request = getattr(self.current, "request", None)
+        if request is not None:
+            request["rows"] += count
+
+    def start(self):
+        """Starts recording a request in the current thread."""
+        request = {"started": time.time(), "statements": [] if self.slow_request_seconds is not None else None}
+        for key, name, help_text in COUNTERS:
+            request[key] = 0
+        self.current.request = request
+
+    def finish(self, endpoint):
+        """
+        Stops recording the request in the current thread and adds it to the metrics of its endpoint.
+        :param endpoint: the name of the endpoint, e.g. MessageList.get
+        :return: if the request took longer than slow_request_seconds, a tuple of its latency and a list of the
+        (seconds, statement, parameters) tuples of its SQL statements, otherwise None
+        """
+        request = getattr(self.current, "request", None)
+        if request is None:
+            return None
+        self.current.request = None
+        seconds = time.time() - request["started"]
+
+        bucket = bucket_index(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self.endpoints[endpoint] = new_endpoint_metrics()
+            metrics["buckets"][bucket] += 1
+            metrics["count"] += 1
+            metrics["seconds"] += seconds
+            for key, name, help_text in COUNTERS:
+                metrics[key] += request[key]
+        self.flush()
+
+        if self.slow_request_seconds is not None and seconds > self.slow_request_seconds:
+            return seconds, request["statements"]
+        return None
+
+    def observe_batch(self, rows):
+        """Records the number of rows committed together by the group commit writer."""
+        with self.lock:
+            self.batches["buckets"][bucket_index(BATCH_SIZE_BUCKETS, rows)] += 1
+            self.batches["count"] += 1
+            self.batches["rows"] += rows
+
+    def flush(self, force=False):
+        """
+        Writes the metrics of this process to its file, at most every flush_interval seconds unless forced.
+        """
+        if self.filename is None or (not force and time.time() < self.next_flush):
+            return
+        with self.lock:
+            self.next_flush = time.time() + self.flush_interval
+            data = json.dumps({"endpoints": self.endpoints, "batches": self.batches})
+        # Renaming replaces the file atomically, so that readers never see a partially written file
+        temporary = "%s.%d.tmp" % (self.filename, threading.current_thread().ident)
+        with open(temporary, "w") as f:
+            f.write(data)
+        os.rename(temporary, self.filename)
+
+    def snapshot(self):
+        """
+        :return: a tuple of a dict from endpoint to the metrics of all processes added up, and the batch metrics of
+        all processes added up
+        """
+        with self.lock:
+            processes = [json.loads(json.dumps({"endpoints": self.endpoints, "batches": self.batches}))]
+        if self.directory is not None:
+            for filename in os.listdir(self.directory):
+                path = os.path.join(self.directory, filename)
+                if filename.endswith(".json") and path != self.filename:
+                    try:
+                        with open(path) as f:
+                            processes.append(json.load(f))
+                    except (IOError, ValueError):  # Removed or replaced while reading
+                        pass
+
+        def add(total, metrics):
+            for key, value in metrics.items():
+                if key == "buckets":
+                    total[key] = [a + b for a, b in zip(total[key], value)]
+                else:
+                    total[key] += value
+
+        totals = {}
+        batches = new_batch_metrics()
+        for process in processes:
+            for endpoint, metrics in process["endpoints"].items():
+                if endpoint not in totals:
+                    totals[endpoint] = new_endpoint_metrics()
+                add(totals[endpoint], metrics)
+            add(batches, process["batches"])
+        return totals, batches
+
+    def render(self):
+        """
+        :return: the metrics of all processes in the Prometheus text exposition format
+        """
+        totals, batches = self.snapshot()
+        endpoints = sorted(totals)
+        lines = ["# HELP babbel_request_duration_seconds Request latency in seconds.",
+                 "# TYPE babbel_request_duration_seconds histogram"]
+        for endpoint in endpoints:
+            metrics = totals[endpoint]
+            lines.extend(histogram_lines("babbel_request_duration_seconds", endpoint_label(endpoint), LATENCY_BUCKETS,
+                                         metrics["buckets"], metrics["seconds"], metrics["count"]))
+
+        for key, name, help_text in COUNTERS:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for endpoint in endpoints:
+                lines.append("%s{%s} %s" % (name, endpoint_label(endpoint), format_value(totals[endpoint][key])))
+
+        lines.append("# HELP babbel_group_commit_batch_size Messages committed together by the group commit writer.")
+        lines.append("# TYPE babbel_group_commit_batch_size histogram")
+        lines.extend(histogram_lines("babbel_group_commit_batch_size", "", BATCH_SIZE_BUCKETS, batches["buckets"],
+                                     batches["rows"], batches["count"]))
+        return "\n".join(lines) + "\n"
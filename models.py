@@ -2,10 +2,10 @@
 from datetime import datetime
 
 import pytz
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, TypeDecorator
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, DateTime, TypeDecorator, Index, event
 from sqlalchemy.orm import relationship
 
-from database import Base
+from database import Base, create_search_index
 
 MESSAGE_MAXLEN = 100
 BEGINNING_OF_TIME = datetime(1987, 4, 2, 0, 0, 1, tzinfo=pytz.utc)
@@ -24,12 +24,32 @@ class AwareDateTime(TypeDecorator):
 
 
 class User(Base):
-    """Represents a user. A user is nly identified by their user name. Each user also has a last refresh timestamp."""
+    """
+    Represents a user. A user is nly identified by their user name. Each user also has the id of the last message
+    they have fetched, so that messages with higher ids are new, and a version number of their mailbox, which changes
+    whenever messages are stored for them or deleted, and from which the ETags of their messages are derived, and the
+    number of messages they haven't fetched yet. The range version only changes when messages in past date ranges do,
+    see babbel.range_etag().
+    Read messages older than retention_days days are moved to the archive, see ArchivedMessage, and archived tells
+    whether the archive may have messages of the user.
+    The users table is also the shard directory: shard is the number of the database that the user's messages are
+    stored in, 0 being the primary database.
+    """
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
     username = Column(String(50), unique=True, nullable=False)
+    # No longer used to find new messages, last_read_id replaced it. Kept since older databases have the column.
     last_fetch = Column(AwareDateTime(timezone=True), nullable=False)
+    last_read_id = Column(Integer, nullable=False, default=0, server_default="0")
+    mailbox_version = Column(Integer, nullable=False, default=0, server_default="0")
+    range_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # The number of messages with a higher id than last_read_id
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+    shard = Column(Integer, nullable=False, default=0, server_default="0")
+    # Overrides the RETENTION_DAYS setting for the user if not NULL
+    retention_days = Column(Integer)
+    archived = Column(Boolean, nullable=False, default=False, server_default="0")
 
     def __init__(self, username=None, last_fetch=None):
         self.username = username
@@ -37,14 +57,27 @@ class User(Base):
             self.last_fetch = last_fetch
         else:
             self.last_fetch = BEGINNING_OF_TIME
+        self.last_read_id = 0
+        self.shard = 0
 
     def __repr__(self):
-        return '<User %d: %s (last seen %s)>' % (self.id, self.username, self.last_fetch.strftime("%Y-%m-%d %H:%M:%S"))
+        return '<User %d: %s (last read message %d)>' % (self.id, self.username, self.last_read_id)
 
 
 class Message(Base):
-    """Represents a message. A message has a sender, a receiver, the actual message contents and a timestamp."""
+    """
+    Represents a message. A message has a sender, a receiver, the actual message contents and a timestamp. Its id is
+    higher than the ids of all messages stored before it.
+    """
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Serves the date range queries in MessageList, which always filter on the receiver
+        Index("ix_messages_receiver_timestamp", "receiver_id", "timestamp"),
+        # Serves lookups of a specific message belonging to a receiver
+        Index("ix_messages_receiver_id", "receiver_id", "id"),
+        # Serves the conversations between two users, one index range per direction
+        Index("ix_messages_sender_receiver_timestamp", "sender_id", "receiver_id", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -72,3 +105,67 @@ class Message(Base):
                                                   self.receiver.username,
                                                   self.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
                                                   self.message)
+
+
+class ArchivedMessage(Base):
+    """
+    A message that has been moved out of the messages table by the retention policy of its receiver, in the same
+    database. It has the same columns, and keeps its id. Date range queries and lookups by id read both tables, so
+    archived messages are still there for clients, but they don't weigh on the indexes that most queries use.
+    """
+    __tablename__ = "messages_archive"
+    __table_args__ = (
+        Index("ix_messages_archive_receiver_timestamp", "receiver_id", "timestamp"),
+        Index("ix_messages_archive_sender_receiver_timestamp", "sender_id", "receiver_id", "timestamp"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    message = Column(String(MESSAGE_MAXLEN), nullable=False)
+    timestamp = Column(AwareDateTime(timezone=True), nullable=False)
+
+
+# New databases and shards get the full-text index along with the messages and messages_archive tables, whichever is
+# created last, older ones through migrations 6 and 10 and create_shard_tables
+for model in (Message, ArchivedMessage):
+    event.listen(model.__table__, "after_create", lambda target, connection, **kw: create_search_index(connection))
+
+
+class Mailbox(Base):
+    """
+    The versions, last_read_id and unread count of a mailbox on a shard other than the primary database, which has
+    them in the users table. Keeping them on the shard lets a request change messages in one database, and a mailbox
+    is on a shard exactly when the shard has its row.
+    """
+    __tablename__ = "mailboxes"
+
+    receiver_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    last_read_id = Column(Integer, nullable=False, default=0, server_default="0")
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+    range_version = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class MailboxMove(Base):
+    """
+    A move of a mailbox to another shard that has been started but not finished yet, see database.move_mailbox. Only
+    used when the messages are sharded, in the primary database.
+    """
+    __tablename__ = "mailbox_moves"
+
+    receiver_id = Column(Integer, primary_key=True)
+    source = Column(Integer, nullable=False)
+    target = Column(Integer, nullable=False)
+
+
+class MessageSequence(Base):
+    """
+    The single row of this table holds the last message id sequence number that the shard it is in has handed out, see
+    database.allocate_message_ids. Until the messages are sharded, the primary database keeps the last message id in
+    row 0 instead.
+    """
+    __tablename__ = "message_sequence"
+
+    id = Column(Integer, primary_key=True)
+    last_id = Column(Integer, nullable=False)
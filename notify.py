@@ -0,0 +1,317 @@
+# coding=utf-8
+import errno
+import os
+import threading
+import time
+from collections import deque
+
+# Wakeup files are replaced when they grow larger than this, see NotificationHub.notify()
+WAKEUP_FILE_MAXSIZE = 1024 * 1024
+
+# The number of notifications each process remembers, see NotificationHub.wait()
+RECENT_NOTIFICATIONS = 10000
+
+# The log file of RecentWriters is replaced when it grows larger than this
+WRITES_LOG_MAXSIZE = 1024 * 1024
+
+
+class NotificationHub(object):
+    """
+    Lets requests wait for new messages to a receiver, instead of polling the database.
+    Within a worker process, notifications go to a bounded log of the most recent receivers, and waiting threads are
+    woken up through a condition variable. Worker processes (e.g. uWSGI processes) are reached through one wakeup file
+    in a shared directory: storing messages appends the ids of their receivers to it in a single write, and waiting
+    threads read what has been appended at every poll interval. Storing messages for any number of receivers therefore
+    takes a few system calls, whether or not anyone is waiting.
+    Usage: take a token() before querying for messages, and if there are none, wait() with that token. This way, no
+    notification can be lost between the query and the wait.
+    """
+
+    def __init__(self, directory=None, poll_interval=0.25, size=RECENT_NOTIFICATIONS):
+        """
+        :param directory: the directory for the wakeup file, which should be shared by all worker processes. If it is
+        None, only threads within this process are woken up.
+        :param poll_interval: how often, in seconds, waiting threads check the wakeup file
+        :param size: the number of notifications remembered within this process. Threads that have been waiting for
+        longer than it takes to store messages for this many receivers are woken up to check for messages.
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.recent = deque(maxlen=size)
+
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.wakeup_file = os.path.join(directory, "wakeup")
+            os.close(os.open(self.wakeup_file, os.O_WRONLY | os.O_CREAT, 0o644))
+
+    def file_state(self):
+        if self.directory is None:
+            return None
+        try:
+            stat = os.stat(self.wakeup_file)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def token(self, receiver_id):
+        """
+        Captures the notification state for a receiver, to be passed to wait().
+        :param receiver_id: the id of the receiving user
+        :return: an opaque token
+        """
+        with self.condition:
+            return self.sequence, self.file_state()
+
+    def notify(self, receiver_ids):
+        """
+        Wakes up all requests waiting for messages to some receivers, in this and other processes. Call this after the
+        messages have been committed.
+        :param receiver_ids: the ids of the receiving users
+        """
+        receiver_ids = list(receiver_ids)
+        if not receiver_ids:
+            return
+        with self.condition:
+            for receiver_id in receiver_ids:
+                self.sequence += 1
+                self.recent.append((self.sequence, receiver_id))
+            self.condition.notify_all()
+
+        if self.directory is not None:
+            # Appending is atomic, so concurrent notifications from other processes can't get lost
+            data = "".join("%d\n" % receiver_id for receiver_id in receiver_ids)
+            while True:
+                fd = os.open(self.wakeup_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    if os.fstat(fd).st_size >= WAKEUP_FILE_MAXSIZE:
+                        # Threads waiting on the old file see that it has been replaced, and check for messages
+                        try:
+                            os.unlink(self.wakeup_file)
+                            continue
+                        except OSError as e:
+                            if e.errno == errno.ENOENT:
+                                continue
+                    os.write(fd, data)
+                    # If another process replaced the file in the meantime, the ids are written to the new one too
+                    file_state = self.file_state()
+                    if file_state is not None and file_state[0] == os.fstat(fd).st_ino:
+                        return
+                finally:
+                    os.close(fd)
+
+    def notified(self, receiver_id, sequence):
+        """
+        Checks the log of this process for notifications. Must be called with the condition held.
+        :return: whether there has been a notification for the receiver after the sequence number, or whether the log
+        does not go back that far anymore
+        """
+        for logged, logged_receiver_id in reversed(self.recent):
+            if logged <= sequence:
+                return False
+            if logged_receiver_id == receiver_id:
+                return True
+        return bool(self.recent) and self.recent[0][0] > sequence + 1
+
+    def read_wakeup_file(self, receiver_id, file_state):
+        """
+        Checks the wakeup file for notifications from other processes.
+        :param receiver_id: the id of the receiving user
+        :param file_state: the state of the file when it was last checked
+        :return: a tuple of whether there has been a notification for the receiver since, or whether the file has been
+        replaced, and the new state of the file
+        """
+        if self.file_state() == file_state:
+            return False, file_state
+        try:
+            fd = os.open(self.wakeup_file, os.O_RDONLY)
+        except OSError:
+            return True, None
+        try:
+            stat = os.fstat(fd)
+            if file_state is None or stat.st_ino != file_state[0] or stat.st_size < file_state[1]:
+                return True, (stat.st_ino, stat.st_size)
+            os.lseek(fd, file_state[1], os.SEEK_SET)
+            data = os.read(fd, stat.st_size - file_state[1])
+        finally:
+            os.close(fd)
+        # Only whole lines, in case a write is still going on
+        data = data[:data.rfind("\n") + 1]
+        return "%d" % receiver_id in data.split(), (file_state[0], file_state[1] + len(data))
+
+    def wait(self, receiver_id, token, timeout):
+        """
+        Blocks until there is a notification for a receiver that happened after the token was taken, or until the
+        timeout expires.
+        :param receiver_id: the id of the receiving user
+        :param token: a token from token()
+        :param timeout: the maximum number of seconds to wait
+        :return: True if there was a notification, False if the timeout expired
+        """
+        sequence, file_state = token
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.notified(receiver_id, sequence):
+                    return True
+                sequence = self.sequence
+                if self.directory is not None:
+                    notified, file_state = self.read_wakeup_file(receiver_id, file_state)
+                    if notified:
+                        return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self.directory is not None:
+                    remaining = min(remaining, self.poll_interval)
+                self.condition.wait(remaining)
+
+
+class RecentWriters(object):
+    """
+    Remembers which users have recently changed data, so that their reads can go to the primary database instead of a
+    read replica that might not have caught up with their changes yet.
+    Within a process, the writes of the last window seconds are kept in a log ordered by time, and older ones are
+    dropped. Worker processes share their writes through one log file in a directory: recording a write appends the
+    user id and time to it in a single write, and each process reads what has been appended when it checks for
+    writes. Like the wakeup file of NotificationHub, the log file is replaced when it gets too large.
+    """
+
+    def __init__(self, directory=None, window=5.0):
+        """
+        :param directory: the directory for the log file, which should be shared by all worker processes. If it is
+        None, only writes within this process are remembered.
+        :param window: for how many seconds after a write the user's reads go to the primary database. This should be
+        longer than the replication lag of the read replicas.
+        """
+        self.directory = directory
+        self.window = window
+        self.lock = threading.Lock()
+        # The time of the last write of each user within the window, and the writes in the order they were learned of
+        self.writes = {}
+        self.log = deque()
+        # The file descriptors of the log file for appending and reading, opened when first needed
+        self.append_fd = None
+        self.read_fd = None
+        self.read_inode = None
+        self.read_offset = 0
+
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.log_file = os.path.join(directory, "writes")
+
+    def remember(self, user_id, when):
+        """Remembers a write. Must be called with the lock held."""
+        if when > self.writes.get(user_id, 0):
+            self.writes[user_id] = when
+            self.log.append((when, user_id))
+
+    def forget(self, since):
+        """Drops the writes from before a time. Must be called with the lock held."""
+        log = self.log
+        while log and log[0][0] <= since:
+            when, user_id = log.popleft()
+            if self.writes.get(user_id) == when:
+                del self.writes[user_id]
+
+    def record(self, user_id):
+        """
+        Records that a user has just changed data.
+        :param user_id: the id of the user
+        """
+        now = time.time()
+        with self.lock:
+            self.remember(user_id, now)
+            self.forget(now - self.window)
+            if self.directory is not None:
+                self.append("%d %.6f\n" % (user_id, now))
+
+    def append(self, data):
+        """Appends a record to the log file. Must be called with the lock held."""
+        while True:
+            if self.append_fd is None:
+                self.append_fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            stat = os.fstat(self.append_fd)
+            if stat.st_size >= WRITES_LOG_MAXSIZE:
+                # Readers finish reading the old file before they go on with the new one
+                try:
+                    os.unlink(self.log_file)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                os.close(self.append_fd)
+                self.append_fd = None
+                continue
+            # Appending is atomic, so concurrent records from other processes can't get lost
+            os.write(self.append_fd, data)
+            # If another process replaced the file in the meantime, the record goes to the new one too
+            try:
+                if os.stat(self.log_file).st_ino == stat.st_ino:
+                    return
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            os.close(self.append_fd)
+            self.append_fd = None
+
+    def read_log(self, since):
+        """Reads the records that other processes have appended to the log file. Must be called with the lock held."""
+        try:
+            stat = os.stat(self.log_file)
+        except OSError:
+            stat = None
+        if stat is not None and stat.st_ino == self.read_inode and stat.st_size == self.read_offset:
+            return
+        if self.read_fd is not None:
+            self.read_records(since)
+            if stat is None or stat.st_ino != self.read_inode:
+                os.close(self.read_fd)
+                self.read_fd = None
+        if self.read_fd is None and stat is not None:
+            try:
+                self.read_fd = os.open(self.log_file, os.O_RDONLY)
+            except OSError:
+                return
+            self.read_inode = os.fstat(self.read_fd).st_ino
+            self.read_offset = 0
+            self.read_records(since)
+
+    def read_records(self, since):
+        """Reads the whole records after read_offset from read_fd. Must be called with the lock held."""
+        os.lseek(self.read_fd, self.read_offset, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = "".join(chunks)
+        # Only whole lines, in case a write is still going on
+        data = data[:data.rfind("\n") + 1]
+        self.read_offset += len(data)
+        for line in data.splitlines():
+            user_id, when = line.split()
+            when = float(when)
+            if when > since:
+                self.remember(int(user_id), when)
+
+    def recent(self, user_id):
+        """
+        :param user_id: the id of the user
+        :return: whether the user has changed data within the last window seconds, in any worker process
+        """
+        since = time.time() - self.window
+        with self.lock:
+            if self.directory is not None:
+                self.read_log(since)
+            self.forget(since)
+            return self.writes.get(user_id, 0) > since
@@ -0,0 +1,82 @@
+# coding=utf-8
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
+
+from timestamps import format_timestamp
+
+# Functions that encode a string as a JSON string literal, exactly like the json module does by default. The json
+# module's own is implemented in C.
+JSON_BACKENDS = {"json": encode_basestring_ascii}
+try:
+    from simplejson.encoder import encode_basestring_ascii as simplejson_encode_basestring_ascii
+    JSON_BACKENDS["simplejson"] = simplejson_encode_basestring_ascii
+except ImportError:
+    pass
+
+# The JSON encoder writes the keys of a dict in iteration order. A dict literal with the same keys as the one built by
+# babbel.dictify_message iterates in the same order, so the serialized messages have the same bytes.
+MESSAGE_KEYS = list({"id": None, "sender": None, "message": None, "timestamp": None})
+
+# The template is filled with the encoded (id, sender, message, timestamp) values, reordered by order_fields
+MESSAGE_FIELDS = ["id", "sender", "message", "timestamp"]
+MESSAGE_TEMPLATE = "{" + ", ".join('"%s": %s' % (key, '"%s"' if key == "timestamp" else "%s")
+                                   for key in MESSAGE_KEYS) + "}"
+order_fields = itemgetter(*[MESSAGE_FIELDS.index(key) for key in MESSAGE_KEYS])
+
+
+class MessageSerializer(object):
+    """
+    Serializes message rows straight to JSON text, skipping the intermediate dicts and the general JSON encoder. The
+    output is byte for byte what Flask-RESTful produces for the dicts of babbel.dictify_message.
+    Timestamps are taken from the text that SQLite stores, e.g. "2016-10-08 16:17:25.735955", which starts with the
+    serialized form, instead of formatting datetime objects.
+    Since messages never change once written, the JSON of each message can optionally be cached. The name of the
+    sender can change though, so entries are keyed by both id and sender name, and a renamed sender's messages are
+    encoded anew. When the cache is full, an arbitrary entry is dropped, which is much cheaper than keeping track of
+    the least recently used one.
+    """
+
+    def __init__(self, backend="json", cache_size=0):
+        """
+        :param backend: the name of the string encoder to use, from JSON_BACKENDS
+        :param cache_size: the number of serialized messages to cache, or 0 to disable the cache
+        """
+        self.encode_string = JSON_BACKENDS[backend]
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def encode(self, message):
+        """
+        :param message: a message row, as returned by babbel.query_messages()
+        :return: the JSON object of the message
+        """
+        timestamp = message.stored_timestamp
+        if self.cache_size:
+            key = (message.id, message.sender)
+            encoded = self.cache.get(key)
+            if encoded is not None:
+                return encoded
+
+        if len(timestamp) == 26 or len(timestamp) == 19:
+            timestamp = timestamp[:19]
+        else:  # Not written by SQLAlchemy
+            timestamp = format_timestamp(message.timestamp)
+        encode_string = self.encode_string
+        encoded = MESSAGE_TEMPLATE % order_fields((message.id, encode_string(message.sender),
+                                                   encode_string(message.message), timestamp))
+
+        if self.cache_size:
+            if len(self.cache) >= self.cache_size:
+                try:
+                    self.cache.popitem()
+                except KeyError:  # Emptied by another thread
+                    pass
+            self.cache[key] = encoded
+        return encoded
+
+    def encode_list(self, messages):
+        """
+        :param messages: a list of message rows
+        :return: the JSON list of the messages, followed by a newline like Flask-RESTful's responses
+        """
+        return "[" + ", ".join(map(self.encode, messages)) + "]\n"
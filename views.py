@@ -1,15 +1,22 @@
 # coding=utf-8
+import heapq
 from datetime import datetime, timedelta
 from urllib import quote_plus
 
 import pytz
-from flask import escape, request, Blueprint, current_app, render_template
+from flask import escape, request, Blueprint, Response, current_app, render_template, stream_with_context
+from flask_restful import abort
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
 
 import babbel
-from models import User, Message
+from models import ArchivedMessage, User, Message, BEGINNING_OF_TIME
 
 views = Blueprint("views", __name__)
 
+# The number of users and messages shown per page by the views, unless the "limit" GET parameter says otherwise
+VIEW_PAGE_SIZE = 100
+
 # Below is the ugly code for the "client".
 # I've made no effort to make the client return valid HTML, or even make it fully functional as a messaging tool.
 # It's the equivalent of a debug printout, pretty much.
@@ -27,27 +34,96 @@ def dates():
     return render_template("dates.html", minus5=minus5, minus1=minus1, now=now, plus1=plus1, plus5=plus5)
 
 
+def stream_template(template_name, **context):
+    """
+    Renders a template as it is sent to the client, instead of building the whole page in memory first.
+    :param template_name: the name of the template
+    :param context: the variables of the template
+    :return: a streaming Response
+    """
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(16)
+    return Response(stream_with_context(stream))
+
+
+def parse_after(name):
+    """
+    Parses a GET parameter with the id after which a page of users or messages starts.
+    :param name: the name of the parameter
+    :return: the id, 0 if the parameter is missing. Raises 400 Bad Request for invalid ids.
+    """
+    value = request.args.get(name, "0")
+    if not value.isdigit():
+        abort(400)
+    return int(value)
+
+
 @views.route("/<string:username>/", methods=["GET"])
 def index(username):
     """
-    Simple view that allows you to send messages and see all of your own messages.
+    Simple view that allows you to send messages and see your own messages, a page at a time. The pages follow each
+    other in timestamp order, using the same cursors as MessageList.
     """
     current_app.logger.debug(u"GET index %s" % request.path)
 
     user = babbel.get_user_or_error(username)
-    messages = Message.query.filter_by(receiver=user).order_by(Message.timestamp)
+    cursor = babbel.decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+    limit = babbel.parse_limit(request.args["limit"]) if "limit" in request.args else VIEW_PAGE_SIZE
+    query = babbel.query_user_messages(user, BEGINNING_OF_TIME, datetime.now(pytz.utc), cursor)
+    messages, has_more = babbel.fetch_page(query, limit)
 
-    return render_template("profile.html", messages=messages, username=username)
+    session = babbel.messages_db(user)
+    total = session.query(func.count(Message.id)).filter(Message.receiver_id == user.id).scalar()
+    if user.archived:
+        total += session.query(func.count(ArchivedMessage.id)).filter(ArchivedMessage.receiver_id == user.id).scalar()
+
+    return stream_template("profile.html", messages=messages, username=username, total=total,
+                           unread=babbel.get_unread_count(user), limit=limit,
+                           next_cursor=babbel.encode_cursor(messages[-1]) if has_more else None)
 
 
 @views.route("/db/", methods=["GET"])
 def db():
     """
-    Displays the contents of the database (messages and users).
+    Displays the contents of the database (messages and users), a page of users and a page of messages at a time, in
+    id order. With DATABASE_SHARDS, the messages of all shards are listed, and the number of mailboxes and messages on
+    each shard. The totals are counted by the database instead of loading every row.
     """
     current_app.logger.debug(u"GET db %s" % request.path)
 
-    users = User.query.all()
-    messages = Message.query.all()
-
-    return render_template("db.html", users=users, messages=messages)
+    users_after = parse_after("users_after")
+    messages_after = parse_after("messages_after")
+    limit = babbel.parse_limit(request.args["limit"]) if "limit" in request.args else VIEW_PAGE_SIZE
+
+    directory = babbel.read_db()
+    users = directory.query(User).filter(User.id > users_after).order_by(User.id).limit(limit + 1).all()
+    mailboxes = dict(directory.query(User.shard, func.count(User.id)).group_by(User.shard))
+
+    sender = aliased(User)
+    receiver = aliased(User)
+    pages = []
+    shards = []
+    for shard, session in enumerate(babbel.message_dbs()):
+        query = session.query(Message.id, Message.timestamp, Message.message, sender.username.label("sender"),
+                              receiver.username.label("receiver")) \
+            .join(sender, Message.sender_id == sender.id).join(receiver, Message.receiver_id == receiver.id) \
+            .filter(Message.id > messages_after).order_by(Message.id).limit(limit + 1)
+        # Message ids are unique across shards, so the pages can be merged by id
+        pages.append([(message.id, message) for message in query])
+        shards.append({"mailboxes": mailboxes.get(shard, 0),
+                       "messages": session.query(func.count(Message.id)).scalar(),
+                       "archived": session.query(func.count(ArchivedMessage.id)).scalar()})
+    messages = [message for msg_id, message in heapq.merge(*pages)][:limit + 1]
+    babbel.count_rows(len(users) + sum(len(page) for page in pages))
+
+    range_cache = babbel.range_cache.stats() if babbel.range_cache is not None else None
+    return stream_template("db.html", users=users[:limit], messages=messages[:limit], limit=limit,
+                           users_after=users_after, messages_after=messages_after,
+                           next_users=users[limit - 1].id if len(users) > limit else None,
+                           next_messages=messages[limit - 1].id if len(messages) > limit else None,
+                           total_users=sum(mailboxes.values()),
+                           total_messages=sum(shard["messages"] for shard in shards),
+                           total_archived=sum(shard["archived"] for shard in shards),
+                           shards=shards if babbel.shard_sessions else None,
+                           user_cache=babbel.user_cache.stats(), range_cache=range_cache)